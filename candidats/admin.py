@@ -45,7 +45,7 @@ def export_candidates(modeladmin, request, queryset):
 
     export = OpenXMLExport('Exportation')
     export.write_line(export_fields.keys(), bold=True)
-    for cand in queryset.values_list(*export_fields.values()):
+    for cand in queryset.values_list(*export_fields.values()).iterator():
         values = []
         for value, field_name in zip(cand, export_fields.values()):
             if value != '' and value is not None and field_name in choice_fields:
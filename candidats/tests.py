@@ -1,14 +1,15 @@
 from datetime import date, datetime
-from io import BytesIO
+from io import BytesIO, StringIO
 from unittest import mock
 
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
 
 from stages.views.export import openxml_contenttype
-from stages.models import Section, Teacher
+from stages.models import Job, Section, Teacher
 from .models import Candidate, Interview
 from .pdf import InscriptionSummaryPDF
 
@@ -20,6 +21,9 @@ class CandidateTests(TestCase):
             'me', 'me@example.org', 'mepassword', first_name='Hans', last_name='Schmid',
         )
 
+    def send_queued_mails(self):
+        call_command('run_jobs', concurrency=1, once=True, stdout=StringIO())
+
     def test_total_result(self):
         ede = Section.objects.create(name='EDE')
         cand = Candidate(
@@ -138,6 +142,11 @@ class CandidateTests(TestCase):
         response = self.client.post(
             reverse('candidate-confirmation', args=[cand3.pk]), data=data, follow=True
         )
+        self.assertContains(
+            response, "La confirmation d’inscription pour Dupond Henri a été placée dans la file d’envoi"
+        )
+        self.assertEqual(len(mail.outbox), 0)
+        self.send_queued_mails()
         self.assertEqual(len(mail.outbox), 1)
         # Logged-in user also receives as Bcc
         self.assertEqual(mail.outbox[0].recipients(), ['henri@example.org', 'me@example.org'])
@@ -164,6 +173,7 @@ tél. 032 886 33 00"""
         response = self.client.post(
             reverse('candidate-confirmation', args=[cand4.pk]), data=data, follow=True
         )
+        self.send_queued_mails()
         self.assertEqual(len(mail.outbox), 1)
         # Logged-in user also receives as Bcc
         self.assertEqual(mail.outbox[0].recipients(), ['joe@example.org', 'me@example.org'])
@@ -192,6 +202,7 @@ tél. 032 886 33 00"""
         response = self.client.post(
             reverse('candidate-confirmation', args=[cand5.pk]), data=data, follow=True
         )
+        self.send_queued_mails()
         self.assertEqual(len(mail.outbox), 1)
         # Logged-in user also receives as Bcc
         self.assertEqual(mail.outbox[0].recipients(), ['john@example.org', 'me@example.org'])
@@ -223,12 +234,17 @@ tél. 032 886 33 00"""
         self.client.login(username='me', password='mepassword')
         response = self.client.get(reverse('candidate-confirmation', args=[henri.pk]))
         data = response.context['form'].initial
-        with mock.patch('django.core.mail.EmailMessage.send') as mocked:
+        response = self.client.post(
+            reverse('candidate-confirmation', args=[henri.pk]), data=data, follow=True
+        )
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages') as mocked:
             mocked.side_effect = Exception("Error sending mail")
-            response = self.client.post(
-                reverse('candidate-confirmation', args=[henri.pk]), data=data, follow=True
-            )
-        self.assertContains(response, "Échec d’envoi pour le candidat Dupond Henri (Error sending mail)")
+            self.send_queued_mails()
+        self.assertEqual(mocked.call_count, 3)
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertIn("Échec d’envoi pour le candidat Dupond Henri (Error sending mail)", job.message)
+        self.assertEqual(job.mails.get().attempts, 3)
         henri.refresh_from_db()
         self.assertIsNone(henri.confirmation_date)
 
@@ -297,6 +313,7 @@ Sans nouvelles de votre part 5 jours ouvrables avant la date du premier examen,
             'sender': 'me@example.org',
         })
         self.assertRedirects(response, reverse('admin:candidats_candidate_changelist'))
+        self.send_queued_mails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].recipients(), ['henri@example.org', 'me@example.org'])
         self.assertEqual(mail.outbox[0].subject, "Procédure de qualification")
@@ -350,6 +367,7 @@ tél. 032 886 33 00
 
         data = response.context['form'].initial
         response = self.client.post(reverse('candidate-validation', args=[henri.pk]), data=data)
+        self.send_queued_mails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].recipients(), ["julie@example.org", "jeanne@example.org", 'me@example.org'])
         self.assertEqual(mail.outbox[0].subject, "Validation de l'entretien d'admission")
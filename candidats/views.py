@@ -7,7 +7,6 @@ from django.http import FileResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.template import loader
 from django.urls import reverse, reverse_lazy
-from django.utils import timezone
 from django.utils.text import slugify
 
 from stages.views.base import EmailConfirmationBaseView
@@ -18,19 +17,18 @@ from .pdf import InscriptionSummaryPDF
 class CandidateConfirmationView(EmailConfirmationBaseView):
     person_model = Candidate
     success_url = reverse_lazy('admin:candidats_candidate_changelist')
-    error_message = "Échec d’envoi pour le candidat {person} ({err})"
+    person_description = "le candidat {person}"
     candidate_date_field = None
 
-    def on_success(self, candidate):
-        setattr(candidate, self.candidate_date_field, timezone.now())
-        candidate.save()
+    def sent_target(self, candidate):
+        return candidate, self.candidate_date_field
 
 
 class ConfirmationView(CandidateConfirmationView):
     """
     Email confirming the receipt of the registration form
     """
-    success_message = "Une confirmation d’inscription a été envoyée à {person}"
+    queued_message = "La confirmation d’inscription pour {person} a été placée dans la file d’envoi"
     candidate_date_field = 'confirmation_date'
     title = "Confirmation de réception de dossier"
 
@@ -77,7 +75,7 @@ class ConfirmationView(CandidateConfirmationView):
 
 
 class ValidationView(CandidateConfirmationView):
-    success_message = "Le message de validation a été envoyé pour le candidat {person}"
+    queued_message = "Le message de validation pour le candidat {person} a été placé dans la file d’envoi"
     candidate_date_field = 'validation_date'
     title = "Validation des examens par les enseignant-e-s EDE"
 
@@ -112,7 +110,7 @@ class ValidationView(CandidateConfirmationView):
 
 
 class ConvocationView(CandidateConfirmationView):
-    success_message = "Le message de convocation a été envoyé pour le candidat {person}"
+    queued_message = "Le message de convocation pour le candidat {person} a été placé dans la file d’envoi"
     candidate_date_field = 'convocation_date'
     title = "Convocation aux examens d'admission EDE/EDS/MSP"
 
@@ -1,3 +1,11 @@
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
 from django.urls import reverse
 from django.http import HttpResponseRedirect
 
@@ -10,3 +18,83 @@ class LoginRequiredMiddleware:
         if not request.user.is_authenticated and not "/admin" in request.path_info:
             return HttpResponseRedirect(reverse('admin:index'))
         return self.get_response(request)
+
+
+class RequestStats:
+    """ Rolling in-process store of the last measures of each URL name """
+    def __init__(self, max_samples=100):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+
+    def add(self, url_name, sample):
+        with self._lock:
+            self._samples[url_name].append(sample)
+
+    def summary(self):
+        """Return a list of per URL name aggregates, the most time consuming first."""
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+        result = []
+        for name, values in samples.items():
+            row = {'url_name': name, 'count': len(values)}
+            for key in ('queries', 'sql_time', 'duplicates', 'total_time'):
+                column = [value[key] for value in values]
+                row['avg_' + key] = sum(column) / len(column)
+                row['max_' + key] = max(column)
+            result.append(row)
+        return sorted(result, key=lambda row: row['avg_total_time'] * row['count'], reverse=True)
+
+
+request_stats = RequestStats()
+
+
+class InstrumentationMiddleware:
+    """
+    Measure the number of SQL queries, the SQL time, the number of duplicate
+    queries (same SQL with any parameters) and the total time of each request.
+    Measures are sent in a Server-Timing header and stored in request_stats.
+    Only active when settings.INSTRUMENTATION is True.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = Counter()
+        sql_time = 0
+
+        def wrapper(execute, sql, params, many, context):
+            nonlocal sql_time
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                sql_time += time.perf_counter() - start
+                queries[sql] += 1
+
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(wrapper))
+            response = self.get_response(request)
+        total_time = time.perf_counter() - start
+
+        num_queries = sum(queries.values())
+        duplicates = num_queries - len(queries)
+        match = request.resolver_match
+        request_stats.add(match.view_name if match else '<non résolue>', {
+            'queries': num_queries, 'sql_time': sql_time * 1000,
+            'duplicates': duplicates, 'total_time': total_time * 1000,
+        })
+        response['Server-Timing'] = (
+            'sql;dur=%.1f;desc="%d queries, %d duplicates", total;dur=%.1f' % (
+                sql_time * 1000, num_queries, duplicates, total_time * 1000
+            )
+        )
+        return response
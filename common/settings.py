@@ -54,8 +54,12 @@ MIDDLEWARE = [
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'common.middleware.LoginRequiredMiddleware',
+    'common.middleware.InstrumentationMiddleware',
 ]
 
+# Set to True to measure SQL queries and time of requests (see /instrumentation/)
+INSTRUMENTATION = False
+
 ROOT_URLCONF = 'common.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -143,6 +147,34 @@ INSTRUCTOR_IMPORT_MAPPING = {
 
 CHARGE_SHEET_TITLE = "Feuille de charge pour l'année scolaire 2018-2019"
 
+# Number of processes rendering PDF files of zipped archives (1 to render in the request process)
+PDF_RENDER_PROCESSES = min(os.cpu_count() or 1, 4)
+
+# Cache of generated single PDF documents
+PDF_CACHE_DIR = os.path.join(MEDIA_ROOT, 'pdf_cache')
+PDF_CACHE_MAX_SIZE = 200 * 1024 * 1024  # In bytes (0 to disable)
+
+# Background jobs, run by the run_jobs management command (see INSTALL.txt). Results are stored in MEDIA_ROOT/jobs
+# and deleted after JOB_RETENTION_DAYS. Workers update the heartbeat of running jobs every
+# JOB_HEARTBEAT_INTERVAL seconds; jobs without heartbeat for JOB_TIMEOUT seconds are failed.
+JOB_CONCURRENCY = 2
+JOB_RETENTION_DAYS = 7
+JOB_HEARTBEAT_INTERVAL = 60
+JOB_TIMEOUT = 10 * 60
+
+# Queued e-mail messages (stages.mail), sent by the run_jobs worker which must be running:
+# pause in seconds between two messages of a batch, and number of sending attempts of each
+# message (the job is run again after MAIL_RETRY_DELAY seconds). Users are warned when
+# messages are waiting for more than MAIL_STALE_DELAY seconds (no worker running).
+MAIL_THROTTLE = 0.5
+MAIL_MAX_ATTEMPTS = 3
+MAIL_RETRY_DELAY = 60
+MAIL_STALE_DELAY = 15 * 60
+
+# Days during which availability changes are kept for the attribution page polling;
+# pages loaded earlier reload the whole period.
+AVAILABILITY_CHANGES_RETENTION_DAYS = 2
+
 # Maximum numbers of periods per teacher per year
 MAX_ENS_PERIODS = 1900
 MAX_ENS_FORMATION = 250
@@ -8,6 +8,7 @@ from django.views.static import serve
 
 from candidats import views as candidats_views
 from stages import views
+from stages.views.jobs import background_allowed
 
 urlpatterns = [
     path('', RedirectView.as_view(url='/admin/', permanent=True), name='home'),
@@ -20,10 +21,14 @@ urlpatterns = [
     path('import_hp_contacts/', views.HPContactsImportView.as_view(), name='import-hp-contacts'),
 
     path('attribution/', views.AttributionView.as_view(), name='attribution'),
-    re_path(r'^stages/export/(?P<scope>all)?/?$', views.export.stages_export, name='stages_export'),
+    re_path(r'^stages/export/(?P<scope>all)?/?$',
+        background_allowed("Export des données de pratique professionnelle")(views.export.stages_export),
+        name='stages_export'),
 
     path('institutions/', views.CorporationListView.as_view(), name='corporations'),
     path('institutions/<int:pk>/', views.CorporationView.as_view(), name='corporation'),
+    path('institutions/<int:pk>/availabilities/', views.CorporationAvailabilitiesView.as_view(),
+        name='corporation-avails'),
     path('institutions/merge/', views.CorporationMergeView.as_view(), name='corporations-merge'),
     path('institutions/export/', views.export.institutions_export, name='corporations-export'),
 
@@ -31,7 +36,10 @@ urlpatterns = [
     path('classes/<int:pk>/', views.KlassView.as_view(), name='class'),
     path('classes/<int:pk>/import_reports/', views.ImportReportsView.as_view(),
         name='import-reports'),
-    path('classes/print_klass_list/', views.PrintKlassList.as_view(), name='print-klass-list'),
+    path('classes/<int:pk>/send_reports/sem/<int:semestre>/', views.SendKlassReportsView.as_view(),
+        name='send-klass-reports'),
+    path('classes/print_klass_list/',
+        background_allowed("Rôles de classes")(views.PrintKlassList.as_view()), name='print-klass-list'),
     path('student/<int:pk>/comment/', views.StudentCommentView.as_view(), name='student-comment'),
 
     path('candidate/<int:pk>/send_convocation/', candidats_views.ConvocationView.as_view(),
@@ -64,9 +72,15 @@ urlpatterns = [
 
     path('student/export_qualif/', views.export.export_qualification, name='export-qualif'),
 
-    path('imputations/export/', views.export.imputations_export, name='imputations_export'),
-    path('print/update_form/', views.PrintUpdateForm.as_view(), name='print_update_form'),
-    path('print/charge_sheet/', views.PrintChargeSheet.as_view(), name='print-charge-sheet'),
+    path('imputations/export/',
+        background_allowed("Export des données comptables")(views.export.imputations_export),
+        name='imputations_export'),
+    path('print/update_form/',
+        background_allowed("Formulaires de mise à jour")(views.PrintUpdateForm.as_view()),
+        name='print_update_form'),
+    path('print/charge_sheet/',
+        background_allowed("Feuilles de charge")(views.PrintChargeSheet.as_view()),
+        name='print-charge-sheet'),
     path('general_export/', views.export.general_export, name='general-export'),
     path('ortra_export/', views.export.ortra_export, name='ortra-export'),
 
@@ -75,10 +89,13 @@ urlpatterns = [
     path('section/<int:pk>/classes/', views.section_classes, name='section_classes'),
     path('period/<int:pk>/students/', views.period_students, name='period_students'),
     path('period/<int:pk>/corporations/', views.period_availabilities, name='period_availabilities'),
+    path('period/<int:pk>/bootstrap/', views.period_bootstrap, name='period_bootstrap'),
+    path('period/<int:pk>/changes/', views.period_changes, name='period_changes'),
     # Training params in POST:
     path('training/new/', views.new_training, name="new_training"),
     path('training/del/', views.del_training, name="del_training"),
     path('training/by_period/<int:pk>/', views.TrainingsByPeriodView.as_view()),
+    path('training/referent_counts/', views.referent_counts, name='referent_counts'),
 
     path('student/<int:pk>/summary/', views.StudentSummaryView.as_view()),
     path('student/<int:pk>/send_reports/sem/<int:semestre>/', views.SendStudentReportsView.as_view(),
@@ -86,6 +103,13 @@ urlpatterns = [
     path('availability/<int:pk>/summary/', views.AvailabilitySummaryView.as_view()),
     path('corporation/<int:pk>/contacts/', views.CorpContactJSONView.as_view()),
 
+    path('jobs/', views.jobs.JobListView.as_view(), name='jobs'),
+    path('jobs/<int:pk>/', views.jobs.JobView.as_view(), name='job'),
+    path('jobs/<int:pk>/status/', views.jobs.job_status, name='job-status'),
+    path('jobs/<int:pk>/download/', views.jobs.job_download, name='job-download'),
+
+    path('instrumentation/', views.InstrumentationView.as_view(), name='instrumentation'),
+
     path('summernote/', include('django_summernote.urls')),
     # Serve bulletins by Django to allow LoginRequiredMiddleware to apply
     path('media/bulletins/<path:path>', serve,
@@ -30,6 +30,15 @@ def print_charge_sheet(modeladmin, request, queryset):
 print_charge_sheet.short_description = "Imprimer les feuilles de charge"
 
 
+def print_charge_sheet_background(modeladmin, request, queryset):
+    return HttpResponseRedirect(
+        reverse('print-charge-sheet') + '?background=1&ids=%s' % ",".join(
+            request.POST.getlist(ACTION_CHECKBOX_NAME)
+        )
+    )
+print_charge_sheet_background.short_description = "Imprimer les feuilles de charge (en arrière-plan)"
+
+
 class ArchivedListFilter(admin.BooleanFieldListFilter):
     """
     Default filter that shows by default unarchived elements.
@@ -103,7 +112,7 @@ class TeacherAdmin(admin.ModelAdmin):
               ('previous_report', 'next_report', 'total_logbook'),
               ('user'))
     readonly_fields = ('total_logbook',)
-    actions = [print_charge_sheet]
+    actions = [print_charge_sheet, print_charge_sheet_background]
     inlines = [LogBookInline]
 
 
@@ -309,7 +318,7 @@ class CorpContactAdmin(admin.ModelAdmin):
 
         export = OpenXMLExport('Exportation')
         export.write_line(export_fields.keys(), bold=True)
-        for corp in queryset.values_list(*export_fields.values()):
+        for corp in queryset.values_list(*export_fields.values()).iterator():
             values = []
             for value, field_name in zip(corp, export_fields.values()):
                 if field_name in ['is_main', 'always_cc']:
@@ -376,7 +385,7 @@ class CorporationAdmin(admin.ModelAdmin):
             export_fields.keys(), bold=True,
             col_widths=[dict(fields)[f] for f in export_fields.values()]
         )
-        for corp in queryset.values_list(*export_fields.values()):
+        for corp in queryset.values_list(*export_fields.values()).iterator():
             values = []
             for value, field_name in zip(corp, export_fields.values()):
                 if field_name in ('archived', 'accred'):
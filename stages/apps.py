@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class StagesConfig(AppConfig):
     name = 'stages'
     verbose_name = 'Pratique professionnelle'
+
+    def ready(self):
+        # Register the mail job runner
+        from . import mail  # noqa
@@ -13,6 +13,7 @@ from .models import Corporation, Period, Section, Student, StudentFile
 
 class StudentImportForm(forms.Form):
     upload = forms.FileField()
+    background = forms.BooleanField(label="Importer en arrière-plan", required=False)
 
     def __init__(self, file_label='Fichier', mandatory_headers=None, **kwargs):
         super().__init__(**kwargs)
@@ -44,6 +45,7 @@ class PeriodForm(forms.Form):
 
 class UploadHPFileForm(forms.Form):
     upload = forms.FileField(label='Fichier HyperPlanning')
+    background = forms.BooleanField(label="Importer en arrière-plan", required=False)
 
 
 class UploadReportForm(forms.Form):
@@ -60,6 +62,12 @@ class EmailBaseForm(forms.Form):
 
 
 
+class KlassReportsForm(forms.Form):
+    sender = forms.CharField(widget=forms.HiddenInput())
+    cci = forms.CharField(required=False, widget=forms.TextInput(attrs={'size': '60'}))
+    subject = forms.CharField(widget=forms.TextInput(attrs={'size': '60'}))
+
+
 class CorpAutocompleteSelect(AutocompleteSelect):
     model = Corporation
 
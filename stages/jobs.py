@@ -0,0 +1,206 @@
+"""
+Database-backed queue of background jobs. Jobs are created with `enqueue` and
+executed by the run_jobs management command, so that long exports, PDF archives
+and imports do not tie up a web worker.
+"""
+import re
+import tempfile
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.messages.storage.base import BaseStorage
+from django.core.files import File
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.http import HttpRequest, QueryDict
+from django.urls import resolve
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+# Job kind: callable receiving the job
+JOB_RUNNERS = {}
+
+
+class JobError(Exception):
+    """Error ending a job with a message for the user (without traceback)."""
+
+
+class JobRetry(Exception):
+    """Raised by a runner so that the job is run again after `delay` seconds."""
+    def __init__(self, delay, message=''):
+        super().__init__(message)
+        self.delay = delay
+
+
+def register(kind):
+    """Decorator registering a runner function for jobs of `kind`."""
+    def decorator(func):
+        JOB_RUNNERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, title, user=None, upload=None, **params):
+    """Create a pending job. `upload` is an optional file to store with the job."""
+    with transaction.atomic():
+        job = Job.objects.create(kind=kind, title=title, user=user, params=params)
+        if upload is not None:
+            # The file path depends on the job pk
+            job.upload.save(upload.name, upload)
+    return job
+
+
+def claim_job():
+    """
+    Mark the oldest pending job as running and return it (None if there is no
+    pending job). The conditional update prevents two workers from claiming
+    the same job.
+    """
+    now = timezone.now()
+    pending = Job.objects.filter(
+        Q(run_after__isnull=True) | Q(run_after__lte=now), status=Job.STATUS_PENDING
+    ).order_by('created', 'pk')
+    for pk in pending.values_list('pk', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=pk, status=Job.STATUS_PENDING).update(
+            status=Job.STATUS_RUNNING, started=now, heartbeat=now
+        )
+        if claimed:
+            return Job.objects.select_related('user').get(pk=pk)
+    return None
+
+
+class Heartbeat(threading.Thread):
+    """
+    Thread updating the heartbeat of a running job every
+    settings.JOB_HEARTBEAT_INTERVAL seconds, so that cleanup_jobs can tell
+    interrupted jobs from long ones.
+    """
+    def __init__(self, job):
+        super().__init__(daemon=True)
+        self.job_pk = job.pk
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.JOB_HEARTBEAT_INTERVAL):
+                Job.objects.filter(pk=self.job_pk, status=Job.STATUS_RUNNING).update(heartbeat=timezone.now())
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(job):
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        runner = JOB_RUNNERS[job.kind]
+    except KeyError:
+        job.status, job.message = Job.STATUS_FAILED, "Type de tâche inconnu : %s" % job.kind
+    else:
+        try:
+            runner(job)
+        except JobError as err:
+            job.status, job.message = Job.STATUS_FAILED, str(err)
+        except JobRetry as retry:
+            job.status, job.message = Job.STATUS_PENDING, str(retry)
+            job.run_after = timezone.now() + timedelta(seconds=retry.delay)
+        except Exception as err:
+            traceback.print_exc()
+            job.status, job.message = Job.STATUS_FAILED, "La tâche a échoué. Erreur: %s" % err
+        else:
+            job.status = Job.STATUS_DONE
+    finally:
+        heartbeat.stop()
+    job.finished = None if job.status == Job.STATUS_PENDING else timezone.now()
+    # The job may have been marked as interrupted by cleanup_jobs in the meantime
+    updated = Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING).update(
+        status=job.status, message=job.message, finished=job.finished, result=job.result.name or '',
+        run_after=job.run_after,
+    )
+    if not updated and job.result:
+        job.result.delete(save=False)
+
+
+def cleanup_jobs():
+    """
+    Delete finished jobs (and their files) older than settings.JOB_RETENTION_DAYS,
+    and mark as failed running jobs without heartbeat for more than
+    settings.JOB_TIMEOUT seconds (interrupted worker).
+    """
+    now = timezone.now()
+    Job.objects.annotate(last_seen=Coalesce('heartbeat', 'started')).filter(
+        status=Job.STATUS_RUNNING, last_seen__lt=now - timedelta(seconds=settings.JOB_TIMEOUT)
+    ).update(status=Job.STATUS_FAILED, finished=now, message="La tâche a été interrompue.")
+    expired = Job.objects.filter(
+        status__in=(Job.STATUS_DONE, Job.STATUS_FAILED),
+        finished__lt=now - timedelta(days=settings.JOB_RETENTION_DAYS),
+    )
+    for job in expired:
+        job.delete_files()
+    return expired.delete()[0]
+
+
+class JobMessageStorage(BaseStorage):
+    """Messages storage keeping messages added by a view run as a job."""
+    def _get(self, *args, **kwargs):
+        return [], True
+
+    def _store(self, messages, response, *args, **kwargs):
+        return []
+
+
+def _response_filename(response):
+    match = re.search(r'filename="?([^";]+)"?', response.get('Content-Disposition', ''))
+    return match.group(1) if match else 'resultat'
+
+
+@register('view')
+def run_view(job):
+    """
+    Run the GET view at job.params['path'] and store its response content as
+    the job result.
+    """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = job.params['path']
+    request.GET = QueryDict(job.params.get('query', ''))
+    if job.user is None:
+        # Views may need the user (permissions, e-mail address)
+        raise JobError("Cette tâche n'a pas d'utilisateur (compte supprimé ?).")
+    request.user = job.user
+    request._messages = JobMessageStorage(request)
+    match = resolve(request.path_info)
+    if not getattr(match.func, 'background_allowed', False):
+        raise JobError("Cette page ne peut pas être générée en arrière-plan.")
+    response = match.func(request, *match.args, **match.kwargs)
+    if response.status_code != 200:
+        raise JobError("\n".join(str(msg) for msg in request._messages) or (
+            "La génération a échoué (code %d)." % response.status_code
+        ))
+    with tempfile.TemporaryFile() as fh:
+        try:
+            for chunk in (response.streaming_content if response.streaming else [response.content]):
+                fh.write(chunk)
+        finally:
+            response.close()
+        fh.seek(0)
+        job.result.save(_response_filename(response), File(fh), save=False)
+    job.message = "\n".join(str(msg) for msg in request._messages)
+
+
+@register('import')
+def run_import(job):
+    """Import the job uploaded file with the ImportViewBase subclass job.params['view']."""
+    view = import_string(job.params['view'])()
+    imp_file = view.open_file(job.upload.path, job.params.get('is_csv', False))
+    with transaction.atomic():
+        stats = view.import_data(imp_file)
+    job.message = "\n".join(msg for _, msg in view.stats_messages(stats))
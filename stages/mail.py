@@ -0,0 +1,125 @@
+"""
+Queued e-mail dispatch: messages are stored as QueuedMail objects and sent by
+a background job over a single SMTP connection per batch.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .jobs import JobError, JobRetry, enqueue, register
+from .models import Job, QueuedMail
+
+
+def mail_from_form(data, target=None, sent_field='', description='', **kwargs):
+    """Return an unsaved QueuedMail from the cleaned data of an EmailBaseForm."""
+    return QueuedMail(
+        subject=data['subject'], body=data['message'], from_email=data['sender'],
+        to=data['to'], bcc=data['cci'], target=target, sent_field=sent_field,
+        description=description or (str(target) if target is not None else ''), **kwargs
+    )
+
+
+def queue_mails(mails, title, user=None):
+    """Save `mails` (unsaved QueuedMail instances) and return the job sending them."""
+    with transaction.atomic():
+        job = enqueue('mail', title, user=user)
+        for mail in mails:
+            mail.job = job
+        QueuedMail.objects.bulk_create(mails)
+    return job
+
+
+def _connection_failed(mails, err):
+    """Count a failed attempt for `mails` which could not be sent (no connection)."""
+    QueuedMail.objects.filter(pk__in=[mail.pk for mail in mails]).update(
+        attempts=F('attempts') + 1, error="Connexion au serveur impossible : %s" % err
+    )
+
+
+def send_mails(mails):
+    """
+    Send `mails` over a single connection, pausing settings.MAIL_THROTTLE
+    seconds between messages. Return the number of sent messages.
+    """
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as err:
+        _connection_failed(mails, err)
+        return 0
+    sent = 0
+    try:
+        for idx, mail in enumerate(mails):
+            if idx and settings.MAIL_THROTTLE:
+                time.sleep(settings.MAIL_THROTTLE)
+            mail.attempts += 1
+            try:
+                connection.send_messages([mail.email_message()])
+            except Exception as err:
+                mail.error = str(err)
+                mail.save(update_fields=['attempts', 'error'])
+                # The connection may be unusable after an error
+                connection.close()
+                try:
+                    connection.open()
+                except Exception as err:
+                    _connection_failed(mails[idx + 1:], err)
+                    break
+            else:
+                mail.mark_sent()
+                sent += 1
+    finally:
+        connection.close()
+    return sent
+
+
+@register('mail')
+def run_mail_job(job):
+    """
+    Send the job pending mails. The job is run again after settings.MAIL_RETRY_DELAY
+    seconds while some mails failed less than settings.MAIL_MAX_ATTEMPTS times.
+    """
+    pending = job.mails.filter(status=QueuedMail.STATUS_PENDING).order_by('pk')
+    mails = list(pending)
+    if mails:
+        send_mails(mails)
+    pending.filter(attempts__gte=settings.MAIL_MAX_ATTEMPTS).update(status=QueuedMail.STATUS_FAILED)
+
+    statuses = list(job.mails.values_list('status', flat=True))
+    num_sent = statuses.count(QueuedMail.STATUS_SENT)
+    num_pending = statuses.count(QueuedMail.STATUS_PENDING)
+    summary = "Courriels envoyés : %d sur %d" % (num_sent, len(statuses))
+    if num_pending:
+        raise JobRetry(settings.MAIL_RETRY_DELAY, "%s\nNouvel essai d’envoi pour %d courriel(s) dans %d secondes" % (
+            summary, num_pending, settings.MAIL_RETRY_DELAY
+        ))
+    lines = [summary] + [
+        "Échec d’envoi pour {0} ({1})".format(mail.description or mail.to, mail.error)
+        for mail in job.mails.filter(status=QueuedMail.STATUS_FAILED).order_by('pk')
+    ]
+    if statuses and not num_sent:
+        raise JobError("\n".join(lines))
+    job.message = "\n".join(lines)
+
+
+def warn_unsent_mails(request):
+    """
+    Warn the user when queued mails are waiting for more than settings.MAIL_STALE_DELAY
+    seconds, which means that no run_jobs worker is running.
+    """
+    limit = timezone.now() - timedelta(seconds=settings.MAIL_STALE_DELAY)
+    stale = QueuedMail.objects.filter(
+        Q(job__run_after__isnull=True) | Q(job__run_after__lt=limit),
+        status=QueuedMail.STATUS_PENDING, job__status=Job.STATUS_PENDING, job__created__lt=limit,
+    )
+    if stale.exists():
+        messages.warning(request, (
+            "Des courriels attendent d’être envoyés depuis plus de %d minutes. Le service d’envoi "
+            "(commande run_jobs) ne semble pas fonctionner, veuillez contacter l’administrateur."
+        ) % (settings.MAIL_STALE_DELAY // 60))
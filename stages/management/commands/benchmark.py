@@ -0,0 +1,158 @@
+import csv
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from openpyxl import Workbook
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from stages.models import Course, Klass, Period, Student, Teacher
+from stages.views.imports import StudentImportView
+
+
+def write_students_file(path, students=None):
+    """
+    Write a CLOEE-like xlsx file (StudentImportView) with `students` (current
+    students by default).
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    headers = list(StudentImportView.student_mapping) + list(StudentImportView.corporation_mapping)
+    ws.append(headers)
+    if students is None:
+        students = Student.objects.filter(archived=False)
+    students = students.filter(ext_id__isnull=False, klass__isnull=False).select_related(
+        'klass__teacher', 'corporation'
+    )
+    for st in students.iterator():
+        corp = st.corporation
+        ws.append([
+            st.ext_id, st.last_name, st.first_name, st.street, '%s %s' % (st.pcode, st.city), st.district,
+            st.tel, st.mobile, st.email, st.login_rpn,
+            st.birth_date.strftime('%d.%m.%Y') if st.birth_date else '', st.avs, st.gender, st.klass.name,
+            str(st.klass.teacher) if st.klass.teacher else '', '',
+        ] + ([
+            corp.ext_id or corp.pk, corp.name, corp.street, corp.pcode, corp.city, corp.tel, corp.district,
+        ] if corp else [''] * len(StudentImportView.corporation_mapping)))
+    wb.save(path)
+
+
+def write_hp_file(path):
+    """Write a HyperPlanning-like CSV file (HPImportView) with current courses."""
+    with open(path, 'w', newline='', encoding='utf-8') as fh:
+        writer = csv.writer(fh, delimiter=';')
+        writer.writerow(['NOMPERSO_ENS', 'UID_ENS', 'LIBELLE_MAT', 'NOMPERSO_DIP', 'TOTAL'])
+        for course in Course.objects.select_related('teacher').iterator():
+            # Split course periods on two lines, like HyperPlanning does for semesters
+            for period in (course.period // 2, course.period - course.period // 2):
+                writer.writerow([str(course.teacher), '', course.subject, course.public, '%.2f' % period])
+
+
+class Command(BaseCommand):
+    help = (
+        "Mesure le temps et le nombre de requêtes SQL des principales vues sur la base de données "
+        "courante (voir generate_data). Toutes les modifications sont annulées. Résultats au format JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help="Nombre de mesures par vue")
+        parser.add_argument('--only', nargs='*', help="Noms des mesures à exécuter")
+        parser.add_argument('--output', help="Fichier de résultats JSON (sortie standard par défaut)")
+
+    def benchmarks(self, temp_dir):
+        period = Period.objects.filter(availability__isnull=False).order_by('-start_date').first()
+        teacher_ids = ','.join(str(pk) for pk in Teacher.objects.filter(archived=False).values_list('pk', flat=True))
+        students_path = os.path.join(temp_dir, 'students.xlsx')
+        write_students_file(students_path)
+        hp_path = os.path.join(temp_dir, 'HYPERPLANNING.csv')
+        write_hp_file(hp_path)
+
+        def upload(url_name, path):
+            def post():
+                with open(path, 'rb') as fh:
+                    return self.client.post(reverse(url_name), {'upload': fh})
+            return post
+
+        benchs = [
+            ('stages_export', lambda: self.client.get(reverse('stages_export', args=['all']))),
+            ('general_export', lambda: self.client.get(reverse('general-export'))),
+            ('imputations_export', lambda: self.client.get(reverse('imputations_export'))),
+            ('print_klass_list', lambda: self.client.get(reverse('print-klass-list'))),
+            ('print_charge_sheet', lambda: self.client.get(reverse('print-charge-sheet'), {'ids': teacher_ids})),
+            ('import_students', upload('import-students', students_path)),
+            ('import_hp', upload('import-hp', hp_path)),
+        ]
+        if period is not None:
+            benchs += [
+                (name, lambda name=name: self.client.get(reverse(name, args=[period.pk])))
+                for name in ('period_students', 'period_availabilities', 'period_bootstrap')
+            ]
+        return benchs
+
+    def measure(self, func, repeat):
+        times, queries = [], []
+        for _ in range(repeat):
+            # Each run is rolled back so that it starts with the same data
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    response = func()
+                    size = len(b''.join(response.streaming_content) if response.streaming else response.content)
+                    times.append((time.perf_counter() - start) * 1000)
+                queries.append(len(ctx.captured_queries))
+                transaction.set_rollback(True)
+        return {
+            'status': response.status_code,
+            'size': size,
+            'queries': queries[-1],
+            'times_ms': [round(t, 2) for t in times],
+            'median_ms': round(statistics.median(times), 2),
+        }
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat doit être au moins 1")
+        setup_test_environment()
+        results = []
+        try:
+            with transaction.atomic(), tempfile.TemporaryDirectory() as temp_dir:
+                user = User.objects.create_superuser('benchmark-%d' % time.time(), 'bench@example.org', None)
+                self.client = Client()
+                self.client.force_login(user)
+                for name, func in self.benchmarks(temp_dir):
+                    if options['only'] and name not in options['only']:
+                        continue
+                    self.stderr.write("Mesure de %s…" % name)
+                    results.append({'name': name, **self.measure(func, options['repeat'])})
+                transaction.set_rollback(True)
+        finally:
+            teardown_test_environment()
+
+        output = json.dumps({
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'dataset': {
+                'students': Student.objects.count(), 'klasses': Klass.objects.count(),
+                'teachers': Teacher.objects.count(), 'courses': Course.objects.count(),
+                'periods': Period.objects.count(),
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,189 @@
+import random
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from candidats.models import Candidate
+from stages.models import (
+    IMPUTATION_CHOICES, Availability, CorpContact, Corporation, Course, Domain, ExamEDESession,
+    Examination, Klass, Level, Period, ReferentLoad, Section, Student, Teacher, Training,
+)
+from stages.utils import school_year_start
+
+FIRST_NAMES = [
+    'Albin', 'Justine', 'Elvire', 'André', 'Gil', 'Léa', 'Noé', 'Chloé', 'Mathis', 'Inès',
+    'Hugo', 'Zoé', 'Louis', 'Jade', 'Nathan', 'Emma', 'Théo', 'Lina', 'Jules', 'Sarah',
+]
+LAST_NAMES = [
+    'Dupond', 'Varrin', 'Hickx', 'Allemand', 'Schmid', 'Perret', 'Jacot', 'Robert', 'Matthey',
+    'Huguenin', 'Vuille', 'Jeanneret', 'Favre', 'Girard', 'Monnier', 'Droz', 'Sandoz', 'Calame',
+]
+CITIES = [
+    ('2000', 'Neuchâtel'), ('2300', 'La Chaux-de-Fonds'), ('2400', 'Le Locle'), ('2053', 'Cernier'),
+    ('2074', 'Marin-Epagnier'), ('2108', 'Couvet'), ('2520', 'La Neuveville'), ('2800', 'Delémont'),
+]
+# Section name: (has_stages, klass name suffix)
+SECTIONS = {
+    'ASE': (False, 'ASEFE'), 'ASSC': (False, 'ASSCFE'), 'EDE': (False, 'EDEpe'), 'EDS': (False, 'EDS'),
+    'MP_ASE': (True, 'MPTS ASE'), 'MP_ASSC': (True, 'MPS ASSC'),
+}
+DOMAINS = ['handicap', 'petite enfance', 'personnes âgées', 'hôpital', 'psychiatrie']
+
+
+class Command(BaseCommand):
+    help = "Génère un jeu de données fictif pour mesurer les performances (ne pas utiliser en production !)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=500)
+        parser.add_argument('--teachers', type=int, default=40)
+        parser.add_argument('--corporations', type=int, default=100)
+        parser.add_argument('--contacts', type=int, default=3, help="Contacts par institution")
+        parser.add_argument('--periods', type=int, default=4, help="Périodes par filière avec PP")
+        parser.add_argument('--availabilities', type=int, default=30, help="Disponibilités par période")
+        parser.add_argument('--trainings', type=float, default=0.7,
+                            help="Proportion des disponibilités attribuées")
+        parser.add_argument('--courses', type=int, default=10, help="Cours par enseignant")
+        parser.add_argument('--candidates', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rand = random.Random(options['seed'])
+        with transaction.atomic():
+            counts = self.generate(options)
+        self.stdout.write("Objets créés : %s" % ", ".join('%s: %d' % item for item in counts.items()))
+
+    def name(self):
+        return self.rand.choice(FIRST_NAMES), self.rand.choice(LAST_NAMES)
+
+    def generate(self, opts):
+        rand = self.rand
+        levels = [Level.objects.get_or_create(name=str(num))[0] for num in (1, 2, 3)]
+        sections = {
+            name: Section.objects.get_or_create(name=name, defaults={'has_stages': has_stages})[0]
+            for name, (has_stages, _) in SECTIONS.items()
+        }
+        domains = [Domain.objects.get_or_create(name=name)[0] for name in DOMAINS]
+
+        teachers = Teacher.objects.bulk_create([
+            Teacher(
+                civility=rand.choice(['Madame', 'Monsieur']), first_name=first, last_name='%s%d' % (last, idx),
+                abrev='T%d' % idx, contract='CDI', rate=rand.choice([50, 80, 100]),
+            ) for idx, (first, last) in enumerate(self.name() for _ in range(opts['teachers']))
+        ])
+
+        klasses = []
+        for sect_name, (_, suffix) in SECTIONS.items():
+            for level in levels:
+                klass_name = '%s%s%s' % (level.name, suffix, rand.choice('abcdefghij'))
+                klass, _ = Klass.objects.get_or_create(
+                    name=klass_name[:10], defaults={'section': sections[sect_name], 'level': level}
+                )
+                klasses.append(klass)
+
+        # Offset to keep (name, city) unique when generating several times
+        offset = Corporation.objects.count()
+        corporations = Corporation.objects.bulk_create([
+            Corporation(
+                name='Institution %s %d' % (rand.choice(LAST_NAMES), offset + idx), typ='Institution',
+                ext_id=100000 + offset + idx,
+                street='Rue des champs %d' % idx, pcode=pcode, city=city, district='NE',
+            ) for idx, (pcode, city) in enumerate(rand.choice(CITIES) for _ in range(opts['corporations']))
+        ])
+        contacts = CorpContact.objects.bulk_create([
+            CorpContact(
+                corporation=corp, civility=rand.choice(['Madame', 'Monsieur']), first_name=first,
+                last_name=last, is_main=(num == 0), email='%s.%s@example.org' % (first, last),
+            )
+            for corp in corporations for num, (first, last) in
+            enumerate(self.name() for _ in range(opts['contacts']))
+        ])
+
+        first_ext_id = (Student.objects.aggregate(Max('ext_id'))['ext_id__max'] or 0) + 1
+        students = Student.objects.bulk_create([
+            Student(
+                ext_id=first_ext_id + idx, first_name=first, last_name=last,
+                gender=rand.choice('MF'), birth_date=date(2000, 1, 1) + timedelta(days=rand.randint(0, 3000)),
+                pcode=pcode, city=city, district='NE', email='%s%d@example.org' % (first.lower(), idx),
+                klass=rand.choice(klasses), corporation=rand.choice(corporations),
+                instructor=rand.choice(contacts) if contacts else None,
+            ) for idx, ((first, last), (pcode, city)) in enumerate(
+                (self.name(), rand.choice(CITIES)) for _ in range(opts['students'])
+            )
+        ])
+
+        # Periods of the current school year for sections planning trainings
+        periods = []
+        year_start = school_year_start()
+        for section in (s for s in sections.values() if s.has_stages):
+            for num in range(opts['periods']):
+                start = year_start + timedelta(weeks=4 + num * 6)
+                periods.append(Period(
+                    title='Stage %d' % (num + 1), section=section, level=levels[num % 2],
+                    start_date=start, end_date=start + timedelta(weeks=rand.randint(1, 6)),
+                ))
+        periods = Period.objects.bulk_create(periods)
+        availabilities = Availability.objects.bulk_create([
+            Availability(
+                corporation=rand.choice(corporations), period=period, domain=rand.choice(domains),
+                priority=rand.random() < 0.1,
+            ) for period in periods for _ in range(opts['availabilities'])
+        ])
+
+        trainings = []
+        for period in periods:
+            candidates = [
+                st for st in students
+                if st.klass.section_id == period.section_id and st.klass.level_id == period.level_id
+            ]
+            rand.shuffle(candidates)
+            avails = [av for av in availabilities if av.period_id == period.pk]
+            for avail, student in zip(avails[:int(len(avails) * opts['trainings'])], candidates):
+                trainings.append(Training(availability=avail, student=student, referent=rand.choice(teachers)))
+        Training.objects.bulk_create(trainings)
+        # Bulk creations do not send signals
+        students_by_avail = {tr.availability_id: tr.student_id for tr in trainings}
+        for period in periods:
+            period.log_changes([
+                (av.pk, students_by_avail.get(av.pk)) for av in availabilities if av.period_id == period.pk
+            ])
+        ReferentLoad.rebuild()
+
+        imputations = [key for key, _ in IMPUTATION_CHOICES]
+        courses = Course.objects.bulk_create([
+            Course(
+                teacher=teacher, public=rand.choice(klasses).name, subject='Cours %d' % num,
+                period=rand.randint(10, 200), imputation=rand.choice(imputations),
+            ) for teacher in teachers for num in range(opts['courses'])
+        ])
+
+        # Qualification examinations for last year EDE/EDS students
+        session, _ = ExamEDESession.objects.get_or_create(year=year_start.year + 1, season='juin')
+        examinations = Examination.objects.bulk_create([
+            Examination(
+                student=student, session=session, type_exam=type_exam, room='A%d' % rand.randint(1, 20),
+                internal_expert=rand.choice(teachers), external_expert=rand.choice(contacts) if contacts else None,
+            )
+            for student in students
+            if student.klass.level_id == levels[2].pk and student.klass.section_id in (
+                sections['EDE'].pk, sections['EDS'].pk
+            )
+            for type_exam in ('exam', 'entr')
+        ])
+
+        candidates = Candidate.objects.bulk_create([
+            Candidate(
+                first_name=first, last_name=last, gender=rand.choice('MF'), pcode=pcode, city=city,
+                section=rand.choice(['ASE', 'ASSC', 'EDE', 'EDS']), deposite_date=date.today(),
+                corporation=rand.choice(corporations),
+            ) for (first, last), (pcode, city) in (
+                (self.name(), rand.choice(CITIES)) for _ in range(opts['candidates'])
+            )
+        ])
+        return {
+            'teachers': len(teachers), 'klasses': len(klasses), 'corporations': len(corporations),
+            'contacts': len(contacts), 'students': len(students), 'periods': len(periods),
+            'availabilities': len(availabilities), 'trainings': len(trainings), 'courses': len(courses),
+            'examinations': len(examinations), 'candidates': len(candidates),
+        }
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from stages.models import ReferentLoad
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcule le nombre de stages suivis par référent et par année scolaire, "
+        "par exemple après des modifications en masse des stages."
+    )
+
+    def handle(self, *args, **options):
+        num = ReferentLoad.rebuild()
+        self.stdout.write("Compteurs de référents recalculés : %d" % num)
@@ -0,0 +1,66 @@
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from stages.jobs import claim_job, cleanup_jobs, run_job
+from stages.models import AvailabilityChange, ReferentLoad
+
+CLEANUP_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = (
+        "Exécute les tâches en arrière-plan en attente (exports, archives PDF, importations) "
+        "et supprime les résultats expirés (réglage JOB_RETENTION_DAYS) ainsi que l'ancien journal "
+        "des disponibilités (réglage AVAILABILITY_CHANGES_RETENTION_DAYS), et recalcule les "
+        "compteurs de stages par référent."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.JOB_CONCURRENCY,
+                            help="Nombre de tâches exécutées en parallèle")
+        parser.add_argument('--once', action='store_true',
+                            help="Quitter dès qu'il n'y a plus de tâche en attente")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Secondes d'attente lorsqu'il n'y a pas de tâche en attente")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency doit être au moins 1")
+        if options['concurrency'] == 1:
+            self.work(options['once'], options['interval'])
+            return
+        # Forked workers must not share the database connection of this process.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        # Not daemonic, so that workers can use processes to render PDF files.
+        workers = [
+            context.Process(target=self.work, args=(options['once'], options['interval']))
+            for _ in range(options['concurrency'])
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, once, interval):
+        last_cleanup = None
+        while True:
+            close_old_connections()
+            if last_cleanup is None or time.monotonic() - last_cleanup > CLEANUP_INTERVAL:
+                cleanup_jobs()
+                AvailabilityChange.prune()
+                ReferentLoad.rebuild()
+                last_cleanup = time.monotonic()
+            job = claim_job()
+            if job is None:
+                if once:
+                    return
+                time.sleep(interval)
+                continue
+            self.stdout.write("Exécution de la tâche %d (%s)…" % (job.pk, job.title))
+            run_job(job)
+            self.stdout.write("Tâche %d : %s" % (job.pk, job.get_status_display()))
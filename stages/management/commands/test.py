@@ -1,10 +1,15 @@
+import tempfile
+
 from django.core.management.commands.test import Command as TestCommand
 from django.test.utils import override_settings
 
 
 class Command(TestCommand):
     def handle(self, *args, **options):
-        with override_settings(
+        with tempfile.TemporaryDirectory() as pdf_cache_dir, override_settings(
             PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+            PDF_CACHE_DIR=pdf_cache_dir,
+            MAIL_THROTTLE=0,
+            MAIL_RETRY_DELAY=0,
         ):
             return super().handle(*args, **options)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0038_corporation_accred_and_remarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='period',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
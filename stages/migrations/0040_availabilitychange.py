@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0039_period_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvailabilityChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('availability_id', models.IntegerField()),
+                ('student_id', models.IntegerField(null=True)),
+                ('period', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stages.period')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'version'], name='stages_avai_period__23465b_idx')],
+            },
+        ),
+    ]
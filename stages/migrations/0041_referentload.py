@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:26
+
+import django.db.models.deletion
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def populate_loads(apps, schema_editor):
+    Training = apps.get_model('stages', 'Training')
+    ReferentLoad = apps.get_model('stages', 'ReferentLoad')
+    counts = Counter()
+    for referent_id, end_date in Training.objects.filter(referent__isnull=False).values_list(
+            'referent_id', 'availability__period__end_date'):
+        year = end_date.year if end_date.month >= 8 else end_date.year - 1
+        counts[(referent_id, year)] += 1
+    ReferentLoad.objects.bulk_create([
+        ReferentLoad(teacher_id=teacher_id, year=year, num_refs=num)
+        for (teacher_id, year), num in counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0040_availabilitychange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferentLoad',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('num_refs', models.PositiveIntegerField(default=0)),
+                ('teacher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stages.teacher')),
+            ],
+            options={
+                'unique_together': {('teacher', 'year')},
+            },
+        ),
+        migrations.RunPython(populate_loads, migrations.RunPython.noop),
+    ]
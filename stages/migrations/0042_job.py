@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:45
+
+import django.db.models.deletion
+import stages.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0041_referentload'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20, verbose_name='Type')),
+                ('title', models.CharField(max_length=200, verbose_name='Titre')),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('running', 'En cours'), ('done', 'Terminé'), ('failed', 'Échec')], default='pending', max_length=10, verbose_name='Statut')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Création')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Début')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Fin')),
+                ('upload', models.FileField(blank=True, upload_to=stages.models.job_file_path)),
+                ('result', models.FileField(blank=True, upload_to=stages.models.job_file_path, verbose_name='Résultat')),
+                ('message', models.TextField(blank=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Utilisateur')),
+            ],
+            options={
+                'verbose_name': 'Tâche en arrière-plan',
+                'verbose_name_plural': 'Tâches en arrière-plan',
+                'ordering': ('-created',),
+                'indexes': [models.Index(fields=['status', 'created'], name='stages_job_status_bcb10b_idx')],
+            },
+        ),
+    ]
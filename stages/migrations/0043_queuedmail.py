@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('stages', '0042_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('description', models.CharField(blank=True, max_length=200)),
+                ('subject', models.CharField(max_length=255, verbose_name='Sujet')),
+                ('body', models.TextField(verbose_name='Message')),
+                ('from_email', models.CharField(max_length=254, verbose_name='Expéditeur')),
+                ('to', models.TextField(verbose_name='Destinataires')),
+                ('bcc', models.TextField(blank=True, verbose_name='Copie cachée')),
+                ('attachment', models.FileField(blank=True, upload_to='mails')),
+                ('attachment_name', models.CharField(blank=True, max_length=150)),
+                ('target_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('sent_field', models.CharField(blank=True, max_length=50)),
+                ('status', models.CharField(choices=[('pending', 'En attente'), ('sent', 'Envoyé'), ('failed', 'Échec')], default='pending', max_length=10, verbose_name='Statut')),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('sent', models.DateTimeField(blank=True, null=True, verbose_name='Envoi')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mails', to='stages.job')),
+                ('target_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'verbose_name': 'Courriel en file d’envoi',
+                'verbose_name_plural': 'Courriels en file d’envoi',
+            },
+        ),
+    ]
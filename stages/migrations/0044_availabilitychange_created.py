@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stages', '0043_queuedmail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='availabilitychange',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
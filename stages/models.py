@@ -1,11 +1,19 @@
 import json
+import os
 from collections import OrderedDict
 from contextlib import suppress
 from datetime import date, timedelta
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Case, Count, When
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.core.mail import EmailMessage
+from django.db import models, transaction
+from django.db.models import Case, Count, Q, Sum, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
 
 from . import utils
 
@@ -93,6 +101,62 @@ class Klass(models.Model):
         return 'EDE' in self.name and 'ps' in self.name
 
 
+class TeacherQuerySet(models.QuerySet):
+    @staticmethod
+    def period_fields():
+        return (
+            ['period_total', 'period_mandats'] + ['period_%s' % key for key in IMPUTATION_KEYS] +
+            ['period_split_%s' % key for key in SPLIT_IMPUTATION_KEYS]
+        )
+
+    def with_periods(self):
+        """
+        Annotate teachers with the sums of their course periods (total, mandates
+        and per imputation), all computed in a single grouped query.
+        """
+        def period_sum(condition=None):
+            return Coalesce(Sum('course__period', filter=condition), 0)
+
+        annotations = {
+            'period_total': period_sum(),
+            'period_mandats': period_sum(Q(course__subject__startswith='#')),
+        }
+        for key in IMPUTATION_KEYS:
+            annotations['period_%s' % key] = period_sum(Q(course__imputation__contains=key))
+        for key in SPLIT_IMPUTATION_KEYS:
+            annotations['period_split_%s' % key] = period_sum(Q(course__imputation=key))
+        return self.annotate(**annotations)
+
+    def with_mandats(self):
+        return self.prefetch_related(models.Prefetch(
+            'course_set', queryset=Course.objects.filter(subject__startswith='#'), to_attr='mandat_courses'
+        ))
+
+    def _calc_and_save_reports(self, calc):
+        """
+        Return the list of calc(teacher) results for all teachers, and store the
+        next_report values which changed in a single bulk update.
+        """
+        results = []
+        changed = []
+        for teacher in self.with_periods():
+            previous = teacher.next_report
+            results.append(calc(teacher))
+            if teacher.next_report != previous:
+                changed.append(teacher)
+        if changed:
+            Teacher.objects.bulk_update(changed, ['next_report'])
+        return results
+
+    def calc_activities(self):
+        """Return a list of (teacher, activities) tuples (see _calc_and_save_reports)."""
+        return self._calc_and_save_reports(lambda teacher: (teacher, teacher.calc_activity()))
+
+    def calc_imputations(self, ratios):
+        """Return a list of (teacher, activities, imputations) tuples (see _calc_and_save_reports)."""
+        return self._calc_and_save_reports(lambda teacher: (teacher, *teacher.calc_imputations(ratios)))
+
+
 class Teacher(models.Model):
     civility = models.CharField(max_length=10, choices=CIVILITY_CHOICES, verbose_name='Civilité')
     first_name = models.CharField(max_length=40, verbose_name='Prénom')
@@ -112,6 +176,8 @@ class Teacher(models.Model):
         verbose_name='Compte utilisateur'
     )
 
+    objects = TeacherQuerySet.as_manager()
+
     class Meta:
         verbose_name='Enseignant'
         ordering = ('last_name', 'first_name')
@@ -134,12 +200,16 @@ class Teacher(models.Model):
     def calc_activity(self):
         """
         Return a dictionary of calculations relative to teacher courses.
-        Store plus/minus periods to self.next_report.
+        Set plus/minus periods to self.next_report (the caller is responsible
+        for saving it).
         """
-        mandats = self.course_set.filter(subject__startswith='#')
-        ens = self.course_set.exclude(subject__startswith='#')
-        tot_mandats = mandats.aggregate(models.Sum('period'))['period__sum'] or 0
-        tot_ens = ens.aggregate(models.Sum('period'))['period__sum'] or 0
+        periods = self.course_periods()
+        if hasattr(self, 'mandat_courses'):
+            mandats = self.mandat_courses
+        else:
+            mandats = self.course_set.filter(subject__startswith='#')
+        tot_mandats = periods['period_mandats']
+        tot_ens = periods['period_total'] - tot_mandats
         # formation periods calculated at pro-rata of total charge
         tot_formation = int(round(
             (tot_mandats + tot_ens) / settings.MAX_ENS_PERIODS * settings.MAX_ENS_FORMATION
@@ -154,7 +224,6 @@ class Teacher(models.Model):
         if (self.rate == 100 and tot_paye < max_periods) or (tot_paye > max_periods):
             tot_paye = max_periods
             self.next_report = tot_trav - tot_paye
-        self.save()
 
         return {
             'mandats': mandats,
@@ -171,29 +240,23 @@ class Teacher(models.Model):
         Return a tuple for accountings charges
         """
         activities = self.calc_activity()
-        imputations = OrderedDict(
-            [('ASAFE', 0), ('ASSCFE', 0), ('ASEFE', 0), ('MPTS', 0), ('MPS', 0), ('EDEpe', 0), ('EDEps', 0),
-             ('EDS', 0), ('CAS_FPP', 0)]
-        )
-        courses = self.course_set.all()
-
-        for key in imputations:
-            imputations[key] = courses.filter(imputation__contains=key).aggregate(models.Sum('period'))['period__sum'] or 0
+        periods = self.course_periods()
+        imputations = OrderedDict([(key, periods['period_%s' % key]) for key in IMPUTATION_KEYS])
 
         # Spliting imputations for EDE, ASE and ASSC
-        ede = courses.filter(imputation='EDE').aggregate(models.Sum('period'))['period__sum'] or 0
+        ede = periods['period_split_EDE']
         if ede > 0:
             pe = int(round(ede * ratios['edepe'], 0))
             imputations['EDEpe'] += pe
             imputations['EDEps'] += ede - pe
 
-        ase = courses.filter(imputation='ASE').aggregate(models.Sum('period'))['period__sum'] or 0
+        ase = periods['period_split_ASE']
         if ase > 0:
             asefe = int(round(ase * ratios['asefe'], 0))
             imputations['ASEFE'] += asefe
             imputations['MPTS'] += ase - asefe
 
-        assc = courses.filter(imputation='ASSC').aggregate(models.Sum('period'))['period__sum'] or 0
+        assc = periods['period_split_ASSC']
         if assc > 0:
             asscfe = int(round(assc * ratios['asscfe'], 0))
             imputations['ASSCFE'] += asscfe
@@ -207,6 +270,16 @@ class Teacher(models.Model):
 
         return (activities, imputations)
 
+    def course_periods(self):
+        """
+        Return the period sums computed by TeacherQuerySet.with_periods(), either
+        from the instance annotations or from a fresh query.
+        """
+        fields = TeacherQuerySet.period_fields()
+        if hasattr(self, fields[0]):
+            return {field: getattr(self, field) for field in fields}
+        return Teacher.objects.filter(pk=self.pk).with_periods().values(*fields)[0]
+
     def total_logbook(self):
         return LogBook.objects.filter(teacher=self).aggregate(models.Sum('nb_period'))['nb_period__sum']
     total_logbook.short_description = 'Solde du carnet du lait'
@@ -354,15 +427,20 @@ class Student(models.Model):
             return {'M': 'étudiant', 'F': 'étudiante'}.get(self.gender, '')
 
     def save(self, **kwargs):
+        self.set_archived_text()
+        super().save(**kwargs)
+
+    def set_archived_text(self, trainings=None):
+        """
+        Fill archived_text with training data (JSON-formatted) for archived
+        students, or empty it for non-archived students.
+        """
         if self.archived and not self.archived_text:
-            # Fill archived_text with training data, JSON-formatted
-            trainings = [
-                tr.serialize() for tr in self.training_set.all().select_related('availability')
-            ]
-            self.archived_text = json.dumps(trainings)
+            if trainings is None:
+                trainings = self.training_set.all().select_related('availability')
+            self.archived_text = json.dumps([tr.serialize() for tr in trainings])
         if self.archived_text and not self.archived:
             self.archived_text = ""
-        super().save(**kwargs)
 
     def age_at(self, date_):
         """Return age of student at `date_` time, as a string."""
@@ -488,6 +566,22 @@ class Corporation(models.Model):
     def pcode_city(self):
         return '{0} {1}'.format(self.pcode, self.city)
 
+    def school_year_stats(self):
+        """
+        Return an OrderedDict of school years (ascending) with weeks of training
+        by section, like: {'2011 — 2012': {'ASE': 6, 'ASSC': 0}, ...}
+        """
+        stats = OrderedDict()
+        periods = Period.objects.filter(availability__corporation=self).annotate(
+            num_trainings=Count('availability__training')
+        ).select_related('section').order_by('start_date')
+        for period in periods:
+            year_stats = stats.setdefault(period.school_year, OrderedDict())
+            year_stats[period.section.name] = (
+                year_stats.get(period.section.name, 0) + period.weeks * period.num_trainings
+            )
+        return stats
+
 
 class CorpContact(models.Model):
     corporation = models.ForeignKey(
@@ -564,6 +658,8 @@ class Period(models.Model):
     level = models.ForeignKey(Level, verbose_name='Niveau', on_delete=models.PROTECT)
     start_date = models.DateField(verbose_name='Date de début')
     end_date = models.DateField(verbose_name='Date de fin')
+    # Incremented each time availabilities/trainings/contacts of the period change
+    version = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = "Période de pratique professionnelle"
@@ -581,21 +677,60 @@ class Period(models.Model):
     def school_year(self):
         return utils.school_year(self.start_date)
 
+    def save(self, **kwargs):
+        end_date_query = Period.objects.filter(pk=self.pk).values_list('end_date', flat=True)
+        old_end_date = end_date_query.first() if self.pk else None
+        super().save(**kwargs)
+        if old_end_date is not None:
+            new_end_date = end_date_query.first()
+            if old_end_date != new_end_date:
+                referents = set(self.availability_set.values_list('training__referent', flat=True))
+                ReferentLoad.refresh({(ref, end) for ref in referents for end in (old_end_date, new_end_date)})
+
+    def _school_year_diff(self):
+        return (utils.school_year(self.start_date, as_tuple=True)[0] -
+                utils.school_year(date.today(), as_tuple=True)[0])
+
     @property
     def relative_level(self):
         """
         Return the level depending on current school year. For example, if the
         period is planned for next school year, level will be level - 1.
         """
-        diff = (utils.school_year(self.start_date, as_tuple=True)[0] -
-                utils.school_year(date.today(), as_tuple=True)[0])
-        return self.level.delta(-diff)
+        return self.level.delta(-self._school_year_diff())
+
+    @property
+    def relative_level_name(self):
+        """Name of relative_level, without querying the Level table."""
+        return str(int(self.level.name) - self._school_year_diff())
 
     @property
     def weeks(self):
         """ Return the number of weeks of this period """
         return (self.end_date - self.start_date).days // 7
 
+    def log_changes(self, changes):
+        """
+        Bump the period version and record that the availabilities (and the
+        students of their trainings) changed in this version. `changes` is a
+        list of (availability_id, student_id) tuples. The period row is locked
+        so that concurrent changes get distinct versions.
+        Called by the Availability/Training signal handlers, and to be called
+        explicitly after bulk creations/updates.
+        """
+        with transaction.atomic():
+            version = Period.objects.select_for_update().values_list('version', flat=True).get(pk=self.pk)
+            self.version = version + 1
+            Period.objects.filter(pk=self.pk).update(version=self.version)
+            AvailabilityChange.objects.bulk_create([
+                AvailabilityChange(
+                    period=self, version=self.version, availability_id=availability_id, student_id=student_id
+                ) for availability_id, student_id in changes
+            ])
+
+    def log_change(self, availability_id, student_id=None):
+        self.log_changes([(availability_id, student_id)])
+
 
 class Availability(models.Model):
     """ Disponibilités des institutions """
@@ -653,6 +788,165 @@ class Training(models.Model):
         }
 
 
+class AvailabilityChange(models.Model):
+    """ Journal des modifications de disponibilités/stages d'une période """
+    period = models.ForeignKey(Period, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    # Not foreign keys, as the objects may have been deleted
+    availability_id = models.IntegerField()
+    student_id = models.IntegerField(null=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['period', 'version'])]
+
+    def __str__(self):
+        return '%s (version %s)' % (self.period, self.version)
+
+    @classmethod
+    def prune(cls):
+        """Delete changes older than settings.AVAILABILITY_CHANGES_RETENTION_DAYS."""
+        return cls.objects.filter(
+            created__lt=timezone.now() - timedelta(days=settings.AVAILABILITY_CHANGES_RETENTION_DAYS)
+        ).delete()[0]
+
+
+class ReferentLoad(models.Model):
+    """
+    Nombre de stages suivis par un référent par année scolaire, maintenu lors
+    de l'enregistrement/suppression des stages (voir aussi la commande
+    rebuild_referent_loads).
+    """
+    teacher = models.ForeignKey(Teacher, on_delete=models.CASCADE)
+    # First year of the school year (starting on August 1st)
+    year = models.PositiveSmallIntegerField()
+    num_refs = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('teacher', 'year')
+
+    def __str__(self):
+        return '%s (%d): %d' % (self.teacher, self.year, self.num_refs)
+
+    @staticmethod
+    def key_for(trainings):
+        """Return the (referent_id, period end date) of the first training of `trainings`."""
+        return trainings.values_list('referent_id', 'availability__period__end_date').first()
+
+    @classmethod
+    def refresh(cls, loads):
+        """Recompute counters for `loads`, a set of (teacher_id, period end date) tuples."""
+        for teacher_id, year in {(load[0], utils.school_year_start(load[1]).year) for load in loads
+                                 if load is not None and load[0] is not None}:
+            cls.objects.update_or_create(
+                teacher_id=teacher_id, year=year,
+                defaults={'num_refs': Training.objects.filter(
+                    referent_id=teacher_id,
+                    availability__period__end_date__gte=date(year, 8, 1),
+                    availability__period__end_date__lt=date(year + 1, 8, 1),
+                ).count()}
+            )
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls):
+        """Recompute all counters from the trainings (after bulk changes)."""
+        counts = {}
+        for teacher_id, end_date, num in Training.objects.filter(referent__isnull=False).values_list(
+                'referent_id', 'availability__period__end_date').annotate(num=Count('id')).order_by():
+            key = (teacher_id, utils.school_year_start(end_date).year)
+            counts[key] = counts.get(key, 0) + num
+        cls.objects.all().delete()
+        cls.objects.bulk_create([
+            cls(teacher_id=teacher_id, year=year, num_refs=num) for (teacher_id, year), num in counts.items()
+        ])
+        return len(counts)
+
+    @classmethod
+    def current_counts(cls):
+        """Return a {teacher_id: num_refs} dict from the current school year on."""
+        return dict(
+            cls.objects.filter(year__gte=utils.school_year_start().year).values('teacher'
+                ).annotate(total=Sum('num_refs')).values_list('teacher', 'total')
+        )
+
+
+# Availability and Training changes are recorded from signals, so that
+# cascade and queryset deletions are also logged.
+
+def _deleting_period(origin):
+    """True when the deletion comes from its period (the change log is deleted too)."""
+    return isinstance(origin, Period) or (isinstance(origin, models.QuerySet) and origin.model is Period)
+
+
+@receiver(pre_save, sender=Availability)
+def _availability_pre_save(sender, instance, raw=False, **kwargs):
+    instance._old_period_id = Availability.objects.filter(pk=instance.pk).values_list(
+        'period_id', flat=True).first() if instance.pk and not raw else None
+
+
+@receiver(post_save, sender=Availability)
+def _availability_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance.period.log_change(instance.pk)
+    if instance._old_period_id not in (None, instance.period_id):
+        # Moved to another period, also notify the old one
+        Period(pk=instance._old_period_id).log_change(instance.pk, Training.objects.filter(
+            availability=instance).values_list('student_id', flat=True).first())
+
+
+@receiver(pre_delete, sender=Availability)
+def _availability_pre_delete(sender, instance, origin=None, **kwargs):
+    if not _deleting_period(origin):
+        Period(pk=instance.period_id).log_change(instance.pk)
+
+
+def _training_state(pk):
+    """Return ((availability_id, period_id, student_id), referent load) of a saved training."""
+    state = Training.objects.filter(pk=pk).values_list(
+        'availability_id', 'availability__period_id', 'student_id',
+        'referent_id', 'availability__period__end_date',
+    ).first()
+    return None if state is None else (state[:3], state[3:])
+
+
+@receiver(pre_save, sender=Training)
+def _training_pre_save(sender, instance, raw=False, **kwargs):
+    instance._old_state = _training_state(instance.pk) if instance.pk and not raw else None
+
+
+@receiver(post_save, sender=Training)
+def _training_post_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    (avail_id, period_id, student_id), load = _training_state(instance.pk)
+    Period(pk=period_id).log_change(avail_id, student_id)
+    old_load = None
+    if instance._old_state is not None:
+        old, old_load = instance._old_state
+        if old != (avail_id, period_id, student_id):
+            # Moved to another availability/student, also log the old ones
+            Period(pk=old[1]).log_change(old[0], old[2])
+    ReferentLoad.refresh({old_load, load})
+
+
+@receiver(pre_delete, sender=Training)
+def _training_pre_delete(sender, instance, origin=None, **kwargs):
+    state = _training_state(instance.pk)
+    if state is None:
+        return
+    (avail_id, period_id, student_id), instance._referent_load = state
+    if not _deleting_period(origin):
+        Period(pk=period_id).log_change(avail_id, student_id)
+
+
+@receiver(post_delete, sender=Training)
+def _training_post_delete(sender, instance, **kwargs):
+    if getattr(instance, '_referent_load', None) is not None:
+        ReferentLoad.refresh({instance._referent_load})
+
+
 IMPUTATION_CHOICES = (
     ('ASAFE', 'ASAFE'),
     ('ASEFE', 'ASEFE'),
@@ -673,6 +967,11 @@ IMPUTATION_CHOICES = (
     ('#Mandat_ASSC', 'ASSC'),
 )
 
+# Imputation keys, in accounting export order
+IMPUTATION_KEYS = ('ASAFE', 'ASSCFE', 'ASEFE', 'MPTS', 'MPS', 'EDEpe', 'EDEps', 'EDS', 'CAS_FPP')
+# Imputations to split afterwards by ratio
+SPLIT_IMPUTATION_KEYS = ('EDE', 'ASE', 'ASSC')
+
 
 class Course(models.Model):
     """Cours et mandats attribués aux enseignants"""
@@ -706,3 +1005,126 @@ class SupervisionBill(models.Model):
 
     def __str__(self):
         return '{0} : {1}'.format(self.student.full_name, self.supervisor.full_name)
+
+
+def job_file_path(job, filename):
+    return 'jobs/{0}/{1}'.format(job.pk, filename)
+
+
+class Job(models.Model):
+    """
+    Long-running task (export, PDF archive, import) executed in the background
+    by the run_jobs management command (see stages.jobs).
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'En attente'),
+        (STATUS_RUNNING, 'En cours'),
+        (STATUS_DONE, 'Terminé'),
+        (STATUS_FAILED, 'Échec'),
+    )
+    kind = models.CharField("Type", max_length=20)
+    title = models.CharField("Titre", max_length=200)
+    params = models.JSONField(default=dict, blank=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='Utilisateur'
+    )
+    status = models.CharField("Statut", max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    created = models.DateTimeField("Création", auto_now_add=True)
+    started = models.DateTimeField("Début", null=True, blank=True)
+    finished = models.DateTimeField("Fin", null=True, blank=True)
+    # Regularly updated by the worker running the job
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    # Pending jobs are not run before this time (retries)
+    run_after = models.DateTimeField(null=True, blank=True)
+    # Uploaded file for imports
+    upload = models.FileField(upload_to=job_file_path, blank=True)
+    result = models.FileField("Résultat", upload_to=job_file_path, blank=True)
+    message = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = 'Tâche en arrière-plan'
+        verbose_name_plural = 'Tâches en arrière-plan'
+        ordering = ('-created',)
+        indexes = [models.Index(fields=['status', 'created'])]
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.title, self.get_status_display())
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def result_filename(self):
+        return os.path.basename(self.result.name)
+
+    def delete_files(self):
+        for field_file in (self.upload, self.result):
+            if field_file:
+                field_file.delete(save=False)
+
+
+class QueuedMail(models.Model):
+    """
+    E-mail message sent by a background job (see stages.mail). When the
+    message is sent, the `sent_field` datetime field of `target` is set.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'En attente'),
+        (STATUS_SENT, 'Envoyé'),
+        (STATUS_FAILED, 'Échec'),
+    )
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name='mails')
+    description = models.CharField(max_length=200, blank=True)
+    subject = models.CharField("Sujet", max_length=255)
+    body = models.TextField("Message")
+    from_email = models.CharField("Expéditeur", max_length=254)
+    # Addresses separated by semicolons
+    to = models.TextField("Destinataires")
+    bcc = models.TextField("Copie cachée", blank=True)
+    # Existing file (not copied), read when the message is sent
+    attachment = models.FileField(upload_to='mails', blank=True)
+    attachment_name = models.CharField(max_length=150, blank=True)
+    target_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True, blank=True)
+    target_id = models.PositiveIntegerField(null=True, blank=True)
+    target = GenericForeignKey('target_type', 'target_id')
+    sent_field = models.CharField(max_length=50, blank=True)
+    status = models.CharField("Statut", max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    sent = models.DateTimeField("Envoi", null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Courriel en file d’envoi'
+        verbose_name_plural = 'Courriels en file d’envoi'
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.subject, self.to)
+
+    @staticmethod
+    def _addresses(value):
+        return [addr.strip() for addr in value.split(';') if addr.strip()]
+
+    def email_message(self):
+        email = EmailMessage(
+            subject=self.subject, body=self.body, from_email=self.from_email,
+            to=self._addresses(self.to), bcc=self._addresses(self.bcc),
+        )
+        if self.attachment:
+            with self.attachment.open('rb') as fh:
+                email.attach(self.attachment_name or os.path.basename(self.attachment.name), fh.read())
+        return email
+
+    def mark_sent(self):
+        self.status, self.sent, self.error = self.STATUS_SENT, timezone.now(), ''
+        self.save(update_fields=['status', 'sent', 'error', 'attempts'])
+        if self.target_type_id and self.sent_field:
+            model = ContentType.objects.get_for_id(self.target_type_id).model_class()
+            model._default_manager.filter(pk=self.target_id).update(**{self.sent_field: self.sent})
@@ -1,16 +1,24 @@
+import hashlib
+import io
+import json
+from contextlib import contextmanager
 from datetime import date
+from functools import lru_cache
 
 from django.conf import settings
 from django.contrib.staticfiles.finders import find
+from django.db.models import Model
 from django.utils.dateformat import format as django_format
 
+from reportlab import rl_config
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
 from reportlab.lib import colors
 from reportlab.lib.styles import ParagraphStyle as PS
+from reportlab.lib.utils import ImageReader
 from reportlab.platypus import (
-    Flowable, Frame, Image, NextPageTemplate, PageBreak, PageTemplate, Paragraph,
+    Flowable, Frame, NextPageTemplate, PageBreak, PageTemplate, Paragraph,
     SimpleDocTemplate, Spacer, Table, TableStyle, Preformatted
 )
 
@@ -27,11 +35,48 @@ style_smaller = PS(name='CORPS', fontName='Helvetica', fontSize=font_size_base -
 style_bold_title = PS(name="CORPS", fontName="Helvetica-Bold", fontSize=font_size_base + 4, alignment=TA_LEFT)
 style_smallx = PS(name='CORPS', fontName="Helvetica-BoldOblique", fontSize=font_size_base - 2, alignment=TA_LEFT)
 
+# Changes whenever this module changes, to invalidate cached documents.
+with open(__file__, 'rb') as fh:
+    TEMPLATES_VERSION = hashlib.sha256(fh.read()).hexdigest()
+
 LOGO_EPC_LONG = find('img/header.gif')
 LOGO_CPNE = find('img/logo_CPNE.jpg')
 LOGO_CPNE_ADR = find('img/logo_CPNE_avec_adr.png')
 
 
+@lru_cache(maxsize=None)
+def shared_image(path):
+    """
+    Return an ImageReader for the image at `path`, decoded once per process and
+    shared by all documents (and pages) drawing it.
+    JPEG files are better drawn from their path, as they are embedded as is.
+    """
+    reader = ImageReader(path)
+    reader.getRGBData()
+    return reader
+
+
+def klass_students(klass):
+    """
+    Return active students of klass, from the `active_students` attribute when
+    they have been prefetched.
+    """
+    if hasattr(klass, 'active_students'):
+        return klass.active_students
+    return klass.student_set.filter(archived=False).order_by('last_name', 'first_name')
+
+
+def render_pdf(pdf_class, init_args, produce_args):
+    """
+    Build a PDF document and return its content as bytes.
+    Arguments must be picklable and already contain all data needed by the
+    document (no database access), as this may run in a separate process.
+    """
+    buff = io.BytesIO()
+    pdf_class(buff, *init_args).produce(*produce_args)
+    return buff.getvalue()
+
+
 class HorLine(Flowable):
     """Line flowable --- draws a line in a flowable"""
 
@@ -46,6 +91,20 @@ class HorLine(Flowable):
         self.canv.line(0, 0, self.width, 0)
 
 
+class SharedImage(Flowable):
+    """Image flowable drawing a shared ImageReader (see shared_image)."""
+
+    def __init__(self, path, width, height, hAlign='CENTER'):
+        super().__init__()
+        self.reader = shared_image(path)
+        self.width = width
+        self.height = height
+        self.hAlign = hAlign
+
+    def draw(self):
+        self.canv.drawImage(self.reader, 0, 0, self.width, self.height, mask='auto')
+
+
 class EpcBaseDocTemplate(SimpleDocTemplate):
     points = '.' * 93
 
@@ -62,10 +121,29 @@ class EpcBaseDocTemplate(SimpleDocTemplate):
         self.story = []
         self.title = title
 
+    def cache_inputs(self):
+        """
+        Return a list of all data rendered in the document (model instances or
+        JSON-serializable values), or None if the document should not be cached.
+        """
+        return None
+
+    def cache_key(self):
+        """Return a hash of the document inputs and templates, or None."""
+        inputs = self.cache_inputs()
+        if inputs is None:
+            return None
+        data = [self.__class__.__name__, TEMPLATES_VERSION, settings.LANGUAGE_CODE] + [
+            [value._meta.label] + [f.value_to_string(value) for f in value._meta.concrete_fields]
+            if isinstance(value, Model) else value
+            for value in inputs
+        ]
+        return hashlib.sha256(json.dumps(data, default=str).encode()).hexdigest()
+
     def header(self, canvas, doc):
         canvas.saveState()
         canvas.drawImage(
-            LOGO_CPNE_ADR, doc.leftMargin, doc.height - 3.5 * cm, 7 * cm, 3 * cm, preserveAspectRatio=True
+            shared_image(LOGO_CPNE_ADR), doc.leftMargin, doc.height - 3.5 * cm, 7 * cm, 3 * cm, preserveAspectRatio=True
         )
 
         # Footer
@@ -100,6 +178,29 @@ class EpcBaseDocTemplate(SimpleDocTemplate):
             self.story.append(Spacer(0, 1.8 * cm))
 
 
+CHARGE_SHEET_TABLE_STYLE = TableStyle([
+    ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+    ('LINEABOVE', (0, -3), (-1, -1), 0.5, colors.black),
+    ('FONT', (0, -2), (-1, -2), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 8),
+])
+
+
+@contextmanager
+def binary_streams():
+    """
+    Write binary (not ASCII85-encoded) streams in documents built in this
+    context: encoding the logos of each document in pure Python takes most of
+    the rendering time of short documents.
+    """
+    use_a85 = rl_config.useA85
+    rl_config.useA85 = 0
+    try:
+        yield
+    finally:
+        rl_config.useA85 = use_a85
+
+
 class ChargeSheetPDF(EpcBaseDocTemplate):
     """
     Génération des feuilles de charges en pdf.
@@ -143,12 +244,7 @@ class ChargeSheetPDF(EpcBaseDocTemplate):
             data, colWidths=[12 * cm, 2 * cm, 2 * cm], hAlign=TA_CENTER,
             rowHeights=(0.6 * cm), spaceBefore=0.4 * cm, spaceAfter=1.5 * cm
         )
-        t.setStyle(TableStyle([
-            ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
-            ('LINEABOVE', (0, -3), (-1, -1), 0.5, colors.black),
-            ('FONT', (0, -2), (-1, -2), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 8),
-        ]))
+        t.setStyle(CHARGE_SHEET_TABLE_STYLE)
         self.story.append(t)
 
         d = 'La Chaux-de-Fonds, le {0}'.format(django_format(date.today(), 'j F Y'))
@@ -164,7 +260,8 @@ class ChargeSheetPDF(EpcBaseDocTemplate):
             self.story.append(Spacer(0, 1 * cm))
             self.story.append(Paragraph('Lieu, date et signature: ' + self.points, style_normal))
         self.story.append(PageBreak())
-        self.build(self.story)
+        with binary_streams():
+            self.build(self.story)
 
 
 class UpdateDataFormPDF(EpcBaseDocTemplate):
@@ -185,9 +282,8 @@ class UpdateDataFormPDF(EpcBaseDocTemplate):
 
     def produce(self, klass):
         self.story = []
-        header = open(LOGO_EPC_LONG, 'rb')
-        for student in klass.student_set.filter(archived=False):
-            self.story.append(Image(header, width=520, height=75))
+        for student in klass_students(klass):
+            self.story.append(SharedImage(LOGO_EPC_LONG, width=520, height=75))
             self.story.append(Spacer(0, 2 *cm))
             destinataire = '{0}<br/>{1}<br/>{2}'.format(student.civility, student.full_name, student.klass)
             self.story.append(Paragraph(destinataire, style_adress))
@@ -266,7 +362,6 @@ class UpdateDataFormPDF(EpcBaseDocTemplate):
             self.story.append(Paragraph("Pas d'élèves dans cette classe", style_normal))
 
         self.build(self.story)
-        header.close()
 
     def is_corp_required(self, klass_name):
         return any(el in klass_name for el in ['FE', 'EDS', 'EDEpe'])
@@ -283,6 +378,13 @@ class CompensationForm:
     EXPERT_ACCOUNT = '30 490 002'
     MENTOR_ACCOUNT = "30 490 002"
 
+    def cache_inputs(self):
+        return [settings.OTP_EDE, settings.OTP_MSP, settings.OTP_EDS]
+
+    def person_inputs(self, person):
+        """Inputs of add_address/add_private_data."""
+        return [person, person.corporation if person else None]
+
     def add_private_data(self, person):
         self.story.append(Spacer(0, 0.5 * cm))
         style_titre1 = PS(name='Title1', fontName='Helvetica-Bold', fontSize=12, alignment=TA_CENTER)
@@ -431,6 +533,13 @@ class ExpertEdeLetterPdf(CompensationForm, EpcBaseDocTemplate):
             PageTemplate(id='ISOPage', frames=[self.page_frame], onPage=self.header_cpne),
         ])
 
+    def cache_inputs(self):
+        exam_data = self.exam_data()
+        return super().cache_inputs() + self.person_inputs(exam_data['expert']) + [
+            # The letter is dated
+            date.today(), self.exam, self.exam.student, self.exam.student.klass, exam_data['internal_expert'],
+        ]
+
     def exam_data(self):
         return {
             'expert': self.exam.external_expert,
@@ -529,6 +638,11 @@ class CompensationPDFForm(CompensationForm, EpcBaseDocTemplate):
             PageTemplate(id='FirstPage', frames=[self.page_frame], onPage=self.header_cpne)
         ])
 
+    def cache_inputs(self):
+        return super().cache_inputs() + self.person_inputs(self.expert) + [
+            self.student, self.student.klass, self.exam,
+        ]
+
     def produce(self):
         self.add_private_data(self.expert)
 
@@ -559,6 +673,9 @@ class ExpertInfoForm(CompensationPDFForm):
         self.contact = contact
         super().__init__(out, **kwargs)
 
+    def cache_inputs(self):
+        return self.person_inputs(self.contact)
+
     def produce(self):
         self.add_private_data(self.contact)
         self.build(self.story)
@@ -646,7 +763,7 @@ class KlassListPDF(EpcBaseDocTemplate):
         self.story.append(t)
 
         data = []
-        for index, student in enumerate(klass.student_set.all().filter(archived=False).order_by('last_name', 'first_name')):
+        for index, student in enumerate(klass_students(klass)):
 
             data.append(['{0}.'.format(index + 1),
                          '{0} {1}'.format(student.last_name, student.first_name),
@@ -0,0 +1,48 @@
+"""
+Process pool rendering files of zipped archives (see ZippedFilesBaseView).
+This module is imported by spawned workers before Django is set up, so it must
+not import models at module level.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.utils import translation
+
+# (number of processes, pool)
+_pool = (0, None)
+
+
+def _init_worker():
+    if not apps.ready:
+        # Spawned worker processes need to setup Django themselves.
+        django.setup()
+
+
+def get_pool(processes):
+    """
+    Return the process pool, created on first use. Workers are spawned (not
+    forked) so that they do not inherit the database connections and state of
+    the web worker, and they are reused between requests.
+    """
+    global _pool
+    if _pool[0] != processes:
+        if _pool[1] is not None:
+            _pool[1].shutdown(wait=False, cancel_futures=True)
+        _pool = (processes, ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+        ))
+    return _pool[1]
+
+
+def reset_pool():
+    """Forget the pool (after a worker died), a new one is created on next use."""
+    global _pool
+    _pool = (0, None)
+
+
+def render(func, language):
+    with translation.override(language):
+        return func()
@@ -14,72 +14,131 @@ function update_periods(section_id) {
         sel.val($.cookie('periode'));
 
     var periode_val = sel.val();
-    update_students(periode_val);
-    update_corporations(periode_val);
+    update_period(periode_val);
     update_trainings(periode_val);
   });
 }
 
-function update_students(period_id) {
+function update_period(period_id) {
+  // Load students, availabilities and contacts of the period in one request
   $('#student_select').empty();
   $('#student_filter').empty();
   $('#student_detail').html('').removeClass("filled");
   current_student = null;
-  $('input#valid_training').hide();
-  if (period_id == '') return;
-  $.getJSON('/period/' + period_id + '/students/', function(data) {
-    var sel = $('#student_select');
-    var classes = [];
-    var options = [];
-    $('#student_filter').append($("<option />").val('').text('Toutes les classes'));
-    $.each(data, function() {
-      if (this.training_id == null) {
-        options.push(this);
-        sel.append($("<option />").val(this.id).text(this.name + ' (' + this.klass + ')'));
-      }
-      if ($.inArray(this.klass, classes) < 0) {
-        classes.push(this.klass);
-        $('#student_filter').append($("<option />").val(this.klass).text(this.klass));
-      }
-    });
-    // Keep options as data to enable filtering
-    sel.data('options', options);
-    $('div#student_total').html(options.length + " étudiant-e-s").data('num', options.length);
-  });
-}
-
-function update_corporations(period_id) {
   $('#corp_select').empty();
   $('#corp_detail').html('').removeClass("filled");
   current_avail = null;
   $('#contact_select').find('option:gt(0)').remove();
   $('input#valid_training').hide();
+  period_contacts = {};
+  period_version = null;
   if (period_id == '') {
       $('input#export_non_attr').hide();
       return;
   }
-  $.getJSON('/period/' + period_id + '/corporations/', function(data) {
-    var sel = $('#corp_select');
-    var domains = [];
-    var options = [];
-    $('#corp_filter').empty().append($("<option />").val('').text('Tous les domaines'));
-    // data contains availabilities (id is availability not corporation)
-    $.each(data, function() {
-      if (this.free) {
-        options.push(this);
-        var new_opt = $("<option />").val(this.id).text(this.corp_name).data('idCorp', this.id_corp);
-        if (this.priority) new_opt.addClass('priority');
-        sel.append(new_opt);
-      }
-      if ($.inArray(this.domain, domains) < 0) {
-        domains.push(this.domain);
-        $('#corp_filter').append($("<option />").val(this.domain).text(this.domain));
-      }
+  $.getJSON('/period/' + period_id + '/bootstrap/', function(data) {
+    fill_students(data.students);
+    fill_corporations(data.availabilities);
+    period_contacts = data.contacts;
+    period_version = data.version;
+  });
+}
+
+function merge_options(sel, changed_ids, items, sort_key) {
+  // Replace changed items in the select options data (sorted by sort_key).
+  var options = $.grep(sel.data('options') || [], function(option) {
+    return $.inArray(option.id, changed_ids) < 0;
+  }).concat(items);
+  options.sort(function(a, b) { return sort_key(a).localeCompare(sort_key(b)); });
+  sel.data('options', options);
+  return options.length;
+}
+
+function poll_changes() {
+  // Apply changes done by other users since the last loaded version
+  var period_id = $('#period_select').val();
+  if (!period_id || period_version === null) return;
+  $.getJSON('/period/' + period_id + '/changes/?since=' + period_version, function(data) {
+    if (period_id != $('#period_select').val() || data.version <= period_version) return;
+    if (data.reload) {
+      // Changes are no longer logged since our version, load the whole period
+      update_period(period_id);
+      update_trainings(period_id);
+      return;
+    }
+    period_version = data.version;
+    var avail_ids = $.map(data.availabilities, function(av) { return av.id; }).concat(data.deleted_availabilities);
+    var free_avails = $.grep(data.availabilities, function(av) { return av.free; });
+    var num = merge_options($('#corp_select'), avail_ids, free_avails, function(av) {
+      return (av.priority ? '0' : '1') + av.corp_name;
+    });
+    $('div#corp_total').html(num + " disponibilités").data('num', num);
+    var student_ids = $.map(data.students, function(st) { return st.id; }).concat(data.deleted_students);
+    var free_students = $.grep(data.students, function(st) { return st.training_id == null; });
+    num = merge_options($('#student_select'), student_ids, free_students, function(st) {
+      return st.name;
+    });
+    $('div#student_total').html(num + " étudiant-e-s").data('num', num);
+    // Redisplay options, keeping current selection
+    $('#corp_filter').trigger('change');
+    if (current_avail !== null) $('#corp_select').val(current_avail);
+    $('#student_filter').trigger('change');
+    if (current_student !== null) $('#student_select').val(current_student);
+    update_trainings(period_id);
+    update_referent_counts();
+  });
+}
+
+function fill_students(data) {
+  var sel = $('#student_select');
+  var classes = [];
+  var options = [];
+  $('#student_filter').append($("<option />").val('').text('Toutes les classes'));
+  $.each(data, function() {
+    if (this.training_id == null) {
+      options.push(this);
+      sel.append($("<option />").val(this.id).text(this.name + ' (' + this.klass + ')'));
+    }
+    if ($.inArray(this.klass, classes) < 0) {
+      classes.push(this.klass);
+      $('#student_filter').append($("<option />").val(this.klass).text(this.klass));
+    }
+  });
+  // Keep options as data to enable filtering
+  sel.data('options', options);
+  $('div#student_total').html(options.length + " étudiant-e-s").data('num', options.length);
+}
+
+function fill_corporations(data) {
+  var sel = $('#corp_select');
+  var domains = [];
+  var options = [];
+  $('#corp_filter').empty().append($("<option />").val('').text('Tous les domaines'));
+  // data contains availabilities (id is availability not corporation)
+  $.each(data, function() {
+    if (this.free) {
+      options.push(this);
+      var new_opt = $("<option />").val(this.id).text(this.corp_name).data('idCorp', this.id_corp);
+      if (this.priority) new_opt.addClass('priority');
+      sel.append(new_opt);
+    }
+    if ($.inArray(this.domain, domains) < 0) {
+      domains.push(this.domain);
+      $('#corp_filter').append($("<option />").val(this.domain).text(this.domain));
+    }
+  });
+  sel.data('options', options);
+  if (options.length > 0) $('input#export_non_attr').show();
+  else $('input#export_non_attr').hide();
+  $('div#corp_total').html(options.length + " disponibilités").data('num', options.length);
+}
+
+function update_referent_counts() {
+  $.getJSON('/training/referent_counts/', function(data) {
+    $('#referent_select option').each(function() {
+      var parsed = $(this).text().match(/(.*) \((\d+)\)$/);
+      if (this.value && parsed) $(this).text(parsed[1] + ' (' + (data[this.value] || 0) + ')');
     });
-    sel.data('options', options);
-    if (options.length > 0) $('input#export_non_attr').show();
-    else $('input#export_non_attr').hide();
-    $('div#corp_total').html(options.length + " disponibilités").data('num', options.length);
   });
 }
 
@@ -102,13 +161,9 @@ function update_trainings(period_id) {
            csrfmiddlewaretoken: $("input[name='csrfmiddlewaretoken']").val()}, function(data) {
             li.remove();
             // dispatch student and corp in their listings
-            update_students($('#period_select').val());
-            update_corporations($('#period_select').val());
+            update_period($('#period_select').val());
             set_export_visibility();
-            // Decrement referent number
-            var referent = $('#referent_select option[value="' + data.ref_id + '"]')
-            var parsed = referent.text().match(/(.*)\((\d+)\)/);
-            referent.text(parsed[1] +' (' + (parseInt(parsed[2]) - 1) + ')');
+            update_referent_counts();
         });
       });
       $('a.edit_training').click(function(ev) {
@@ -130,8 +185,7 @@ $(document).ready(function() {
 
   $('#period_select').change(function(ev) {
     // Update student/corporation list when period is modified
-    update_students($(this).val());
-    update_corporations($(this).val());
+    update_period($(this).val());
     update_trainings($(this).val());
     $.cookie('periode', $(this).val(), { expires: 7 });
   });
@@ -173,7 +227,7 @@ $(document).ready(function() {
     $.each(options, function(i) {
         var option = options[i];
         if (option.domain == filter_val || filter_val == '') {
-          var new_opt = $("<option />").val(option.id).text(option.corp_name);
+          var new_opt = $("<option />").val(option.id).text(option.corp_name).data('idCorp', option.id_corp);
           if (option.priority) new_opt.addClass('priority');
           sel.append(new_opt);
         }
@@ -188,15 +242,17 @@ $(document).ready(function() {
     var sel = $('#contact_select');
     sel.html('<option value="">-------</option>');
     var id_corp = $(this).find("option:selected").data('idCorp');
-    if (id_corp) {
-        $.getJSON('/corporation/' + id_corp + '/contacts/', function(data) {
-            $.each(data, function(key, contact) {
-                var item = contact.first_name + ' ' + contact.last_name;
-                if (contact.role.length) item += ' (' + contact.role + ')';
-                sel.append($("<option />").val(contact.id).text(item));
-            });
-            if (data.length == 1) sel.val(data[0].id);
+    function fill_contacts(data) {
+        $.each(data, function(key, contact) {
+            var item = contact.first_name + ' ' + contact.last_name;
+            if (contact.role.length) item += ' (' + contact.role + ')';
+            sel.append($("<option />").val(contact.id).text(item));
         });
+        if (data.length == 1) sel.val(data[0].id);
+    }
+    if (id_corp) {
+        if (id_corp in period_contacts) fill_contacts(period_contacts[id_corp]);
+        else $.getJSON('/corporation/' + id_corp + '/contacts/', fill_contacts);
     }
   });
 
@@ -225,11 +281,8 @@ $(document).ready(function() {
           $('input#valid_training').hide();
 
           // Update referent select
-          var parsed = $('#referent_select option:selected').text().match(/(.*)\((\d+)\)/);
-          if (parsed) {
-            $('#referent_select option:selected').text(parsed[1] +' (' + (parseInt(parsed[2]) + 1) + ')');
-            $('#referent_select').val('');
-          }
+          update_referent_counts();
+          $('#referent_select').val('');
           $('#contact_select').val('');
 
           update_trainings($('#period_select').val());
@@ -253,7 +306,10 @@ $(document).ready(function() {
   if ($.cookie('section') != 'undefined')
     $('#section_select').val($.cookie('section'));
   update_periods($('#section_select').val());
+  setInterval(poll_changes, 15000);
 });
 
 var current_student = null;
 var current_avail = null;
+var period_contacts = {};
+var period_version = null;
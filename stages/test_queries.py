@@ -0,0 +1,228 @@
+"""
+Regression guards: the number of SQL queries of exports, imports and batch
+prints must not depend on the number of exported/imported/printed rows.
+"""
+import csv
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from candidats.models import Candidate
+from .management.commands.benchmark import write_hp_file, write_students_file
+from .models import CorpContact, Corporation, Klass, Period, Section, Student, Teacher
+
+
+def write_hp_contacts_file(path):
+    """Write a HyperPlanning-like CSV file of student instructors (HPContactsImportView)."""
+    with open(path, 'w', newline='', encoding='utf-8') as fh:
+        writer = csv.writer(fh, delimiter=';')
+        writer.writerow(['UID_ETU', 'NoSIRET', 'CIVMDS', 'PRENOMMDS', 'NOMMDS', 'EMAILMDS'])
+        students = Student.objects.filter(
+            archived=False, corporation__ext_id__isnull=False
+        ).select_related('corporation', 'instructor').order_by('pk')
+        for idx, student in enumerate(students):
+            if idx % 2 and student.instructor:
+                # Existing contact, with a new email
+                contact = student.instructor
+                writer.writerow([
+                    student.ext_id, student.corporation.ext_id, contact.civility,
+                    contact.first_name, contact.last_name, 'new-%d@example.org' % idx,
+                ])
+            else:
+                writer.writerow([
+                    student.ext_id, student.corporation.ext_id, 'Madame',
+                    'Prénom%d' % idx, 'Nom%d' % idx, 'contact%d@example.org' % idx,
+                ])
+
+
+class QueryCountTests(TestCase):
+    # Number of students added before each measure. Kept small enough so that
+    # bulk queries are not split in several batches (SQLite parameters limit).
+    sizes = (10, 30)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('me', 'me@example.org', 'mepassword')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def add_data(self, size, seed):
+        call_command(
+            'generate_data', students=size, teachers=size // 5, corporations=size // 3,
+            contacts=2, periods=2, availabilities=size // 5, courses=3, candidates=size // 3,
+            seed=seed, stdout=StringIO(),
+        )
+
+    def assertQueriesIndependentOfSize(self, request_func, prepare=None):
+        """
+        Call `request_func` with datasets of growing sizes and check that the
+        number of queries stays the same. `prepare` is called before each
+        measure and its return value is passed to `request_func`.
+        """
+        counts = []
+        for seed, size in enumerate(self.sizes):
+            self.add_data(size, seed)
+            args = (prepare(),) if prepare else ()
+            cache.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                response = request_func(*args)
+                if response.streaming:
+                    # Rendering may be deferred to content streaming
+                    b''.join(response.streaming_content)
+            self.assertIn(response.status_code, (200, 302))
+            self.assertNotIn(messages.ERROR, [msg.level for msg in messages.get_messages(response.wsgi_request)])
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(
+            counts[0], counts[-1],
+            "The number of queries grows with the dataset size (%s)" % ' -> '.join(str(c) for c in counts)
+        )
+
+    def upload(self, url_name):
+        def post(path):
+            with open(path, 'rb') as fh:
+                return self.client.post(reverse(url_name), {'upload': fh})
+        return post
+
+    def admin_action(self, model, action):
+        def post():
+            return self.client.post(
+                reverse('admin:%s_%s_changelist' % (model._meta.app_label, model._meta.model_name)),
+                {'action': action, '_selected_action': list(model.objects.values_list('pk', flat=True))},
+            )
+        return post
+
+    def test_stages_export(self):
+        self.assertQueriesIndependentOfSize(lambda: self.client.get(reverse('stages_export', args=['all'])))
+        self.assertQueriesIndependentOfSize(lambda: self.client.get(reverse('stages_export')))
+
+    def test_stages_export_period(self):
+        def export(non_attr):
+            def get():
+                period = Period.objects.order_by('pk').first()
+                return self.client.get(reverse('stages_export'), {'period': period.pk, 'non_attr': non_attr})
+            return get
+        self.assertQueriesIndependentOfSize(export(0))
+        self.assertQueriesIndependentOfSize(export(1))
+
+    def reset_next_reports(self):
+        # Force next_report changes, so that each measure includes the bulk update.
+        Teacher.objects.update(next_report=9999)
+
+    def test_imputations_export(self):
+        self.assertQueriesIndependentOfSize(
+            lambda _: self.client.get(reverse('imputations_export')), self.reset_next_reports
+        )
+
+    def test_general_export(self):
+        self.assertQueriesIndependentOfSize(lambda: self.client.get(reverse('general-export')))
+
+    def test_ortra_export(self):
+        self.assertQueriesIndependentOfSize(lambda: self.client.get(reverse('ortra-export')))
+
+    def test_export_qualification(self):
+        self.assertQueriesIndependentOfSize(lambda: self.client.get(reverse('export-qualif')))
+
+    def test_institutions_export(self):
+        self.assertQueriesIndependentOfSize(lambda: self.client.get(reverse('corporations-export')))
+
+    def test_klass_export(self):
+        def prepare():
+            # Gather all students having trainings in a single class
+            klass = Klass.objects.filter(section__has_stages=True).order_by('pk').first()
+            Student.objects.filter(klass__section__has_stages=True).update(klass=klass)
+            return klass
+
+        def export(klass):
+            return self.client.get(reverse('class', args=[klass.pk]), {'format': 'xls'})
+
+        def html(klass):
+            return self.client.get(reverse('class', args=[klass.pk]))
+        self.assertQueriesIndependentOfSize(export, prepare)
+        self.assertQueriesIndependentOfSize(html, prepare)
+
+    def test_send_klass_reports(self):
+        def prepare():
+            klass = Klass.objects.order_by('pk').first()
+            Student.objects.update(klass=klass, report_sem1='bulletins/bulletin.pdf')
+            # Fill the content types cache (used to set QueuedMail.target)
+            ContentType.objects.get_for_model(Student)
+            return klass
+
+        def send(klass):
+            return self.client.post(reverse('send-klass-reports', args=[klass.pk, 1]), {
+                'sender': 'me@example.org', 'cci': 'me@example.org', 'subject': "Bulletin semestriel",
+            })
+        self.assertQueriesIndependentOfSize(send, prepare)
+
+    def test_print_update_form(self):
+        with self.settings(PDF_RENDER_PROCESSES=1):
+            self.assertQueriesIndependentOfSize(
+                lambda: self.client.get(reverse('print_update_form'), {'date': '14.09.2018'})
+            )
+
+    def test_print_charge_sheet(self):
+        def print_sheets(_):
+            ids = ','.join(str(pk) for pk in Teacher.objects.values_list('pk', flat=True))
+            return self.client.get(reverse('print-charge-sheet'), {'ids': ids})
+        with self.settings(PDF_RENDER_PROCESSES=1):
+            self.assertQueriesIndependentOfSize(print_sheets, self.reset_next_reports)
+
+    def test_admin_exports(self):
+        self.assertQueriesIndependentOfSize(self.admin_action(CorpContact, 'export_contacts'))
+        self.assertQueriesIndependentOfSize(self.admin_action(Corporation, 'export_corporations'))
+        self.assertQueriesIndependentOfSize(self.admin_action(Candidate, 'export_candidates'))
+
+    def prepare_students_file(self, path, sections):
+        """
+        Write a students file for students of `sections` where some students
+        are new (created), some are missing (archived) and some are modified.
+        """
+        students = Student.objects.filter(archived=False, klass__section__in=sections).order_by('pk')
+        pks = list(students.values_list('pk', flat=True))
+        write_students_file(path, students.exclude(pk__in=pks[2::3]))
+        Student.objects.filter(pk__in=pks[::3]).delete()
+        Student.objects.filter(pk__in=pks[1::3]).update(district='VD')
+        return path
+
+    def test_import_students(self):
+        def prepare():
+            return self.prepare_students_file(
+                os.path.join(self.temp_dir.name, 'students.xlsx'),
+                [s for s in Section.objects.all() if s.is_EPC]
+            )
+        self.assertQueriesIndependentOfSize(self.upload('import-students'), prepare)
+
+    def test_import_students_ester(self):
+        def prepare():
+            return self.prepare_students_file(
+                os.path.join(self.temp_dir.name, 'students_ester.xlsx'),
+                [s for s in Section.objects.all() if s.is_ESTER]
+            )
+        self.assertQueriesIndependentOfSize(self.upload('import-students-ester'), prepare)
+
+    def test_import_hp(self):
+        def prepare():
+            path = os.path.join(self.temp_dir.name, 'HYPERPLANNING.csv')
+            write_hp_file(path)
+            return path
+        self.assertQueriesIndependentOfSize(self.upload('import-hp'), prepare)
+
+    def test_import_hp_contacts(self):
+        def prepare():
+            path = os.path.join(self.temp_dir.name, 'HP_Formateurs.csv')
+            write_hp_contacts_file(path)
+            return path
+        self.assertQueriesIndependentOfSize(self.upload('import-hp-contacts'), prepare)
@@ -1,20 +1,47 @@
 import json
 import os
-from datetime import date, datetime
+import tempfile
+import zipfile
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from functools import partial
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.http import StreamingHttpResponse
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import escape
 
+from openpyxl import load_workbook
+from reportlab import rl_config
+
 from candidats.models import Candidate
+from common.middleware import request_stats
 from .models import (
     Level, Domain, Section, Klass, Option, Period, Student, Corporation, Availability,
-    CorpContact, Teacher, Training, Course, Examination, ExamEDESession,
+    CorpContact, Teacher, Training, Course, Examination, ExamEDESession, ReferentLoad, Job,
+    QueuedMail, AvailabilityChange,
 )
-from .utils import school_year
+from .jobs import JOB_RUNNERS, enqueue
+from .mail import queue_mails
+from .utils import school_year, school_year_start
+from .views.base import PDFCache, ZippedFilesBaseView
+from .views.export import _ratio_Ede_Ase_Assc
+from .views.imports import HPContactsImportView
+
+
+def run_jobs():
+    call_command('run_jobs', concurrency=1, once=True, stdout=StringIO())
 
 
 class StagesTests(TestCase):
@@ -98,14 +125,45 @@ class StagesTests(TestCase):
 
         response2 = self.client.get(reverse('stages_export'), {'period': '2', 'non_attr': '0'})
         self.assertEqual(response2.status_code, 200)
-        self.assertGreater(len(response1.content), len(response2.content))
+        self.assertGreater(len(response1.getvalue()), len(response2.getvalue()))
 
         response3 = self.client.get(reverse('stages_export'), {'period': '1', 'non_attr': '1'})
         self.assertEqual(response2.status_code, 200)
 
+    def test_export_stages_default_contact(self):
+        """
+        The default contact of an availability without contact is taken from
+        its own corporation, even when another corporation has the same name.
+        """
+        corp2 = Corporation.objects.create(
+            name="Centre pédagogique XY", street="Rue du lac 3", city="Neuchâtel", pcode="2000",
+        )
+        CorpContact.objects.create(
+            corporation=corp2, civility="Madame", first_name="Lise", last_name="Bolle",
+            is_main=True, email="lise@example.org", always_cc=True,
+        )
+        avail = Availability.objects.create(
+            corporation=corp2, domain=Domain.objects.get(name="handicap"), period=self.p1,
+        )
+        Training.objects.create(availability=avail, student=Student.objects.get(first_name="Elvire"))
+        response = self.client.get(reverse('stages_export', args=['all']))
+        ws = load_workbook(BytesIO(response.getvalue())).active
+        headers = [cell.value for cell in ws[1]]
+        lines = {
+            row[headers.index('Prénom')]: row for row in ws.iter_rows(min_row=2, values_only=True)
+        }
+        self.assertEqual(lines['Elvire'][headers.index('Nom contact')], 'Bolle')
+        self.assertEqual(lines['André'][headers.index('Nom contact')], 'Horner')
+
     def test_export_students(self):
         response = self.client.get(reverse('general-export'))
         self.assertEqual(response.status_code, 200)
+        wb = load_workbook(BytesIO(response.getvalue()))
+        ws = wb.active
+        self.assertEqual(ws.title, 'Exportation')
+        self.assertEqual(ws['A1'].value, 'Num_Ele')
+        self.assertTrue(ws['A1'].font.bold)
+        self.assertEqual(ws.max_row, 1 + Student.objects.filter(archived=False).count())
 
     def test_export_qualif(self):
         response = self.client.get(reverse('export-qualif'))
@@ -196,6 +254,209 @@ class StagesTests(TestCase):
         decoded = json.loads(response.content.decode('utf-8'))
         self.assertEqual(len(decoded), 2)
         self.assertEqual([item['priority'] for item in decoded], [True, False])
+        self.assertEqual([item['free'] for item in decoded], [True, False])
+
+    def test_period_bootstrap(self):
+        url = reverse('period_bootstrap', args=[self.p1.pk])
+        response = self.client.get(url)
+        data = response.json()
+        self.assertEqual(len(data['availabilities']), 2)
+        self.assertEqual(len(data['trainings']), 1)
+        self.assertEqual(data['trainings'][0]['referent'], 'Caux Julie')
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        self.assertEqual(data['contacts'][str(corp.pk)][0]['last_name'], 'Horner')
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Student and contact changes are not logged in the period version, but change the ETag
+        contact = CorpContact.objects.get(last_name='Horner')
+        contact.role = 'Directeur'
+        contact.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        student = Student.objects.get(pk=data['trainings'][0]['student_id'])
+        student.last_name = "Nouveau"
+        student.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['trainings'][0]['student'], str(student))
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        # Deleting a training changes the version
+        training = Training.objects.get(availability__period=self.p1)
+        self.client.post(reverse('del_training'), {'pk': training.pk})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['trainings'], [])
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_period_changes(self):
+        klass = Klass.objects.get(name="1ASE3")
+        period = Period.objects.create(
+            title="Stage courant", start_date=date.today(), end_date=date.today() + timedelta(days=14),
+            section=klass.section, level=klass.level,
+        )
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        avail = Availability.objects.create(corporation=corp, domain=Domain.objects.first(), period=period)
+        avail2 = Availability.objects.create(corporation=corp, domain=Domain.objects.first(), period=period)
+        version = self.client.get(reverse('period_bootstrap', args=[period.pk])).json()['version']
+        url = reverse('period_changes', args=[period.pk])
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'since': version}).json()['availabilities'], [])
+
+        student = Student.objects.get(last_name="Varrin")
+        self.client.post(reverse('new_training'), {'student': student.pk, 'avail': avail.pk})
+        avail2_pk = avail2.pk
+        avail2.delete()
+        data = self.client.get(url, {'since': version}).json()
+        self.assertGreater(data['version'], version)
+        self.assertEqual([(av['id'], av['free']) for av in data['availabilities']], [(avail.pk, False)])
+        self.assertEqual(data['deleted_availabilities'], [avail2_pk])
+        self.assertEqual([tr['student_id'] for tr in data['trainings']], [student.pk])
+        self.assertEqual([st['id'] for st in data['students']], [student.pk])
+        self.assertIsNotNone(data['students'][0]['training_id'])
+        # Nothing changed since the last version
+        version = data['version']
+        data = self.client.get(url, {'since': version}).json()
+        self.assertEqual(data['availabilities'] + data['trainings'] + data['students'], [])
+        self.assertFalse(data['reload'])
+
+        # Moving an availability to another period is also logged in the old period
+        avail.period = self.p1
+        avail.save()
+        data = self.client.get(url, {'since': version}).json()
+        self.assertEqual(data['deleted_availabilities'], [avail.pk])
+        self.assertEqual([st['id'] for st in data['students']], [student.pk])
+        self.assertIsNone(data['students'][0]['training_id'])
+
+        # Cascade deletions are logged
+        avail.period = period
+        avail.save()
+        version = Period.objects.get(pk=period.pk).version
+        student_pk = student.pk
+        student.delete()
+        data = self.client.get(url, {'since': version}).json()
+        self.assertEqual([(av['id'], av['free']) for av in data['availabilities']], [(avail.pk, True)])
+        self.assertEqual(data['trainings'], [])
+        self.assertEqual(data['deleted_students'], [student_pk])
+
+        # Pruned changes require a full reload
+        AvailabilityChange.objects.filter(period=period).update(created=timezone.now() - timedelta(days=3))
+        with self.settings(AVAILABILITY_CHANGES_RETENTION_DAYS=2):
+            self.assertEqual(AvailabilityChange.prune(), 7)
+        data = self.client.get(url, {'since': version}).json()
+        self.assertEqual(data, {'version': Period.objects.get(pk=period.pk).version, 'reload': True})
+        data = self.client.get(url, {'since': data['version']}).json()
+        self.assertFalse(data['reload'])
+
+    def test_referent_counts(self):
+        klass = Klass.objects.get(name="1ASE3")
+        period = Period.objects.create(
+            title="Stage courant", start_date=date.today(), end_date=date.today() + timedelta(days=14),
+            section=klass.section, level=klass.level,
+        )
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        avail = Availability.objects.create(corporation=corp, domain=Domain.objects.first(), period=period)
+        ref1 = Teacher.objects.get(abrev="JCA")
+        ref2 = Teacher.objects.create(first_name="Jean", last_name="Gris")
+        url = reverse('referent_counts')
+        self.assertEqual(self.client.get(url).json(), {})
+        self.client.post(reverse('new_training'), {
+            'student': Student.objects.get(last_name="Varrin").pk, 'avail': avail.pk, 'referent': ref1.pk,
+        })
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 1})
+        training = avail.training
+        training.referent = ref2
+        training.save()
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 0, str(ref2.pk): 1})
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('attribution'))
+        self.assertContains(response, '%s (1)</option>' % ref2)
+        self.client.post(reverse('del_training'), {'pk': training.pk})
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 0, str(ref2.pk): 0})
+
+        # Cascade and queryset deletions
+        avail2 = Availability.objects.create(corporation=corp, domain=Domain.objects.first(), period=period)
+        student = Student.objects.get(last_name="Varrin")
+        Training.objects.create(student=student, availability=avail, referent=ref1)
+        Training.objects.create(student=Student.objects.get(last_name="Hickx"), availability=avail2, referent=ref1)
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 2, str(ref2.pk): 0})
+        student.delete()
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 1, str(ref2.pk): 0})
+        Training.objects.filter(availability__period=period).delete()
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 0, str(ref2.pk): 0})
+        Training.objects.create(student=Student.objects.get(last_name="Hickx"), availability=avail2, referent=ref1)
+        period.delete()
+        self.assertEqual(self.client.get(url).json(), {str(ref1.pk): 0, str(ref2.pk): 0})
+
+    def test_rebuild_referent_loads(self):
+        training = Training.objects.get(availability__period=self.p1)
+        teacher = Teacher.objects.create(first_name="Jean", last_name="Gris")
+        # Bulk changes are not tracked
+        Training.objects.filter(pk=training.pk).update(referent=teacher)
+        ReferentLoad.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_referent_loads', stdout=out)
+        self.assertEqual(out.getvalue(), "Compteurs de référents recalculés : %d\n" % ReferentLoad.objects.count())
+        year = school_year_start(training.availability.period.end_date).year
+        self.assertEqual(
+            list(ReferentLoad.objects.filter(teacher=teacher).values_list('year', 'num_refs')), [(year, 1)]
+        )
+
+    def test_corporation_view(self):
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        response = self.client.get(reverse('corporation', args=[corp.pk]))
+        self.assertContains(response, "MP_ASE\xa0: 7 semaine(s)")
+        self.assertContains(response, "Dupond Albin (1ASE3)")
+        with self.assertNumQueries(1):
+            self.assertEqual(corp.school_year_stats(), {'2012 — 2013': {'MP_ASE': 7}})
+        response = self.client.get(reverse('corporation-avails', args=[corp.pk]), {'year': '2012'})
+        self.assertContains(response, "Allemand André (2ASE3)")
+        avail = Availability.objects.get(period=self.p1, training__isnull=True)
+        training = Training.objects.create(availability=avail, student=Student.objects.get(last_name="Varrin"))
+        self.assertEqual(corp.school_year_stats(), {'2012 — 2013': {'MP_ASE': 8}})
+        # Queryset deletions are also seen
+        Training.objects.filter(pk=training.pk).delete()
+        self.assertEqual(corp.school_year_stats(), {'2012 — 2013': {'MP_ASE': 7}})
+
+    @override_settings(INSTRUMENTATION=True)
+    def test_instrumentation(self):
+        request_stats.clear()
+        response = self.client.get(reverse('period_availabilities', args=[self.p1.pk]))
+        self.assertRegex(response['Server-Timing'], r'^sql;dur=[\d.]+;desc="\d+ queries, 0 duplicates", total;')
+        response = self.client.get(reverse('instrumentation'))
+        self.assertContains(response, '<td>period_availabilities</td><td>1</td>', html=False)
+        self.client.post(reverse('instrumentation'))
+        self.assertEqual(request_stats.summary()[0]['url_name'], 'instrumentation')
+        User.objects.create_user('user', 'user@example.org', 'userpassword')
+        self.client.login(username='user', password='userpassword')
+        self.assertEqual(self.client.get(reverse('instrumentation')).status_code, 403)
+
+    def test_period_endpoints_queries(self):
+        """The number of queries doesn't depend on the period size."""
+        klass = Klass.objects.get(name="1ASE3")
+        period = Period.objects.create(
+            title="Stage courant", start_date=date.today(), end_date=date.today() + timedelta(days=14),
+            section=klass.section, level=klass.level,
+        )
+        self.client.get(reverse('period_students', args=[period.pk]))  # Warm up the session
+        corp = Corporation.objects.get(name="Centre pédagogique XY")
+        for num in (2, 20):
+            Student.objects.bulk_create([
+                Student(first_name="Élève", last_name="N%d" % idx, klass=klass) for idx in range(num)
+            ])
+            Availability.objects.bulk_create([
+                Availability(corporation=corp, domain=Domain.objects.first(), period=period)
+                for idx in range(num)
+            ])
+            with self.assertNumQueries(5):
+                response = self.client.get(reverse('period_students', args=[period.pk]))
+            self.assertEqual(len(response.json()), Student.objects.filter(klass=klass).count())
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse('period_availabilities', args=[period.pk]))
+            self.assertEqual(len(response.json()), period.availability_set.count())
 
     def test_export_update_forms(self):
         self.client.login(username='me', password='mepassword')
@@ -203,7 +464,7 @@ class StagesTests(TestCase):
         self.assertEqual(
             response['Content-Disposition'], 'attachment; filename="modification.zip"'
         )
-        self.assertGreater(int(response['Content-Length']), 10)
+        self.assertGreater(len(response.getvalue()), 10)
 
     def test_send_ede_convocation(self):
         st = Student.objects.get(first_name="Albin")
@@ -257,6 +518,7 @@ tél. 032 886 33 00
             'message': "Monsieur Albin, ...",
             'sender': 'me@example.org',
         })
+        run_jobs()
         self.assertEqual(len(mail.outbox), 1)
         exam.refresh_from_db()
         self.assertIsNotNone(exam.date_soutenance_mailed)
@@ -323,6 +585,7 @@ tél. 032 886 33 00
             'message': "Monsieur Albin, ...",
             'sender': 'me@example.org',
         })
+        run_jobs()
         self.assertEqual(len(mail.outbox), 1)
         exam.refresh_from_db()
         self.assertIsNotNone(exam.date_soutenance_mailed)
@@ -365,6 +628,54 @@ tél. 032 886 33 00
         self.assertEqual(response['Content-Type'], 'application/pdf')
         self.assertGreater(int(response['Content-Length']), 1000)
 
+    def test_pdf_cache(self):
+        st = Student.objects.get(first_name="Albin")
+        st.mentor = CorpContact.objects.get(last_name="Horner")
+        st.save()
+        url = reverse('print-mentor-compens-form', args=[st.pk])
+        self.client.login(username='me', password='mepassword')
+
+        def cached_files():
+            return [os.path.join(path, name) for path, _, names in os.walk(cache_dir) for name in names]
+
+        with tempfile.TemporaryDirectory() as cache_dir, self.settings(PDF_CACHE_DIR=cache_dir):
+            response = self.client.get(url)
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertTrue(response.getvalue().startswith(b'%PDF'))
+            self.assertEqual(len(cached_files()), 1)
+            # Served from the cache
+            with open(cached_files()[0], 'wb') as fh:
+                fh.write(b'%PDF-cached')
+            response = self.client.get(url)
+            self.assertEqual(response.getvalue(), b'%PDF-cached')
+            self.assertEqual(
+                response['Content-Disposition'], 'attachment; filename="dupond_albin_Indemn_mentor.pdf"'
+            )
+            # Changing data read by the document produces a new document
+            st.mentor.street = 'Rue Neuve 1'
+            st.mentor.save()
+            response = self.client.get(url)
+            self.assertNotEqual(response.getvalue(), b'%PDF-cached')
+            self.assertEqual(len(cached_files()), 2)
+
+    def test_pdf_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            pdf_cache = PDFCache(cache_dir, max_size=12)
+            with mock.patch('stages.views.base.os.walk', wraps=os.walk) as walk:
+                pdf_cache.set('aaaa', b'a' * 6)
+                pdf_cache.set('bbbb', b'b' * 6)
+            # The directory is only walked once to get its initial size
+            self.assertEqual(walk.call_count, 1)
+            os.utime(pdf_cache.path('aaaa'), (1, 1))
+            os.utime(pdf_cache.path('bbbb'), (2, 2))
+            # Reading a file makes it the most recently used one
+            pdf_cache.open('aaaa').close()
+            pdf_cache.set('cccc', b'c' * 6)
+            self.assertIsNone(pdf_cache.open('bbbb'))
+            for key in ('aaaa', 'cccc'):
+                with pdf_cache.open(key) as fh:
+                    self.assertEqual(fh.read(), key[0].encode() * 6)
+
     def test_print_eds_compensation_forms(self):
         klass = Klass.objects.create(
             name="3EDS", section=Section.objects.get(name='EDS'), level=Level.objects.get(name='3')
@@ -466,7 +777,48 @@ class TeacherTests(TestCase):
             'attachment; filename="archive_FeuillesDeCharges.zip"'
         )
         self.assertEqual(response['Content-Type'], 'application/zip')
-        self.assertGreater(len(response.content), 200)
+        content = response.getvalue()
+        self.assertGreater(len(content), 200)
+        # Charge sheets use binary streams, without changing other documents
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            self.assertNotIn(b'ASCII85Decode', archive.read(archive.namelist()[0]))
+        self.assertEqual(rl_config.useA85, 1)
+
+    def test_export_charge_sheet_processes(self):
+        """Files rendered in a process pool are archived in the same order."""
+        Teacher.objects.create(first_name='Isidore', last_name='Gluck', civility='Monsieur')
+        ids = ','.join(str(pk) for pk in Teacher.objects.values_list('pk', flat=True))
+        self.client.login(username='me', password='mepassword')
+        names = []
+        for processes in (1, 2):
+            with self.settings(PDF_RENDER_PROCESSES=processes):
+                response = self.client.get(reverse('print-charge-sheet') + '?ids=%s' % ids)
+                self.assertIsInstance(response, StreamingHttpResponse)
+                self.assertTrue(response.streaming)
+                content = response.getvalue()
+            with zipfile.ZipFile(BytesIO(content)) as archive:
+                names.append(archive.namelist())
+                self.assertTrue(all(archive.read(name).startswith(b'%PDF') for name in names[-1]))
+        self.assertEqual(names[0], ['dubois_jeanne.pdf', 'gluck_isidore.pdf'])
+        self.assertEqual(names[0], names[1])
+
+    def test_zipped_files_render_window(self):
+        """Only a bounded number of files are rendered ahead of the streaming."""
+        submitted = []
+
+        class Pool:
+            def submit(self, func, *args):
+                submitted.append(args)
+                future = Future()
+                future.set_result(func(*args))
+                return future
+
+        jobs = [('%d.txt' % idx, partial(str, idx)) for idx in range(10)]
+        with mock.patch('stages.render_pool.get_pool', return_value=Pool()):
+            files = ZippedFilesBaseView().generate_files(jobs, processes=2)
+            self.assertEqual(next(files), ('0.txt', '0'))
+            self.assertEqual(len(submitted), 4)
+            self.assertEqual([name for name, _ in files], ['%d.txt' % idx for idx in range(1, 10)])
 
     def test_calc_activity(self):
         expected = {
@@ -555,7 +907,42 @@ class TeacherTests(TestCase):
         self.assertEqual(result[1]['ASSCFE'], 606)
         self.assertEqual(result[1]['MPS'], 389)
 
+    def test_calc_imputations_bulk(self):
+        t2 = Teacher.objects.create(
+            first_name='Isidore', last_name='Gluck', birth_date='1986-01-01', previous_report=10,
+        )
+        Course.objects.create(teacher=t2, period=154, subject='#ASSCE Colloque', imputation='ASSC')
+        Course.objects.create(teacher=t2, period=275, subject='Cours MP ASSC', imputation='MPS')
+        Course.objects.create(teacher=t2, period=450, subject='Cours ASSCFE', imputation='ASSCFE')
+        Teacher.objects.create(first_name='Marie', last_name='Sans-Cours')
+        ratio = {'edepe': 0.45, 'asefe': 0.45, 'asscfe': 0.55}
 
+        # One aggregation query and one bulk update, whatever the number of teachers.
+        with self.assertNumQueries(2):
+            results = Teacher.objects.all().calc_imputations(ratio)
+        # No write when next_report values did not change.
+        with self.assertNumQueries(1):
+            Teacher.objects.all().calc_imputations(ratio)
+        self.assertEqual(len(results), 3)
+        for teacher, activities, imputations in results:
+            expected = Teacher.objects.get(pk=teacher.pk).calc_imputations(ratio)
+            del activities['mandats']
+            del expected[0]['mandats']
+            self.assertEqual((activities, imputations), expected)
+        self.assertEqual(results[1][2]['ASSCFE'], 606)
+        t2.refresh_from_db()
+        self.assertEqual(t2.next_report, results[1][0].next_report)
+
+    def test_imputation_ratios(self):
+        with self.assertNumQueries(1):
+            ratios = _ratio_Ede_Ase_Assc()
+        self.assertEqual(ratios, {'edepe': 1, 'asefe': 1, 'asscfe': 1})
+        course = Course.objects.create(
+            teacher=self.teacher, period=12, subject='Sém. enfance 3', imputation='EDEps'
+        )
+        self.assertEqual(_ratio_Ede_Ase_Assc()['edepe'], 0.25)
+        Course.objects.filter(pk=course.pk).update(imputation='EDEpe')
+        self.assertEqual(_ratio_Ede_Ase_Assc()['edepe'], 1)
 
     def test_export_imputations(self):
         self.client.login(username='me', password='mepassword')
@@ -662,8 +1049,10 @@ class ImportTests(TestCase):
         stud_arch = Student.objects.get(ext_id=44444)
         self.assertTrue(stud_arch.archived)
         # Klass teachers have been set
-        klass_assc.teacher = teacher
-        klass_epe.teacher = teacher
+        klass_assc.refresh_from_db()
+        self.assertEqual(klass_assc.teacher, teacher)
+        klass_epe.refresh_from_db()
+        self.assertEqual(klass_epe.teacher, teacher)
         # Corporation.ext_id is updated
         corp.refresh_from_db()
         self.assertEqual(corp.ext_id, 100)
@@ -759,6 +1148,23 @@ class ImportTests(TestCase):
         st1.refresh_from_db()
         self.assertEqual(st1.instructor.last_name, 'Geiser')
 
+    def test_import_hp_contacts_several_lines(self):
+        corp = Corporation.objects.create(ext_id=44444, name="Crèche Les Mousaillons", city="Moulineaux")
+        existing = CorpContact.objects.create(corporation=corp, first_name="Paul", last_name="Ancien")
+        student = Student.objects.create(
+            ext_id=164718, first_name='Margot', last_name='Fellmann', birth_date="1994-05-12",
+            pcode="2300", city="La Chaux-de-Fonds", corporation=corp)
+        line = {
+            'UID_ETU': 164718, 'NoSIRET': 44444, 'CIVMDS': '', 'EMAILMDS': '',
+            'PRENOMMDS': 'Amandine', 'NOMMDS': 'Geiser',
+        }
+        # The contact of the last line of the student wins
+        stats = HPContactsImportView().import_data([line, dict(line, PRENOMMDS='Paul', NOMMDS='Ancien')])
+        self.assertEqual(stats['errors'], [])
+        student.refresh_from_db()
+        self.assertEqual(student.instructor, existing)
+        self.assertTrue(CorpContact.objects.filter(last_name='Geiser').exists())
+
     def test_import_and_send_bulletins(self):
         lev1 = Level.objects.create(name='1')
         klass1 = Klass.objects.create(
@@ -794,6 +1200,8 @@ class ImportTests(TestCase):
         data = response.context['form'].initial
         self.assertEqual(data['to'], "albin@example.org")
         response = self.client.post(send_url, data=data, follow=True)
+        self.assertContains(response, "Le message a été placé dans la file d’envoi.")
+        run_jobs()
         self.assertEqual(len(mail.outbox), 1)
         # Second email as bcc
         self.assertEqual(mail.outbox[0].recipients(), ['albin@example.org', 'me@example.org'])
@@ -801,3 +1209,389 @@ class ImportTests(TestCase):
         student.refresh_from_db()
         self.assertIsNotNone(student.report_sem1_sent)
         self.assertIsNone(student.report_sem2_sent)
+
+    def test_import_bulletins_pages(self):
+        klass = Klass.objects.create(
+            name='1ASEFEa', section=Section.objects.create(name='ASE'),
+            level=Level.objects.create(name='1'),
+        )
+        Student.objects.bulk_create([
+            Student(first_name="Albin", last_name="Dupond", klass=klass),
+            Student(first_name="Justine", last_name="Varrin", klass=klass),
+            Student(first_name="Elvire", last_name="Hickx", klass=klass),
+            Student(first_name="Elvire", last_name="Hickx", klass=klass),
+        ])
+        pages = [
+            "Elève : Dupond Albin", "Elève : Varrin Justine", "Elève : Dupond Albin",
+            "Elève : Hickx Elvire", "Bulletin sans nom",
+        ]
+
+        class FakePopen:
+            """Simulate pdfseparate and pdftotext on a 5-page file."""
+            def __init__(self, args, **kwargs):
+                self.args = args
+
+            def communicate(self):
+                if self.args[0] == 'pdfseparate':
+                    for num in range(1, len(pages) + 1):
+                        with open(self.args[2] % num, 'wb') as fh:
+                            fh.write(b'%%PDF-1.4 page %d' % num)
+                    return b'', b''
+                return '\f'.join(pages).encode('utf-8'), b''
+
+        path = os.path.join(os.path.dirname(__file__), 'test_files', '1ASEFEa.pdf')
+        self.client.login(username='me', password='mepassword')
+        with open(path, 'rb') as fh, mock.patch('stages.views.imports.Popen', FakePopen), \
+                mock.patch('stages.views.imports.call', return_value=0):
+            response = self.client.post(
+                reverse('import-reports', args=[klass.pk]), data={'upload': fh, 'semester': '1'}, follow=True
+            )
+        messages = [str(msg) for msg in response.context['messages']]
+        self.assertEqual(messages, [
+            "Plusieurs étudiants s'appellent Hickx Elvire dans la classe 1ASEFEa",
+            "Impossible de trouver le nom de l'étudiant à la page 5",
+            "2 bulletins PDF ont été importés pour la classe 1ASEFEa (sur 4 élèves)",
+        ])
+        student = Student.objects.get(last_name="Dupond")
+        self.assertEqual(student.report_sem1.name, 'bulletins/1ASEFEa_3.pdf')
+        with student.report_sem1.open('rb') as fh:
+            self.assertEqual(fh.read(), b'%PDF-1.4 page 3')
+
+
+class JobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('me', 'me@example.org', 'mepassword')
+        cls.teacher = Teacher.objects.create(
+            first_name='Jeanne', last_name='Dupond', birth_date='1974-08-08', rate=50.0,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        media_settings = self.settings(MEDIA_ROOT=media_dir.name, PDF_RENDER_PROCESSES=1)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def test_background_export(self):
+        response = self.client.get(reverse('imputations_export'), {'background': 1})
+        job = Job.objects.get()
+        self.assertRedirects(response, reverse('job', args=[job.pk]))
+        self.assertEqual(job.params, {'path': reverse('imputations_export'), 'query': ''})
+        response = self.client.get(reverse('job', args=[job.pk]))
+        self.assertContains(response, "En attente")
+        self.assertEqual(self.client.get(reverse('job-status', args=[job.pk])).json()['status'], 'pending')
+
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(
+            job.result_filename, 'Imputations_export_%s.xlsx' % date.strftime(date.today(), '%Y-%m-%d')
+        )
+        status = self.client.get(reverse('job-status', args=[job.pk])).json()
+        self.assertTrue(status['finished'])
+        self.assertEqual(status['download_url'], reverse('job-download', args=[job.pk]))
+        response = self.client.get(status['download_url'])
+        self.assertEqual(
+            response['Content-Disposition'], 'attachment; filename="%s"' % job.result_filename
+        )
+        load_workbook(BytesIO(b''.join(response.streaming_content)))
+        self.assertContains(self.client.get(reverse('jobs')), job.result_filename)
+
+        # Jobs are only visible by their owner
+        self.client.force_login(User.objects.create_user('other', 'other@example.org', 'otherpassword'))
+        self.assertEqual(self.client.get(reverse('job', args=[job.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('job-download', args=[job.pk])).status_code, 404)
+
+    def test_background_charge_sheet(self):
+        response = self.client.post(reverse('admin:stages_teacher_changelist'), {
+            'action': 'print_charge_sheet_background',
+            '_selected_action': [self.teacher.pk],
+        }, follow=True)
+        job = Job.objects.get()
+        self.assertEqual(response.redirect_chain[-1][0], reverse('job', args=[job.pk]))
+        self.assertEqual(job.params['query'], 'ids=%d' % self.teacher.pk)
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(job.result_filename, 'archive_FeuillesDeCharges.zip')
+        with job.result.open('rb') as fh, zipfile.ZipFile(fh) as archive:
+            self.assertEqual(archive.namelist(), ['dupond_jeanne.pdf'])
+
+    def test_background_failure(self):
+        self.client.get(reverse('print_update_form'), {'background': 1, 'date': 'demain'})
+        run_jobs()
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertEqual(job.message, "La date fournie n'est pas valable")
+        self.assertFalse(job.result)
+
+    def test_background_import(self):
+        path = os.path.join(os.path.dirname(__file__), 'test_files', 'HYPERPLANNING.csv')
+        with open(path, 'rb') as fh:
+            response = self.client.post(reverse('import-hp'), {'upload': fh, 'background': 'on'})
+        job = Job.objects.get()
+        self.assertRedirects(response, reverse('job', args=[job.pk]))
+        self.assertEqual(job.kind, 'import')
+        self.assertEqual(self.teacher.course_set.count(), 0)
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertIn("Objets créés : 13", job.message)
+        self.assertEqual(self.teacher.course_set.count(), 13)
+
+    def test_cleanup(self):
+        now = timezone.now()
+        old_job = Job.objects.create(
+            kind='view', title='Ancien', status=Job.STATUS_DONE, finished=now - timedelta(days=8)
+        )
+        old_job.result.save('ancien.xlsx', ContentFile(b'data'))
+        result_path = old_job.result.path
+        recent_job = Job.objects.create(
+            kind='view', title='Récent', status=Job.STATUS_DONE, finished=now - timedelta(days=1)
+        )
+        stale_job = Job.objects.create(
+            kind='view', title='Interrompu', status=Job.STATUS_RUNNING, started=now - timedelta(days=1),
+            heartbeat=now - timedelta(hours=1),
+        )
+        long_job = Job.objects.create(
+            kind='view', title='Long', status=Job.STATUS_RUNNING, started=now - timedelta(days=1),
+            heartbeat=now - timedelta(seconds=30),
+        )
+        with self.settings(JOB_RETENTION_DAYS=7, JOB_TIMEOUT=600):
+            run_jobs()
+        self.assertFalse(Job.objects.filter(pk=old_job.pk).exists())
+        self.assertFalse(os.path.exists(result_path))
+        self.assertTrue(Job.objects.filter(pk=recent_job.pk).exists())
+        stale_job.refresh_from_db()
+        self.assertEqual(stale_job.status, Job.STATUS_FAILED)
+        # Jobs still running in another worker are kept
+        long_job.refresh_from_db()
+        self.assertEqual(long_job.status, Job.STATUS_RUNNING)
+
+    def test_interrupted_job_status_kept(self):
+        job = enqueue('reaped', "Tâche", user=self.user)
+
+        def reaped(job):
+            # cleanup_jobs running in another worker while the job runs
+            Job.objects.filter(pk=job.pk).update(status=Job.STATUS_FAILED, message="La tâche a été interrompue.")
+
+        with mock.patch.dict(JOB_RUNNERS, {'reaped': reaped}):
+            run_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message), (Job.STATUS_FAILED, "La tâche a été interrompue."))
+
+    def test_background_without_user(self):
+        job = enqueue('view', "Sans utilisateur", path=reverse('print_update_form'), query='date=14.09.2018')
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertIn("pas d'utilisateur", job.message)
+
+
+class MailTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('me', 'me@example.org', 'mepassword')
+        level = Level.objects.create(name='1')
+        cls.klass = Klass.objects.create(
+            name='1ASEFEa', section=Section.objects.create(name='ASE'), level=level
+        )
+        cls.student = Student.objects.create(
+            first_name="Albin", last_name="Dupond", gender='M', email="albin@example.org", klass=cls.klass,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        media_settings = self.settings(MEDIA_ROOT=media_dir.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def test_send_student_reports(self):
+        self.student.report_sem1.save('1ASEFEa_1.pdf', ContentFile(b'%PDF-1.4 bulletin'))
+        send_url = reverse('send-student-reports', args=[self.student.pk, 1])
+        data = self.client.get(send_url).context['form'].initial
+        response = self.client.post(send_url, data=data)
+        self.assertRedirects(response, reverse('class', args=[self.klass.pk]))
+        self.assertEqual(len(mail.outbox), 0)
+        run_jobs()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].attachments, [
+            ('bulletin_scol_dupond-albin.pdf', b'%PDF-1.4 bulletin', 'application/pdf')
+        ])
+        self.student.refresh_from_db()
+        self.assertIsNotNone(self.student.report_sem1_sent)
+        self.assertEqual(self.student.report_sem1_sent, QueuedMail.objects.get().sent)
+        self.assertIsNone(self.student.report_sem2_sent)
+
+    def test_send_klass_reports(self):
+        contact = CorpContact.objects.create(
+            corporation=Corporation.objects.create(name='Crèche Les Lutins', city='Le Locle'),
+            first_name='Jeanne', last_name='Caux', email='jeanne@example.org',
+        )
+        justine = Student.objects.create(
+            first_name="Justine", last_name="Varrin", gender='F', email="justine@example.org",
+            klass=self.klass, instructor=contact, corporation=contact.corporation,
+        )
+        elvire = Student.objects.create(first_name="Elvire", last_name="Hickx", klass=self.klass)
+        zoe = Student.objects.create(
+            first_name="Zoé", last_name="Droz", email="zoe@example.org", klass=self.klass,
+            report_sem1_sent=timezone.now() - timedelta(days=1),
+        )
+        for student in (self.student, justine, zoe):
+            student.report_sem1.save(
+                '1ASEFEa_%d.pdf' % student.pk, ContentFile(b'%PDF-1.4 ' + student.first_name.encode())
+            )
+
+        url = reverse('send-klass-reports', args=[self.klass.pk, 1])
+        response = self.client.get(url)
+        self.assertEqual([st for st, _ in response.context['students']], [self.student, justine])
+        self.assertEqual(response.context['missing'], [elvire])
+        self.assertEqual(response.context['sent'], [zoe])
+        self.assertContains(response, "justine@example.org; jeanne@example.org")
+        self.assertContains(response, "Crèche Les Lutins")
+
+        response = self.client.post(url, data=response.context['form'].initial)
+        job = Job.objects.get()
+        self.assertRedirects(response, reverse('job', args=[job.pk]))
+        self.assertEqual(job.title, "Bulletins du semestre 1 de la classe 1ASEFEa")
+        # A second submit does not queue the reports again
+        response = self.client.get(url)
+        self.assertEqual(response.context['students'], [])
+        self.assertEqual(response.context['queued'], [self.student, justine])
+        self.assertContains(response, "Bulletins en cours d'envoi")
+        response = self.client.post(url, data={'sender': 'me@example.org', 'subject': 'Bulletin'}, follow=True)
+        self.assertContains(response, "Aucun bulletin à envoyer pour la classe 1ASEFEa")
+        self.assertEqual(Job.objects.count(), 1)
+        with mock.patch('stages.mail.get_connection', wraps=get_connection) as connections:
+            run_jobs()
+        self.assertEqual(connections.call_count, 1)
+        self.assertEqual([msg.recipients() for msg in mail.outbox], [
+            ['albin@example.org', 'me@example.org'],
+            ['justine@example.org', 'jeanne@example.org', 'me@example.org'],
+        ])
+        self.assertIn("le bulletin scolaire de Madame Justine Varrin", mail.outbox[1].body)
+        self.assertEqual(
+            mail.outbox[1].attachments[0][:2], ('bulletin_scol_varrin-justine.pdf', b'%PDF-1.4 Justine')
+        )
+        self.assertEqual(Student.objects.filter(klass=self.klass, report_sem1_sent__isnull=False).count(), 3)
+
+        # Nothing left to send
+        response = self.client.post(url, data={'sender': 'me@example.org', 'subject': 'Bulletin'}, follow=True)
+        self.assertContains(response, "Aucun bulletin à envoyer pour la classe 1ASEFEa")
+
+    def test_batch_connection_and_retry(self):
+        job = queue_mails([
+            QueuedMail(
+                subject='Sujet', body='Message', from_email='me@example.org', to='dest%d@example.org' % idx
+            ) for idx in range(3)
+        ], "Envoi groupé", user=self.user)
+        send_messages = LocMemEmailBackend.send_messages
+        calls = []
+
+        def flaky_send(backend, messages):
+            # The second message fails at the first attempt
+            calls.append(messages[0].to)
+            if len(calls) == 2:
+                raise Exception("Serveur indisponible")
+            return send_messages(backend, messages)
+
+        with mock.patch('stages.mail.get_connection', wraps=get_connection) as connections, \
+                mock.patch.object(LocMemEmailBackend, 'send_messages', flaky_send):
+            run_jobs()
+        # One connection for the first attempt, one for the retry
+        self.assertEqual(connections.call_count, 2)
+        self.assertEqual(
+            [msg.to for msg in mail.outbox], [['dest0@example.org'], ['dest2@example.org'], ['dest1@example.org']]
+        )
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(job.message, "Courriels envoyés : 3 sur 3")
+        self.assertEqual(list(job.mails.order_by('pk').values_list('attempts', flat=True)), [1, 2, 1])
+
+    def test_connection_failure(self):
+        job = queue_mails([
+            QueuedMail(
+                subject='Sujet', body='Message', from_email='me@example.org', to='dest%d@example.org' % idx
+            ) for idx in range(2)
+        ], "Envoi groupé", user=self.user)
+        opened = []
+
+        def failing_open(backend):
+            # The server is unreachable at the first attempt
+            opened.append(backend)
+            if len(opened) == 1:
+                raise ConnectionRefusedError("Connexion refusée")
+
+        with mock.patch.object(LocMemEmailBackend, 'open', failing_open):
+            run_jobs()
+        self.assertEqual(len(mail.outbox), 2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(list(job.mails.values_list('status', 'attempts')), [(QueuedMail.STATUS_SENT, 2)] * 2)
+
+        # The server is never reachable
+        job = queue_mails([
+            QueuedMail(subject='Sujet', body='Message', from_email='me@example.org', to='dest@example.org')
+        ], "Envoi groupé", user=self.user)
+        with mock.patch.object(LocMemEmailBackend, 'open', side_effect=ConnectionRefusedError("Connexion refusée")):
+            run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertEqual(
+            list(job.mails.values_list('status', 'attempts', 'error')),
+            [(QueuedMail.STATUS_FAILED, 3, "Connexion au serveur impossible : Connexion refusée")]
+        )
+        self.assertIn("Échec d’envoi pour dest@example.org", job.message)
+
+    @override_settings(MAIL_RETRY_DELAY=60)
+    def test_retry_delayed(self):
+        job = queue_mails([
+            QueuedMail(subject='Sujet', body='Message', from_email='me@example.org', to='dest@example.org')
+        ], "Envoi groupé", user=self.user)
+        with mock.patch.object(LocMemEmailBackend, 'open', side_effect=ConnectionRefusedError("Connexion refusée")), \
+                mock.patch('stages.mail.time.sleep') as sleep:
+            run_jobs()
+        sleep.assert_not_called()
+        # The job is pending again, and not claimed before the retry delay
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_PENDING)
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=50))
+        self.assertIn("Nouvel essai d’envoi pour 1 courriel(s) dans 60 secondes", job.message)
+        self.assertEqual(job.mails.get().attempts, 1)
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_unsent_mails_warning(self):
+        job = queue_mails([
+            QueuedMail(subject='Sujet', body='Message', from_email='me@example.org', to='dest@example.org')
+        ], "Envoi groupé", user=self.user)
+        response = self.client.get(reverse('job', args=[job.pk]))
+        self.assertNotContains(response, "ne semble pas fonctionner")
+        Job.objects.filter(pk=job.pk).update(created=timezone.now() - timedelta(minutes=20))
+        response = self.client.get(reverse('job', args=[job.pk]))
+        self.assertContains(response, "Le service d’envoi (commande run_jobs) ne semble pas fonctionner")
+
+
+class GenerateDataTests(TestCase):
+    def test_generate_data(self):
+        out = StringIO()
+        call_command(
+            'generate_data', students=30, teachers=5, corporations=10, availabilities=5,
+            candidates=5, stdout=out
+        )
+        self.assertEqual(Student.objects.count(), 30)
+        self.assertEqual(Period.objects.count(), 8)
+        self.assertEqual(
+            sum(ReferentLoad.objects.values_list('num_refs', flat=True)), Training.objects.count()
+        )
+        # Can be run several times
+        call_command('generate_data', students=10, corporations=10, seed=1, stdout=out)
+        self.assertEqual(Student.objects.count(), 40)
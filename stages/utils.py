@@ -17,13 +17,13 @@ def school_year(date, as_tuple=False):
         return "%d — %d" % (start_year, start_year + 1)
 
 
-def school_year_start():
-    """ Return first official day of current school year """
-    current_year = date.today().year
-    if date(current_year, 8, 1) > date.today():
-        return date(current_year-1, 8, 1)
+def school_year_start(date_=None):
+    """ Return first official day of current school year (or of date_'s school year) """
+    date_ = date_ or date.today()
+    if date(date_.year, 8, 1) > date_:
+        return date(date_.year - 1, 8, 1)
     else:
-        return date(current_year, 8, 1)
+        return date(date_.year, 8, 1)
 
 
 def is_int(s):
@@ -1,33 +1,40 @@
-import io
+import hashlib
 import json
 import os
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from datetime import date, datetime, timedelta
+from functools import partial
 
+from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth.mixins import PermissionRequiredMixin
-from django.core.mail import EmailMessage
-from django.db.models import Count
-from django.http import FileResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect
+from django.contrib.auth.mixins import PermissionRequiredMixin, UserPassesTestMixin
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Exists, OuterRef, Prefetch
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseRedirect,
+)
 from django.shortcuts import get_object_or_404, redirect
 from django.template import loader
 from django.urls import reverse, reverse_lazy
-from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.utils.dateformat import format as django_format
+from django.utils.http import quote_etag
 from django.utils.text import slugify
+from django.views.decorators.cache import cache_control
 from django.views.generic import DetailView, FormView, ListView, TemplateView, UpdateView
 
+from common.middleware import request_stats
 from .base import EmailConfirmationBaseView, PDFBaseView, ZippedFilesBaseView
 from .export import OpenXMLExport
 from .imports import HPContactsImportView, HPImportView, ImportReportsView, StudentImportView
-from ..forms import CorporationMergeForm, EmailBaseForm, StudentCommentForm
+from ..forms import CorporationMergeForm, EmailBaseForm, KlassReportsForm, StudentCommentForm
+from ..mail import mail_from_form, queue_mails, warn_unsent_mails
 from ..models import (
     Klass, Section, Student, Teacher, Corporation, CorpContact, Period,
-    Training, Availability, Examination,
+    Training, Availability, Examination, ReferentLoad, QueuedMail,
 )
 from .. import pdf
-from ..utils import school_year_start
 
 
 class CorporationListView(ListView):
@@ -43,28 +50,43 @@ class CorporationView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # Create a structure like:
-        #   {'2011-2012': {'avails': [avail1, avail2, ...], 'stats': {'fil': num}},
-        #    '2012-2013': ...}
-        school_years = OrderedDict()
-        for av in Availability.objects.filter(corporation=self.object
-                ).select_related('training__student__klass', 'period__section'
-                ).order_by('period__start_date'):
-            if av.period.school_year not in school_years:
-                school_years[av.period.school_year] = {'avails': [], 'stats': {}}
-            school_years[av.period.school_year]['avails'].append(av)
-            if av.period.section.name not in school_years[av.period.school_year]['stats']:
-                school_years[av.period.school_year]['stats'][av.period.section.name] = 0
-            try:
-                av.training
-                # Only add to stats if training exists
-                school_years[av.period.school_year]['stats'][av.period.section.name] += av.period.weeks
-            except Training.DoesNotExist:
-                pass
-
+        #   {'2011 — 2012': {'year': 2011, 'stats': {'fil': num}, 'avails': None},
+        #    '2012 — 2013': ...}
+        # Availabilities are only loaded for the last year, others are loaded on demand.
+        school_years = OrderedDict(
+            (year, {'year': int(year[:4]), 'stats': stats, 'avails': None})
+            for year, stats in self.object.school_year_stats().items()
+        )
+        if school_years:
+            last_year = next(reversed(school_years.values()))
+            last_year['avails'] = CorporationAvailabilitiesView.get_availabilities(self.object, last_year['year'])
         context['years'] = school_years
         return context
 
 
+class CorporationAvailabilitiesView(DetailView):
+    """ Availabilities of a corporation for the school year starting on `year` (HTML fragment) """
+    model = Corporation
+    template_name = 'corporation_avails.html'
+    context_object_name = 'corp'
+
+    @staticmethod
+    def get_availabilities(corp, year):
+        return Availability.objects.filter(
+            corporation=corp,
+            period__start_date__gte=date(year, 7, 1), period__start_date__lt=date(year + 1, 7, 1),
+        ).select_related('training__student__klass', 'period__section').order_by('period__start_date')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        try:
+            year = int(self.request.GET['year'])
+        except (KeyError, ValueError):
+            raise Http404("Année scolaire non valide")
+        context['avails'] = self.get_availabilities(self.object, year)
+        return context
+
+
 class CorporationMergeView(FormView):
     form_class = CorporationMergeForm
     template_name = 'corporation_merge.html'
@@ -99,8 +121,13 @@ class KlassView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context.update({
-            'students': self.object.student_set.filter(archived=False
-                ).prefetch_related('training_set').order_by('last_name', 'first_name'),
+            'students': self.object.student_set.filter(archived=False).select_related(
+                'corporation', 'option_ase'
+            ).prefetch_related(Prefetch(
+                'training_set', queryset=Training.objects.select_related(
+                    'availability__period', 'availability__corporation', 'availability__domain'
+                )
+            )).order_by('last_name', 'first_name'),
             'show_option_ase': self.object.section.name.endswith('ASE'),
             'show_pp': self.object.section.has_stages,
             'show_employeur': not self.object.section.is_ESTER,
@@ -138,9 +165,7 @@ class KlassView(DetailView):
                     if student.corporation else ''
                 )
             if context['show_pp']:
-                for training in student.training_set.select_related(
-                            'availability', 'availability__corporation', 'availability__domain'
-                        ).all():
+                for training in student.training_set.all():
                     values.append(training.availability.corporation.name)
                     values.append(training.availability.domain.name)
             export.write_line(values)
@@ -175,6 +200,7 @@ class AttributionView(TemplateView):
       * corp. availabilities for current period: period_availabilities
       * already planned training for current period: TrainingsByPeriodView
       * student list targetted by current period: period_students
+    (those period data are also available in one request: period_bootstrap)
     When an availability is chosen:
       * corp. contact list: CorpContactJSONView
     When a student is chosen;
@@ -185,13 +211,10 @@ class AttributionView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # Need 2 queries, because referents with no training item would not appear in the second query
         referents = Teacher.objects.filter(archived=False).order_by('last_name', 'first_name')
 
         # Populate each referent with the number of referencies done during the current school year
-        ref_counts = dict([(ref.id, ref.num_refs)
-                for ref in Teacher.objects.filter(archived=False, training__availability__period__end_date__gte=school_year_start()
-                ).annotate(num_refs=Count('training'))])
+        ref_counts = ReferentLoad.current_counts()
         for ref in referents:
             ref.num_refs = ref_counts.get(ref.id, 0)
 
@@ -266,32 +289,135 @@ def section_classes(request, pk):
     return HttpResponse(json.dumps(classes), content_type="application/json")
 
 
-def period_students(request, pk):
-    """
-    Return all active students from period's section and level,
-    with corresponding Training if existing (JSON)
-    """
-    period = get_object_or_404(Period, pk=pk)
+def _period_students(period, ids=None):
     students = Student.objects.filter(
-        archived=False, klass__section=period.section, klass__level=period.relative_level
-        ).order_by('last_name')
-    trainings = dict((t.student_id, t.id) for t in Training.objects.filter(availability__period=period))
-    data = [{
+        archived=False, klass__section=period.section_id, klass__level__name=period.relative_level_name
+        ).select_related('klass').order_by('last_name')
+    trainings = Training.objects.filter(availability__period=period)
+    if ids is not None:
+        students = students.filter(pk__in=ids)
+        trainings = trainings.filter(student__in=ids)
+    trainings = dict(trainings.values_list('student_id', 'id'))
+    return [{
         'name': str(s),
         'id': s.id,
         'training_id': trainings.get(s.id),
         'klass': s.klass.name} for s in students]
-    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def _period_availabilities(period, ids=None):
+    availabilities = period.availability_set.select_related('corporation', 'domain').annotate(
+        is_free=~Exists(Training.objects.filter(availability=OuterRef('pk')))
+    )
+    if ids is not None:
+        availabilities = availabilities.filter(pk__in=ids)
+    # Sorting by the boolean priority is first with PostgreSQL, last with SQLite :-/
+    return [{'id': av.id, 'id_corp': av.corporation.id, 'corp_name': av.corporation.name,
+             'domain': av.domain.name, 'free': av.is_free, 'priority': av.priority}
+            for av in availabilities.order_by('-priority', 'corporation__name')]
+
+
+def _period_trainings(period, avail_ids=None):
+    trainings = Training.objects.filter(availability__period=period).select_related(
+        'student__klass', 'availability__corporation', 'availability__domain', 'referent'
+    ).order_by('student__last_name', 'student__first_name')
+    if avail_ids is not None:
+        trainings = trainings.filter(availability__in=avail_ids)
+    return [{
+        'id': tr.id,
+        'student_id': tr.student_id,
+        'student': str(tr.student),
+        'klass': tr.student.klass.name if tr.student.klass else '',
+        'avail_id': tr.availability_id,
+        'corp_name': tr.availability.corporation.name,
+        'domain': tr.availability.domain.name,
+        'referent_id': tr.referent_id,
+        'referent': str(tr.referent) if tr.referent else '',
+    } for tr in trainings]
+
+
+def period_students(request, pk):
+    """
+    Return all active students from period's section and level,
+    with corresponding Training if existing (JSON)
+    """
+    period = get_object_or_404(Period.objects.select_related('level'), pk=pk)
+    return HttpResponse(json.dumps(_period_students(period)), content_type="application/json")
 
 def period_availabilities(request, pk):
     """ Return all availabilities in the specified period """
     period = get_object_or_404(Period, pk=pk)
-    # Sorting by the boolean priority is first with PostgreSQL, last with SQLite :-/
-    corps = [{'id': av.id, 'id_corp': av.corporation.id, 'corp_name': av.corporation.name,
-              'domain': av.domain.name, 'free': av.free, 'priority': av.priority}
-             for av in period.availability_set.select_related('corporation').all(
-                                             ).order_by('-priority', 'corporation__name')]
-    return HttpResponse(json.dumps(corps), content_type="application/json")
+    return HttpResponse(json.dumps(_period_availabilities(period)), content_type="application/json")
+
+@cache_control(private=True, no_cache=True)
+def period_bootstrap(request, pk):
+    """
+    Return availabilities, students, trainings and corporation contacts of a
+    period in one payload (JSON). The ETag is a hash of the payload, as it
+    depends on data (students, contacts, current date) not covered by the
+    period version.
+    """
+    period = get_object_or_404(Period.objects.select_related('level'), pk=pk)
+    contacts = defaultdict(list)
+    for contact in CorpContact.objects.filter(
+            corporation__availability__period=period, archived=False).distinct().order_by('pk'):
+        contacts[contact.corporation_id].append(
+            {field: getattr(contact, field) for field in CorpContactJSONView.return_fields}
+        )
+    data = {
+        'version': period.version,
+        'availabilities': _period_availabilities(period),
+        'students': _period_students(period),
+        'trainings': _period_trainings(period),
+        'contacts': contacts,
+    }
+    content = json.dumps(data).encode()
+    response = HttpResponse(content, content_type="application/json")
+    response['ETag'] = quote_etag(hashlib.sha256(content).hexdigest()[:32])
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+def period_changes(request, pk):
+    """
+    Return availabilities, trainings and students of a period which changed
+    since the `since` version (JSON). Deleted availabilities and students no
+    longer part of the period are listed in `deleted_availabilities` and
+    `deleted_students`. `reload` is true when the changes since that
+    version are no longer all logged (pruned), then the whole period must be
+    loaded again.
+    """
+    period = get_object_or_404(Period.objects.select_related('level'), pk=pk)
+    try:
+        since = int(request.GET['since'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("Le paramètre «since» est obligatoire")
+    avail_ids, student_ids = set(), set()
+    first_version = None
+    for version, avail_id, student_id in period.availabilitychange_set.filter(
+            version__gt=since, version__lte=period.version).values_list('version', 'availability_id', 'student_id'):
+        first_version = version if first_version is None else min(first_version, version)
+        avail_ids.add(avail_id)
+        if student_id is not None:
+            student_ids.add(student_id)
+    if since < period.version and (first_version is None or first_version > since + 1):
+        # Some versions (pruned changes) are missing from the log
+        return HttpResponse(json.dumps({'version': period.version, 'reload': True}),
+                            content_type="application/json")
+    availabilities = _period_availabilities(period, ids=avail_ids) if avail_ids else []
+    students = _period_students(period, ids=student_ids) if student_ids else []
+    data = {
+        'version': period.version,
+        'reload': False,
+        'availabilities': availabilities,
+        'deleted_availabilities': sorted(avail_ids - {av['id'] for av in availabilities}),
+        'trainings': _period_trainings(period, avail_ids=avail_ids) if avail_ids else [],
+        'students': students,
+        'deleted_students': sorted(student_ids - {st['id'] for st in students}),
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+def referent_counts(request):
+    """ Return the number of referencies of each teacher for the current school year (JSON) """
+    return HttpResponse(json.dumps(ReferentLoad.current_counts()), content_type="application/json")
 
 def new_training(request):
     if request.method != 'POST':
@@ -324,6 +450,28 @@ def del_training(request):
     return HttpResponse(json.dumps({'ref_id': ref_id}), content_type="application/json")
 
 
+def report_recipients(student):
+    to = [student.email] if student.email else []
+    if student.instructor and student.instructor.email:
+        to.append(student.instructor.email)
+    return '; '.join(to)
+
+
+def report_mail(student, semestre, data):
+    """
+    Return an unsaved QueuedMail sending the semester report of student, from
+    EmailBaseForm-like data.
+    """
+    student_filename = slugify('{0} {1}'.format(student.last_name, student.first_name))
+    return mail_from_form(
+        data, target=student, sent_field='report_sem%d_sent' % semestre,
+        description="l'étudiant {0}".format(student),
+        # The PDF file is read when the message is sent
+        attachment=getattr(student, 'report_sem%d' % semestre).name,
+        attachment_name='bulletin_scol_{0}.pdf'.format(student_filename),
+    )
+
+
 class SendStudentReportsView(FormView):
     template_name = 'email_report.html'
     form_class = EmailBaseForm
@@ -333,10 +481,6 @@ class SendStudentReportsView(FormView):
         self.student = Student.objects.get(pk=self.kwargs['pk'])
         self.semestre = self.kwargs['semestre']
 
-        to = [self.student.email]
-        if self.student.instructor and self.student.instructor.email:
-            to.append(self.student.instructor.email)
-
         context = {
             'student': self.student,
             'sender': self.request.user,
@@ -344,7 +488,7 @@ class SendStudentReportsView(FormView):
 
         initial.update({
             'cci': self.request.user.email,
-            'to': '; '.join(to),
+            'to': report_recipients(self.student),
             'subject': "Bulletin semestriel",
             'message': loader.render_to_string('email/bulletins_scolaires.txt', context),
             'sender': self.request.user.email,
@@ -352,29 +496,10 @@ class SendStudentReportsView(FormView):
         return initial
 
     def form_valid(self, form):
-        email = EmailMessage(
-            subject=form.cleaned_data['subject'],
-            body=form.cleaned_data['message'],
-            from_email=form.cleaned_data['sender'],
-            to=form.cleaned_data['to'].split(';'),
-            bcc=form.cleaned_data['cci'].split(';'),
-        )
-        # Attach PDF file to email
-        student_filename = slugify('{0} {1}'.format(self.student.last_name, self.student.first_name))
-        student_filename = '{0}.pdf'.format(student_filename)
-        # pdf_file = os.path.join(dir_klass, pdf_file_list[attach_idx])
-        pdf_name = 'bulletin_scol_{0}'.format(student_filename)
-        with open(getattr(self.student, 'report_sem%d' % self.semestre).path, 'rb') as pdf:
-            email.attach(pdf_name, pdf.read(), 'application/pdf')
-
-        try:
-            email.send()
-        except Exception as err:
-            messages.error(self.request, "Échec d’envoi pour l'étudiant {0} ({1})".format(self.student, err))
-        else:
-            setattr(self.student, 'report_sem%d_sent' % self.semestre, timezone.now())
-            self.student.save()
-            messages.success(self.request, "Le message a été envoyé.")
+        mail = report_mail(self.student, self.semestre, form.cleaned_data)
+        queue_mails([mail], "Envoi du bulletin semestriel", user=self.request.user)
+        messages.success(self.request, "Le message a été placé dans la file d’envoi.")
+        warn_unsent_mails(self.request)
         return HttpResponseRedirect(reverse('class', args=[self.student.klass.pk]))
 
     def get_context_data(self, **kwargs):
@@ -387,14 +512,98 @@ class SendStudentReportsView(FormView):
         return context
 
 
+class SendKlassReportsView(FormView):
+    """
+    Send the semester reports (imported by ImportReportsView) of all students
+    of a class, in a single background mail job.
+    """
+    template_name = 'klass_reports.html'
+    form_class = KlassReportsForm
+
+    def dispatch(self, request, *args, **kwargs):
+        self.klass = get_object_or_404(Klass, pk=kwargs['pk'])
+        self.semestre = kwargs['semestre']
+        if self.semestre not in (1, 2):
+            raise Http404("Semestre inconnu")
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_students(self):
+        """
+        Return (students to send, students without report or address, students
+        whose report was already sent, students whose report is waiting in
+        the mail queue).
+        """
+        to_send, missing, sent, queued = [], [], [], []
+        students = self.klass.student_set.filter(archived=False).select_related(
+            'instructor', 'corporation'
+        ).order_by('last_name', 'first_name')
+        queued_ids = set(QueuedMail.objects.filter(
+            target_type=ContentType.objects.get_for_model(Student),
+            target_id__in=students.values('pk'),
+            sent_field='report_sem%d_sent' % self.semestre,
+            status=QueuedMail.STATUS_PENDING,
+        ).values_list('target_id', flat=True))
+        for student in students:
+            if getattr(student, 'report_sem%d_sent' % self.semestre):
+                sent.append(student)
+            elif student.pk in queued_ids:
+                queued.append(student)
+            elif not getattr(student, 'report_sem%d' % self.semestre) or not report_recipients(student):
+                missing.append(student)
+            else:
+                to_send.append(student)
+        return to_send, missing, sent, queued
+
+    def get_initial(self):
+        return {
+            **super().get_initial(),
+            'cci': self.request.user.email,
+            'subject': "Bulletin semestriel",
+            'sender': self.request.user.email,
+        }
+
+    def form_valid(self, form):
+        template = loader.get_template('email/bulletins_scolaires.txt')
+        mails = [
+            report_mail(student, self.semestre, {
+                **form.cleaned_data,
+                'to': report_recipients(student),
+                'message': template.render({'student': student, 'sender': self.request.user}),
+            })
+            for student in self.get_students()[0]
+        ]
+        if not mails:
+            messages.warning(self.request, "Aucun bulletin à envoyer pour la classe {0}".format(self.klass.name))
+            return HttpResponseRedirect(reverse('class', args=[self.klass.pk]))
+        job = queue_mails(
+            mails, "Bulletins du semestre {0} de la classe {1}".format(self.semestre, self.klass.name),
+            user=self.request.user,
+        )
+        warn_unsent_mails(self.request)
+        return HttpResponseRedirect(reverse('job', args=[job.pk]))
+
+    def get_context_data(self, **kwargs):
+        to_send, missing, sent, queued = self.get_students()
+        return {
+            **super().get_context_data(**kwargs),
+            'title': "Envoi des bulletins du semestre {0}".format(self.semestre),
+            'klass': self.klass,
+            'semestre': self.semestre,
+            'students': [(student, report_recipients(student)) for student in to_send],
+            'missing': missing,
+            'sent': sent,
+            'queued': queued,
+        }
+
+
 class EmailConfirmationView(EmailConfirmationBaseView):
     person_model = Student
     success_url = reverse_lazy('admin:stages_student_changelist')
-    error_message = "Échec d’envoi pour l’étudiant {person} ({err})"
+    person_description = "l’étudiant {person}"
 
 
 class StudentConvocationExaminationView(EmailConfirmationView):
-    success_message = "Le message de convocation a été envoyé pour l’étudiant {person}"
+    queued_message = "Le message de convocation pour l’étudiant {person} a été placé dans la file d’envoi"
     title = "Convocation à la soutenance du travail de diplôme"
     email_template = 'email/student_convocation_EDE.txt'
 
@@ -470,9 +679,8 @@ class StudentConvocationExaminationView(EmailConfirmationView):
         })
         return initial
 
-    def on_success(self, student):
-        self.exam.date_soutenance_mailed = timezone.now()
-        self.exam.save()
+    def sent_target(self, student):
+        return self.exam, 'date_soutenance_mailed'
 
 
 class StudentConvocationEDSView(StudentConvocationExaminationView):
@@ -480,6 +688,17 @@ class StudentConvocationEDSView(StudentConvocationExaminationView):
     email_template = 'email/student_convocation_EDS.txt'
 
 
+def active_students_prefetch():
+    """Prefetch active students of classes with the relations used in PDF documents."""
+    return Prefetch(
+        'student_set',
+        queryset=Student.objects.filter(archived=False).select_related(
+            'klass', 'corporation', 'instructor__corporation'
+        ).order_by('last_name', 'first_name'),
+        to_attr='active_students'
+    )
+
+
 class PrintUpdateForm(ZippedFilesBaseView):
     """
     PDF form to update personal data
@@ -494,13 +713,14 @@ class PrintUpdateForm(ZippedFilesBaseView):
             return HttpResponseRedirect(request.META.get('HTTP_REFERER', '/'))
         return super().get(request, *args, **kwargs)
 
-    def generate_files(self):
+    def get_jobs(self):
         for klass in Klass.objects.filter(level__gte=2
-                ).exclude(section__name='MP_ASSC').exclude(section__name='MP_ASE'):
-            buff = io.BytesIO()
-            pdf_doc = pdf.UpdateDataFormPDF(buff, self.return_date)
-            pdf_doc.produce(klass)
-            yield ('{0}.pdf'.format(klass.name), buff.getvalue())
+                ).exclude(section__name='MP_ASSC').exclude(section__name='MP_ASE'
+                ).prefetch_related(active_students_prefetch()):
+            yield (
+                '{0}.pdf'.format(klass.name),
+                partial(pdf.render_pdf, pdf.UpdateDataFormPDF, (self.return_date,), (klass,))
+            )
 
 
 class PrintExpertEDECompensationForm(PDFBaseView):
@@ -606,13 +826,10 @@ class PrintExpertEDSCompensationForm(PrintExpertEDECompensationForm):
 class PrintKlassList(ZippedFilesBaseView):
     filename = 'archive_RolesDeClasses.zip'
 
-    def generate_files(self):
-        for klass in Klass.active.order_by('section', 'name'):
-            buff = io.BytesIO()
-            pdf_doc = pdf.KlassListPDF(buff, klass)
-            pdf_doc.produce(klass)
+    def get_jobs(self):
+        for klass in Klass.active.order_by('section', 'name').prefetch_related(active_students_prefetch()):
             filename = slugify(klass.name + '.pdf')
-            yield (filename, buff.getvalue())
+            yield (filename, partial(pdf.render_pdf, pdf.KlassListPDF, (klass,), (klass,)))
 
 
 class PrintChargeSheet(ZippedFilesBaseView):
@@ -622,12 +839,28 @@ class PrintChargeSheet(ZippedFilesBaseView):
     """
     filename = 'archive_FeuillesDeCharges.zip'
 
-    def generate_files(self):
-        queryset = Teacher.objects.filter(pk__in=self.request.GET.get('ids').split(','))
-        for teacher in queryset:
-            activities = teacher.calc_activity()
-            buff = io.BytesIO()
-            pdf_doc = pdf.ChargeSheetPDF(buff, teacher)
-            pdf_doc.produce(activities)
+    def get_jobs(self):
+        queryset = Teacher.objects.filter(pk__in=self.request.GET.get('ids').split(',')).with_mandats()
+        for teacher, activities in queryset.calc_activities():
             filename = slugify('{0}_{1}'.format(teacher.last_name, teacher.first_name)) + '.pdf'
-            yield (filename, buff.getvalue())
+            yield (filename, partial(pdf.render_pdf, pdf.ChargeSheetPDF, (teacher,), (activities,)))
+
+
+class InstrumentationView(UserPassesTestMixin, TemplateView):
+    """ Display request measures of InstrumentationMiddleware (superusers only) """
+    template_name = 'instrumentation.html'
+
+    def test_func(self):
+        return self.request.user.is_superuser
+
+    def post(self, request, *args, **kwargs):
+        request_stats.clear()
+        return HttpResponseRedirect(reverse('instrumentation'))
+
+    def get_context_data(self, **kwargs):
+        return {
+            **super().get_context_data(**kwargs),
+            'title': "Mesures des requêtes",
+            'enabled': getattr(settings, 'INSTRUMENTATION', False),
+            'stats': request_stats.summary(),
+        }
@@ -2,14 +2,19 @@ import io
 import os
 import tempfile
 import zipfile
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
 
+from django.conf import settings
 from django.contrib import messages
-from django.core.mail import EmailMessage
-from django.http import FileResponse, HttpResponse
+from django.http import FileResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
+from django.utils import translation
 from django.views.generic import FormView, View
 
+from stages import render_pool
 from stages.forms import EmailBaseForm
+from stages.mail import mail_from_form, queue_mails, warn_unsent_mails
 
 
 class EmailConfirmationBaseView(FormView):
@@ -18,33 +23,31 @@ class EmailConfirmationBaseView(FormView):
     title = ''
     person_model = None  # To be defined on subclasses
     success_url = reverse_lazy('admin:candidats_candidate_changelist')
-    success_message = "Le message a été envoyé pour {person}"
-    error_message = "Échec d’envoi pour {person} ({err})"
+    queued_message = "Le message pour {person} a été placé dans la file d’envoi"
+    # Person description in the sending report
+    person_description = "{person}"
 
     def get_person(self):
         return self.person_model.objects.get(pk=self.kwargs['pk'])
 
     def form_valid(self, form):
-        email = EmailMessage(
-            subject=form.cleaned_data['subject'],
-            body=form.cleaned_data['message'],
-            from_email=form.cleaned_data['sender'],
-            to=form.cleaned_data['to'].split(';'),
-            bcc=form.cleaned_data['cci'].split(';'),
-        )
         person = self.get_person()
-        try:
-            email.send()
-        except Exception as err:
-            messages.error(self.request, self.error_message.format(person=person, err=err))
-        else:
-            self.on_success(person)
-            messages.success(self.request, self.success_message.format(person=person))
+        target, sent_field = self.sent_target(person)
+        mail = mail_from_form(
+            form.cleaned_data, target=target, sent_field=sent_field,
+            description=self.person_description.format(person=person),
+        )
+        queue_mails([mail], self.title or form.cleaned_data['subject'], user=self.request.user)
+        messages.success(self.request, self.queued_message.format(person=person))
+        warn_unsent_mails(self.request)
         return super().form_valid(form)
 
-    def on_success(self, person):
-        """Operation to apply if message is successfully sent."""
-        raise NotImplementedError("You should define an on_success method in your view")
+    def sent_target(self, person):
+        """
+        Return the (object, datetime field name) to set when the message is
+        successfully sent.
+        """
+        raise NotImplementedError("You should define a sent_target method in your view")
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -55,33 +58,196 @@ class EmailConfirmationBaseView(FormView):
         return context
 
 
+class PDFCache:
+    """
+    Content-addressed cache of generated PDF files on disk. When the cache
+    grows over `max_size` bytes, the least recently used files are removed.
+    """
+    # Running size of each cache directory in this process. Files written by
+    # other processes are counted again at the next eviction.
+    _sizes = {}
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pdf')
+
+    def open(self, key):
+        """Return the cached file for key opened for reading, or None."""
+        path = self.path(key)
+        try:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            # The modification time is the last access time for eviction.
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return fh
+
+    def set(self, key, data):
+        """Store data for key, evicting old files only when over max_size."""
+        if self.directory not in self._sizes:
+            self._sizes[self.directory] = sum(size for _, size, _ in self._files())
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        # Write to a temporary file first, so that a partial file is never served.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        self._sizes[self.directory] += len(data) - old_size
+        if self._sizes[self.directory] > self.max_size:
+            self.evict()
+
+    def _files(self):
+        """Return (mtime, size, path) of cached files."""
+        files = []
+        for dir_path, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if file_name.endswith('.pdf'):
+                    try:
+                        stat = os.stat(os.path.join(dir_path, file_name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(dir_path, file_name)))
+        return files
+
+    def evict(self):
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._sizes[self.directory] = total
+
+
 class PDFBaseView(View):
+    """
+    Return the PDF document produced by pdf_class for the view object. Documents
+    are cached on disk (settings.PDF_CACHE_DIR) when pdf_class provides a cache
+    key (see EpcBaseDocTemplate.cache_key).
+    """
     pdf_class = None
 
     def get(self, request, *args, **kwargs):
         obj = self.get_object()
         buff = io.BytesIO()
         pdf = self.pdf_class(buff, obj)
+        max_size = getattr(settings, 'PDF_CACHE_MAX_SIZE', 0)
+        key = pdf.cache_key() if max_size else None
+        if key is not None:
+            cache = PDFCache(settings.PDF_CACHE_DIR, max_size)
+            cached = cache.open(key)
+            if cached is not None:
+                return FileResponse(cached, as_attachment=True, filename=self.filename(obj))
         pdf.produce()
+        if key is not None:
+            cache.set(key, buff.getvalue())
         buff.seek(0)
         return FileResponse(buff, as_attachment=True, filename=self.filename(obj))
 
 
+class ZipStream(io.RawIOBase):
+    """
+    Unseekable file-like object collecting data written by zipfile.ZipFile,
+    so that compressed data can be sent as soon as each file is added.
+    """
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files):
+    """Generator yielding zip archive chunks from (file_name, file_data) tuples."""
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED) as filezip:
+        for file_name, file_data in files:
+            filezip.writestr(file_name, file_data)
+            yield stream.pop()
+    # Central directory
+    yield stream.pop()
+
+
 class ZippedFilesBaseView(View):
-    """A base class to return a .zip file containing a compressed list of files."""
+    """
+    A base class to return a .zip file containing a compressed list of files.
+    File contents are rendered in a shared pool of settings.PDF_RENDER_PROCESSES
+    processes when there are several files to produce, and the archive is
+    streamed to the client as each file is added.
+    """
     filename = 'to_be_defined.zip'
 
-    def generate_files(self):
-        """Generator yielding (file_name, file_data) tuples."""
+    def get_jobs(self):
+        """
+        Return an iterable of (file_name, render) tuples, render being a
+        picklable callable returning the file data. As it may be run in another
+        process, render must not access the database (prefetch all data).
+        """
         raise NotImplementedError()
 
-    def get(self, request, *args, **kwargs):
-        tmp_file = tempfile.NamedTemporaryFile()
-        with zipfile.ZipFile(tmp_file, mode='w', compression=zipfile.ZIP_DEFLATED) as filezip:
-            for file_name, file_data in self.generate_files():
-                filezip.writestr(file_name, file_data)
+    def generate_files(self, jobs, processes=1):
+        """
+        Generator yielding (file_name, file_data) tuples, in job order, rendered
+        by `processes` processes.
+        """
+        if processes < 2 or len(jobs) < 2:
+            for file_name, render in jobs:
+                yield (file_name, render())
+            return
+        pool = render_pool.get_pool(processes)
+        language = translation.get_language()
+        # Only a few files are rendered ahead of the (slower) streaming, so
+        # that rendered files do not pile up in memory.
+        pending = deque()
+        try:
+            for file_name, render in jobs:
+                pending.append((file_name, pool.submit(render_pool.render, render, language)))
+                if len(pending) >= processes * 2:
+                    file_name, future = pending.popleft()
+                    yield (file_name, future.result())
+            while pending:
+                file_name, future = pending.popleft()
+                yield (file_name, future.result())
+        except BrokenProcessPool:
+            # A worker died, a new pool is created for the next request
+            render_pool.reset_pool()
+            raise
+        finally:
+            # Do not render remaining files if the client went away.
+            for _, future in pending:
+                future.cancel()
 
-        with open(filezip.filename, mode='rb') as fh:
-            response = HttpResponse(fh.read(), content_type='application/zip')
+    def get(self, request, *args, **kwargs):
+        # Database queries happen here, only rendering is deferred to streaming.
+        jobs = list(self.get_jobs())
+        processes = getattr(settings, 'PDF_RENDER_PROCESSES', 1)
+        response = StreamingHttpResponse(
+            stream_zip(self.generate_files(jobs, processes)), content_type='application/zip'
+        )
         response['Content-Disposition'] = 'attachment; filename="%s"' % self.filename
         return response
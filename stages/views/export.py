@@ -1,18 +1,19 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from datetime import date
 from tempfile import NamedTemporaryFile
 
 from django.conf import settings
-from django.db.models import Q, Sum
-from django.http import HttpResponse
+from django.db.models import Prefetch, Q, Sum
+from django.http import FileResponse
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 
 from ..models import (
-    Availability, CorpContact, Corporation, Course, Klass, Section, Student,
-    Teacher, Training,
+    Availability, CorpContact, Corporation, Course, Examination, Klass, Section,
+    Student, Teacher, Training,
 )
 from ..utils import school_year_start
 
@@ -20,37 +21,40 @@ openxml_contenttype = 'application/vnd.openxmlformats-officedocument.spreadsheet
 
 
 class OpenXMLExport:
+    """
+    Excel export built on an openpyxl write-only worksheet: lines are
+    serialized to disk as soon as they are written, so memory usage does not
+    grow with the number of exported lines.
+    """
     def __init__(self, sheet_title):
-        self.wb = Workbook()
-        self.ws = self.wb.active
-        self.ws.title = sheet_title
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(title=sheet_title)
         self.bold = Font(bold=True)
         self.row_idx = 1
 
     def write_line(self, values, bold=False, col_widths=()):
-        for col_idx, value in enumerate(values, start=1):
-            cell = self.ws.cell(row=self.row_idx, column=col_idx)
-            try:
-                cell.value = value
-            except KeyError:
-                # Ugly workaround for https://bugs.python.org/issue28969
-                from openpyxl.utils.datetime import to_excel
-                to_excel.cache_clear()
-                cell.value = value
-            if bold:
-                cell.font = self.bold
-            if col_widths:
-                self.ws.column_dimensions[get_column_letter(col_idx)].width = col_widths[col_idx - 1]
+        # Column widths can only be set before the first line is written.
+        for col_idx, width in enumerate(col_widths, start=1):
+            self.ws.column_dimensions[get_column_letter(col_idx)].width = width
+        if bold:
+            values = [self._bold_cell(value) for value in values]
+        self.ws.append(list(values))
         self.row_idx += 1
 
+    def _bold_cell(self, value):
+        cell = WriteOnlyCell(self.ws, value=value)
+        cell.font = self.bold
+        return cell
+
     def get_http_response(self, filename_base):
-        with NamedTemporaryFile() as tmp:
-            self.wb.save(tmp.name)
-            tmp.seek(0)
-            response = HttpResponse(tmp, content_type=openxml_contenttype)
-            response['Content-Disposition'] = 'attachment; filename=%s_%s.xlsx' % (
-                filename_base, date.strftime(date.today(), '%Y-%m-%d')
-            )
+        # The temporary file is deleted when the response closes it.
+        tmp = NamedTemporaryFile(suffix='.xlsx')
+        self.wb.save(tmp)
+        tmp.seek(0)
+        response = FileResponse(tmp, content_type=openxml_contenttype)
+        response['Content-Disposition'] = 'attachment; filename=%s_%s.xlsx' % (
+            filename_base, date.strftime(date.today(), '%Y-%m-%d')
+        )
         return response
 
 
@@ -114,13 +118,37 @@ NON_ATTR_EXPORT_FIELDS = [
 ]
 
 
+def _default_contacts(corporations):
+    """
+    Return a tuple of two dicts keyed by (corporation id, section name):
+      * the default contact (used when no contact is defined on the availability)
+      * the list of contacts which should always be in copy.
+    Only contacts from `corporations` (a queryset of corporation ids) are loaded.
+    """
+    section_names = list(Section.objects.values_list('name', flat=True))
+    default_contacts = {}
+    always_ccs = defaultdict(list)
+    for contact in CorpContact.objects.filter(corporation__in=corporations
+            ).prefetch_related('sections').order_by('corporation', 'pk'):
+        for section in contact.sections.all():
+            key = (contact.corporation_id, section.name)
+            if key not in default_contacts or contact.is_main is True:
+                default_contacts[key] = contact
+            if contact.always_cc:
+                always_ccs[key].append(contact)
+        if contact.is_main:
+            for sname in section_names:
+                default_contacts.setdefault((contact.corporation_id, sname), contact)
+    return default_contacts, always_ccs
+
+
 def stages_export(request, scope=None):
     period_filter = request.GET.get('period')
     non_attributed = bool(int(request.GET.get('non_attr', 0)))
 
     export_fields = OrderedDict(EXPORT_FIELDS)
     contact_test_field = 'availability__contact__last_name'
-    corp_name_field = 'availability__corporation__name'
+    corp_id_field = 'availability__corporation_id'
 
     if period_filter:
         if non_attributed:
@@ -128,7 +156,7 @@ def stages_export(request, scope=None):
             query = Availability.objects.filter(period_id=period_filter, training__isnull=True)
             export_fields = OrderedDict(NON_ATTR_EXPORT_FIELDS)
             contact_test_field = 'contact__last_name'
-            corp_name_field = 'corporation__name'
+            corp_id_field = 'corporation_id'
         else:
             # Export trainings for a specific period
             query = Training.objects.filter(availability__period_id=period_filter)
@@ -140,71 +168,52 @@ def stages_export(request, scope=None):
             query = Training.objects.filter(availability__period__end_date__gt=school_year_start())
 
     # Prepare "default" contacts (when not defined on training)
-    section_names = Section.objects.all().values_list('name', flat=True)
-    default_contacts = dict(
-        (c, {s: '' for s in section_names})
-        for c in Corporation.objects.all().values_list('name', flat=True)
-    )
-    always_ccs = dict(
-        (c, {s: [] for s in section_names})
-        for c in Corporation.objects.all().values_list('name', flat=True)
-    )
-    for contact in CorpContact.objects.filter(corporation__isnull=False
-            ).select_related('corporation'
-            ).prefetch_related('sections').order_by('corporation'):
-        for section in contact.sections.all():
-            if not default_contacts[contact.corporation.name][section.name] or contact.is_main is True:
-                default_contacts[contact.corporation.name][section.name] = contact
-            if contact.always_cc:
-                always_ccs[contact.corporation.name][section.name].append(contact)
-        if contact.is_main:
-            for sname in section_names:
-                if not default_contacts[contact.corporation.name][sname]:
-                    default_contacts[contact.corporation.name][sname] = contact
+    default_contacts, always_ccs = _default_contacts(query.values(corp_id_field))
 
     export = OpenXMLExport('Pratiques professionnelles')
     export.write_line(export_fields.keys(), bold=True)  # Headers
     # Data
     query_keys = [f for f in export_fields.values() if f is not None]
-    for line in query.values(*query_keys):
+    # Contact columns are the last ones of query_keys
+    contact_prefix = contact_test_field.rsplit('__', 1)[0] + '__'
+    contact_fields = [f[len(contact_prefix):] for f in query_keys if f.startswith(contact_prefix)]
+    for line in query.values(*query_keys, corp_id_field).iterator():
         values = []
         for field in query_keys:
             value = line[field]
             if 'gender' in field:
                 value = {'F': 'Madame', 'M': 'Monsieur', '': ''}[value]
             values.append(value)
+        contact_key = (line[corp_id_field], line[export_fields['Filière']])
         if line[contact_test_field] is None:
             # Use default contact
-            contact = default_contacts.get(line[corp_name_field], {}).get(line[export_fields['Filière']])
+            contact = default_contacts.get(contact_key)
             if contact:
-                values = values[:-6] + [
-                    contact.civility, contact.first_name, contact.last_name, contact.ext_id,
-                    contact.tel, contact.email
-                ]
-        if always_ccs[line[corp_name_field]].get(line[export_fields['Filière']]):
-            values.append("; ".join(
-                [c.email for c in always_ccs[line[corp_name_field]].get(line[export_fields['Filière']])]
-            ))
+                values = values[:-len(contact_fields)] + [getattr(contact, f) for f in contact_fields]
+        if always_ccs.get(contact_key):
+            values.append("; ".join([c.email for c in always_ccs[contact_key]]))
         export.write_line(values)
 
     return export.get_http_response('pp_export')
 
 
 def _ratio_Ede_Ase_Assc():
-    # Spliting for unattribued periods
-    tot_edeps = Course.objects.filter(imputation='EDEps').aggregate(Sum('period'))['period__sum'] or 0
-    tot_edepe = Course.objects.filter(imputation='EDEpe').aggregate(Sum('period'))['period__sum'] or 0
-    edepe_ratio = 1 if tot_edepe + tot_edeps == 0 else tot_edepe / (tot_edepe + tot_edeps)
-
-    tot_asefe = Course.objects.filter(imputation='ASEFE').aggregate(Sum('period'))['period__sum'] or 0
-    tot_mpts = Course.objects.filter(imputation='MPTS').aggregate(Sum('period'))['period__sum'] or 0
-    asefe_ratio = 1 if tot_asefe + tot_mpts == 0 else tot_asefe / (tot_asefe + tot_mpts)
+    """
+    Return ratios for spliting unattributed periods, computed from course
+    periods in one grouped query.
+    """
+    totals = defaultdict(int, Course.objects.filter(
+        imputation__in=['EDEps', 'EDEpe', 'ASEFE', 'MPTS', 'ASSCFE', 'MPS']
+    ).values('imputation').annotate(tot=Sum('period')).values_list('imputation', 'tot'))
 
-    tot_asscfe = Course.objects.filter(imputation='ASSCFE').aggregate(Sum('period'))['period__sum'] or 0
-    tot_mps = Course.objects.filter(imputation='MPS').aggregate(Sum('period'))['period__sum'] or 0
-    asscfe_ratio = 1 if tot_asscfe + tot_mps == 0 else tot_asscfe / (tot_asscfe + tot_mps)
+    def ratio(main, other):
+        return 1 if totals[main] + totals[other] == 0 else totals[main] / (totals[main] + totals[other])
 
-    return {'edepe': edepe_ratio, 'asefe': asefe_ratio, 'asscfe': asscfe_ratio}
+    return {
+        'edepe': ratio('EDEpe', 'EDEps'),
+        'asefe': ratio('ASEFE', 'MPTS'),
+        'asscfe': ratio('ASSCFE', 'MPS'),
+    }
 
 
 def imputations_export(request):
@@ -219,8 +228,7 @@ def imputations_export(request):
     export = OpenXMLExport('Imputations')
     export.write_line(IMPUTATIONS_EXPORT_FIELDS, bold=True)  # Headers
 
-    for teacher in Teacher.objects.filter(archived=False):
-        activities, imputations = teacher.calc_imputations(ratios)
+    for teacher, activities, imputations in Teacher.objects.filter(archived=False).calc_imputations(ratios):
         values = [
             teacher.last_name, teacher.first_name, teacher.previous_report,
             activities['tot_ens'], 'Ens. prof.', activities['tot_mandats'] + activities['tot_formation'],
@@ -294,7 +302,7 @@ def general_export(request):
     # Data
     query_keys = [f for f in export_fields.values() if f is not None]
     query = Student.objects.filter(archived=False).order_by('klass__name', 'last_name', 'first_name')
-    for line in query.values(*query_keys):
+    for line in query.values(*query_keys).iterator():
         values = []
         for field in query_keys:
             if field == 'gender':
@@ -357,7 +365,7 @@ def ortra_export(request):
                                                             'last_name',
                                                             'first_name')
 
-    for line in query.values(*query_keys):
+    for line in query.values(*query_keys).iterator():
         values = []
         for field in query_keys:
             if field == 'gender':
@@ -391,7 +399,10 @@ def export_qualification(request):
     students = Student.objects.filter(
         klass__in=es_classes, archived=False
     ).select_related('klass', 'referent', 'training_referent', 'mentor',
-    ).prefetch_related('examination_set').order_by('klass__name', 'last_name')
+    ).prefetch_related(Prefetch(
+        'examination_set',
+        queryset=Examination.objects.select_related('session', 'internal_expert', 'external_expert'),
+    )).order_by('klass__name', 'last_name')
 
     def format_date(val):
         if not val:
@@ -451,7 +462,7 @@ def institutions_export(request):
 
     export = OpenXMLExport('Institutions')
     export.write_line(headers, bold=True)
-    for corp in Corporation.objects.filter(archived=False).order_by('name'):
+    for corp in Corporation.objects.filter(archived=False).order_by('name').iterator():
         values = [format_value(getattr(corp, f[1])) for f in fields]
         export.write_line(values)
     return export.get_http_response('Institutions')
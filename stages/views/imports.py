@@ -2,7 +2,7 @@ import os
 import re
 import tempfile
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from fnmatch import fnmatch
 from subprocess import PIPE, Popen, call
@@ -13,8 +13,7 @@ from django.conf import settings
 from django.contrib import messages
 from django.core.files import File
 from django.db import IntegrityError, transaction
-from django.db.models import Value
-from django.db.models.functions import Concat
+from django.db.models import Prefetch
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
@@ -22,8 +21,9 @@ from django.views.generic import FormView
 
 from candidats.models import Candidate
 from ..forms import StudentImportForm, UploadHPFileForm, UploadReportForm
+from ..jobs import enqueue
 from ..models import (
-    Corporation, CorpContact, Course, Klass, Option, Section, Student, Teacher,
+    Corporation, CorpContact, Course, Klass, Option, Section, Student, Teacher, Training,
 )
 from ..utils import is_int
 
@@ -38,6 +38,27 @@ class ImportViewBase(FormView):
         elif isinstance(txt, str):
             return datetime.strptime(txt, '%d.%m.%Y').date()
 
+    def open_file(self, upfile, is_csv):
+        """Return an imported file object for `upfile` (an uploaded file or a file path)."""
+        if is_csv:
+            # Reopen the file in text mode
+            path = upfile if isinstance(upfile, str) else upfile.temporary_file_path()
+            return CSVImportedFile(File(open(path, mode='r', encoding='utf-8-sig')))
+        return FileFactory(upfile)
+
+    @staticmethod
+    def stats_messages(stats):
+        """Return (level, message) tuples summarizing import stats."""
+        msgs = []
+        non_fatal_errors = stats.get('errors', [])
+        if 'created' in stats:
+            msgs.append((messages.INFO, "Objets créés : %d" % stats['created']))
+        if 'modified' in stats:
+            msgs.append((messages.INFO, "Objets modifiés : %d" % stats['modified']))
+        if non_fatal_errors:
+            msgs.append((messages.WARNING, "Erreurs rencontrées:\n %s" % "\n".join(non_fatal_errors)))
+        return msgs
+
     def form_valid(self, form):
         upfile = form.cleaned_data['upload']
         is_csv = (
@@ -45,13 +66,14 @@ class ImportViewBase(FormView):
             'csv' in upfile.content_type or
             upfile.content_type == 'text/plain'
         )
+        if form.cleaned_data.get('background'):
+            job = enqueue(
+                'import', self.title, user=self.request.user, upload=upfile,
+                view='%s.%s' % (self.__class__.__module__, self.__class__.__qualname__), is_csv=is_csv,
+            )
+            return HttpResponseRedirect(reverse('job', args=[job.pk]))
         try:
-            if is_csv:
-                # Reopen the file in text mode
-                upfile = open(upfile.temporary_file_path(), mode='r', encoding='utf-8-sig')
-                imp_file = CSVImportedFile(File(upfile))
-            else:
-                imp_file = FileFactory(upfile)
+            imp_file = self.open_file(upfile, is_csv)
             with transaction.atomic():
                 stats = self.import_data(imp_file)
         except Exception as e:
@@ -62,13 +84,8 @@ class ImportViewBase(FormView):
                 msg += " (content-type: %s)" % upfile.content_type
             messages.error(self.request, msg)
         else:
-            non_fatal_errors = stats.get('errors', [])
-            if 'created' in stats:
-                messages.info(self.request, "Objets créés : %d" % stats['created'])
-            if 'modified' in stats:
-                messages.info(self.request, "Objets modifiés : %d" % stats['modified'])
-            if non_fatal_errors:
-                messages.warning(self.request, "Erreurs rencontrées:\n %s" % "\n".join(non_fatal_errors))
+            for level, msg in self.stats_messages(stats):
+                messages.add_message(self.request, level, msg)
         return HttpResponseRedirect(reverse('admin:index'))
 
 
@@ -113,6 +130,7 @@ class StudentImportView(ImportViewBase):
     # Those values are always taken from the import file
     fields_to_overwrite = ['klass', 'district', 'login_rpn']
     klasses_to_skip = []
+    batch_size = 500
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
@@ -135,21 +153,23 @@ class StudentImportView(ImportViewBase):
                 values['klass'] = None
             else:
                 try:
-                    k = Klass.objects.get(name=values['klass'])
-                except Klass.DoesNotExist:
+                    k = self._klasses[values['klass']]
+                except KeyError:
                     raise Exception("La classe '%s' n'existe pas encore" % values['klass'])
                 values['klass'] = k
 
         if 'option_ase' in values:
-            if values['option_ase']:
-                try:
-                    values['option_ase'] = Option.objects.get(name=values['option_ase'])
-                except Option.DoesNotExist:
-                    values['option_ase'] = None
-            else:
-                values['option_ase'] = None
+            values['option_ase'] = self._options.get(values['option_ase']) if values['option_ase'] else None
         return values
 
+    @staticmethod
+    def _ext_key(ext_id):
+        """Normalize an imported ext_id (str, float or int) to a dict key."""
+        try:
+            return int(ext_id)
+        except (TypeError, ValueError):
+            return ext_id
+
     @property
     def _existing_students(self):
         return Student.objects.filter(
@@ -158,13 +178,30 @@ class StudentImportView(ImportViewBase):
             klass__section__in=[s for s in Section.objects.all() if s.is_EPC]
         )
 
+    def get_candidates(self, names):
+        """Return a {(last_name, first_name): [candidates]} dict for new students names."""
+        candidates = defaultdict(list)
+        if names:
+            query = Candidate.objects.filter(
+                last_name__in={n[0] for n in names}, first_name__in={n[1] for n in names}
+            ).select_related('corporation', 'instructor')
+            for candidate in query:
+                candidates[(candidate.last_name, candidate.first_name)].append(candidate)
+        return candidates
+
     def update_defaults_from_candidate(self, defaults):
         # Any DoesNotExist exception will bubble up.
-        candidate = Candidate.objects.get(last_name=defaults['last_name'],
-                                          first_name=defaults['first_name'])
+        matching = self._candidates.get((defaults['last_name'], defaults['first_name']), [])
+        if not matching:
+            raise Candidate.DoesNotExist
+        elif len(matching) > 1:
+            raise Candidate.MultipleObjectsReturned(
+                "Il existe plusieurs candidats %s %s" % (defaults['last_name'], defaults['first_name'])
+            )
+        candidate = matching[0]
         # Mix CLOEE data and Candidate data
         if candidate.option in self.mapping_option_ase:
-            defaults['option_ase'] = Option.objects.get(name=self.mapping_option_ase[candidate.option])
+            defaults['option_ase'] = self._options[self.mapping_option_ase[candidate.option]]
         if candidate.corporation:
             defaults['corporation'] = candidate.corporation
         defaults['instructor'] = candidate.instructor
@@ -172,7 +209,10 @@ class StudentImportView(ImportViewBase):
         defaults['soutien_dys'] = candidate.handicap
 
     def import_data(self, up_file):
-        """ Import Student data from uploaded file. """
+        """
+        Import Student data from uploaded file.
+        All lookups are preloaded and database writes are done in bulk.
+        """
 
         def strip(val):
             return val.strip() if isinstance(val, str) else val
@@ -185,32 +225,56 @@ class StudentImportView(ImportViewBase):
         )
         seen_klasses = set()
         prof_dict = {str(t): t for t in Teacher.objects.all()}
+        self._klasses = {k.name: k for k in Klass.objects.all()}
+        self._options = {o.name: o for o in Option.objects.all()}
 
+        # First pass: read and clean file values
+        rows = []
+        corp_rows = OrderedDict()
         for line in up_file:
             student_defaults = {
                 val: '' if line[key] is None else strip(line[key]) for key, val in self.student_mapping.items()
             }
-            if student_defaults['ext_id'] in seen_students_ids:
+            ext_key = self._ext_key(student_defaults['ext_id'])
+            if ext_key in seen_students_ids:
                 # Second line for student, ignore it
                 continue
             for klass in self.klasses_to_skip:
                 if fnmatch(student_defaults['klass'], klass):
                     continue
-            seen_students_ids.add(student_defaults['ext_id'])
+            seen_students_ids.add(ext_key)
 
+            corp_key = None
             if self.corporation_mapping:
                 corporation_defaults = {
                     val: '' if line[key] is None else strip(line[key]) for key, val in self.corporation_mapping.items()
                 }
                 if isinstance(corporation_defaults['pcode'], float):
                     corporation_defaults['pcode'] = int(corporation_defaults['pcode'])
-                student_defaults['corporation'] = self.get_corporation(corporation_defaults)
+                if corporation_defaults['ext_id'] != '':
+                    corp_key = self._ext_key(corporation_defaults['ext_id'])
+                    corp_rows.setdefault(corp_key, corporation_defaults)
 
             if 'option_ase' in self.fields_to_overwrite:
                 if student_defaults['option_ase'] in self.mapping_option_ase:
                     student_defaults['option_ase'] = self.mapping_option_ase[student_defaults['option_ase']]
 
-            defaults = self.clean_values(student_defaults)
+            rows.append((ext_key, corp_key, self.clean_values(student_defaults)))
+
+        corporations = self.get_corporations(corp_rows)
+        students = Student.objects.in_bulk([row[0] for row in rows], field_name='ext_id')
+        self._candidates = self.get_candidates([
+            (defaults['last_name'], defaults['first_name'])
+            for ext_key, _, defaults in rows if ext_key not in students
+        ])
+
+        # Second pass: compute Student/Klass changes
+        klasses_to_update = {}
+        students_to_update = []
+        students_to_create = []
+        for ext_key, corp_key, defaults in rows:
+            if self.corporation_mapping:
+                defaults['corporation'] = corporations.get(corp_key)
 
             if defaults.get('teacher') and defaults['klass'] not in seen_klasses:
                 klass = defaults['klass']
@@ -220,27 +284,34 @@ class StudentImportView(ImportViewBase):
                     # Set the teacher for this klass
                     try:
                         klass.teacher = prof_dict[full_name]
-                        klass.save()
+                        klasses_to_update[klass.pk] = klass
                     except KeyError:
                         err_msg.append(
                             "L’enseignant {0} n'existe pas dans la base de données".format(full_name)
                         )
                     seen_klasses.add(klass)
 
-            try:
-                student = Student.objects.get(ext_id=defaults['ext_id'])
+            student = students.get(ext_key)
+            if student is not None:
                 modified = False
                 for field_name in self.fields_to_overwrite:
-                    if getattr(student, field_name) != defaults[field_name]:
-                        setattr(student, field_name, defaults[field_name])
+                    field = Student._meta.get_field(field_name)
+                    new_value = defaults[field_name]
+                    if field.is_relation:
+                        changed = getattr(student, field.attname) != (new_value.pk if new_value else None)
+                    else:
+                        changed = getattr(student, field_name) != new_value
+                    if changed:
+                        setattr(student, field_name, new_value)
                         modified = True
                 if student.archived:
                     student.archived = False
                     modified = True
                 if modified:
-                    student.save()
+                    student.set_archived_text()
+                    students_to_update.append(student)
                     obj_modified += 1
-            except Student.DoesNotExist:
+            else:
                 try:
                     self.update_defaults_from_candidate(defaults)
                 except Candidate.DoesNotExist:
@@ -252,49 +323,84 @@ class StudentImportView(ImportViewBase):
                     )
 
                 defaults.pop('teacher', None)
-                Student.objects.create(**defaults)
+                students_to_create.append(Student(**defaults))
                 obj_created += 1
 
+        Klass.objects.bulk_update(klasses_to_update.values(), ['teacher'], batch_size=self.batch_size)
+        Student.objects.bulk_update(
+            students_to_update, self.fields_to_overwrite + ['archived', 'archived_text'],
+            batch_size=self.batch_size
+        )
+        Student.objects.bulk_create(students_to_create, batch_size=self.batch_size)
+
         # Archive students who have not been exported
         rest = existing_students_ids - seen_students_ids
-        archived = 0
-        for student_id in rest:
-            st = Student.objects.get(ext_id=student_id)
+        to_archive = Student.objects.filter(ext_id__in=rest).prefetch_related(
+            Prefetch('training_set', queryset=Training.objects.select_related(
+                'availability__period', 'availability__corporation', 'availability__domain',
+                'availability__contact__corporation', 'referent',
+            ))
+        )
+        archived_students = []
+        for st in to_archive:
             st.archived = True
-            st.save()
-            archived += 1
+            st.set_archived_text(trainings=st.training_set.all())
+            archived_students.append(st)
+        Student.objects.bulk_update(archived_students, ['archived', 'archived_text'], batch_size=self.batch_size)
         return {
-            'created': obj_created, 'modified': obj_modified, 'archived': archived,
+            'created': obj_created, 'modified': obj_modified, 'archived': len(archived_students),
             'errors': err_msg,
         }
 
-    def get_corporation(self, corp_values):
-        if corp_values['ext_id'] == '':
-            return None
-        if corp_values.get('city') and is_int(corp_values['city'][:4]):
-            corp_values['pcode'], _, corp_values['city'] = corp_values['city'].partition(' ')
-        try:
-            corp, created = Corporation.objects.get_or_create(
-                ext_id=corp_values['ext_id'],
-                defaults=corp_values
+    def get_corporations(self, corp_rows):
+        """
+        Return a {ext_id: Corporation} dict for `corp_rows` (a {ext_id: corp_values} dict),
+        creating missing corporations in bulk.
+        """
+        if not corp_rows:
+            return {}
+        for corp_values in corp_rows.values():
+            if corp_values.get('city') and is_int(corp_values['city'][:4]):
+                corp_values['pcode'], _, corp_values['city'] = corp_values['city'].partition(' ')
+
+        corporations = {}
+        for corp in Corporation.objects.filter(ext_id__in=list(corp_rows)):
+            if corp.ext_id in corporations:
+                corp_values = corp_rows[corp.ext_id]
+                raise ValueError(
+                    "Il existe plusieurs institutions avec le numéro %s (%s, %s)" % (
+                        corp_values['ext_id'], corp_values['name'], corp_values['city']
+                ))
+            corporations[corp.ext_id] = corp
+
+        missing = [key for key in corp_rows if key not in corporations]
+        by_name_city = {
+            (corp.name, corp.city): corp for corp in Corporation.objects.filter(
+                name__in={corp_rows[key]['name'] for key in missing},
+                city__in={corp_rows[key]['city'] for key in missing},
             )
-        except IntegrityError:
-            # It may happen that the corporation exists (name and city are enforced unique)
-            # but without the ext_id. In that case, we update the ext_id.
-            try:
-                corp = Corporation.objects.get(name=corp_values['name'], city=corp_values['city'])
-                if corp.ext_id:
-                    raise
+        } if missing else {}
+        to_create, to_update = [], []
+        for key in missing:
+            corp_values = corp_rows[key]
+            corp = by_name_city.get((corp_values['name'], corp_values['city']))
+            if corp is None:
+                corp = Corporation(**corp_values)
+                by_name_city[(corp.name, corp.city)] = corp
+                to_create.append(corp)
+            elif corp.ext_id:
+                # name and city are enforced unique
+                raise IntegrityError(
+                    "L'institution %s, %s existe déjà avec le numéro %s" % (corp.name, corp.city, corp.ext_id)
+                )
+            else:
+                # The corporation exists but without the ext_id. In that case, we update the ext_id.
                 corp.ext_id = corp_values['ext_id']
-                corp.save()
-            except Corporation.DoesNotExist:
-                raise
-        except Corporation.MultipleObjectsReturned:
-            raise ValueError(
-                "Il existe plusieurs institutions avec le numéro %s (%s, %s)" % (
-                    corp_values['ext_id'], corp_values['name'], corp_values['city']
-            ))
-        return corp
+                to_update.append(corp)
+            corporations[key] = corp
+        Corporation.objects.bulk_create(to_create, batch_size=self.batch_size)
+        Corporation.objects.bulk_update(to_update, ['ext_id'], batch_size=self.batch_size)
+        return corporations
 
 
 class StudentEsterImportView(StudentImportView):
@@ -329,6 +435,9 @@ class StudentEsterImportView(StudentImportView):
             klass__section__in=[s for s in Section.objects.all() if s.is_ESTER]
         )
 
+    def get_candidates(self, names):
+        return {}
+
     def update_defaults_from_candidate(self, defaults):
         pass
 
@@ -338,6 +447,7 @@ class HPImportView(ImportViewBase):
     Importation du fichier HyperPlanning pour l'établissement  des feuilles
     de charges.
     """
+    title = "Importation du fichier HyperPlanning"
     form_class = UploadHPFileForm
     mapping = {
         'NOMPERSO_ENS': 'teacher',
@@ -369,13 +479,29 @@ class HPImportView(ImportViewBase):
         ('#Mandat_ASSC', 'ASSC'),
     ])
 
+    def imputation_matcher(self):
+        """
+        Return a function returning the imputation of a course public (first
+        matching account category), memoized as publics repeat a lot.
+        """
+        categories = list(self.account_categories.items())
+        cache = {}
+
+        def match(public):
+            if public not in cache:
+                cache[public] = next((v for k, v in categories if k in public), '')
+            return cache[public]
+        return match
+
     def import_data(self, up_file):
         obj_created = obj_modified = 0
         errors = []
 
         # Pour accélérer la recherche
         profs = {str(t): t for t in Teacher.objects.all()}
-        Course.objects.all().delete()
+        get_imputation = self.imputation_matcher()
+        # Courses aggregated by (teacher, subject, public)
+        courses = OrderedDict()
 
         for line in up_file:
             if (line['LIBELLE_MAT'] == '' or line['NOMPERSO_DIP'] == '' or line['TOTAL'] == ''):
@@ -389,27 +515,24 @@ class HPImportView(ImportViewBase):
                     errors.append(msg)
                 continue
 
-            obj, created = Course.objects.get_or_create(
-                teacher=teacher,
-                subject=line['LIBELLE_MAT'],
-                public=line['NOMPERSO_DIP'],
-            )
-
             period = int(float(line['TOTAL'].replace("'", "").replace('\xa0', '')))
-            if created:
-                obj.period = period
-                obj_created += 1
-                for k, v in self.account_categories.items():
-                    if k in obj.public:
-                        obj.imputation = v
-                        break
-            else:
-                obj.period += period
+            key = (teacher.pk, line['LIBELLE_MAT'], line['NOMPERSO_DIP'])
+            if key in courses:
+                courses[key].period += period
                 obj_modified += 1
-            obj.save()
+            else:
+                courses[key] = Course(
+                    teacher=teacher, subject=line['LIBELLE_MAT'], public=line['NOMPERSO_DIP'],
+                    period=period, imputation=get_imputation(line['NOMPERSO_DIP']),
+                )
+                obj_created += 1
 
-            if not obj.imputation:
-                errors.append("Le cours {0} n'a pas pu être imputé correctement!". format(str(obj)))
+        Course.objects.all().delete()
+        Course.objects.bulk_create(courses.values(), batch_size=500)
+
+        for course in courses.values():
+            if not course.imputation:
+                errors.append("Le cours {0} n'a pas pu être imputé correctement!". format(str(course)))
 
         return {'created': obj_created, 'modified': obj_modified, 'errors': errors}
 
@@ -418,15 +541,36 @@ class HPContactsImportView(ImportViewBase):
     """
     Importation du fichier Hyperplanning contenant les formateurs d'étudiants.
     """
+    title = "Importation des formateurs (fichier HP)"
     form_class = UploadHPFileForm
 
     def import_data(self, up_file):
         obj_modified = 0
         errors = []
-        for idx, line in enumerate(up_file, start=2):
+        lines = list(up_file)
+        students = Student.objects.in_bulk(
+            {int(line['UID_ETU']) for line in lines}, field_name='ext_id'
+        )
+        corps = {}
+        for corp in Corporation.objects.filter(
+                ext_id__in={int(line['NoSIRET']) for line in lines if line['NoSIRET']}):
+            if corp.ext_id in corps:
+                raise ValueError("Il existe plusieurs institutions avec le numéro %s" % corp.ext_id)
+            corps[corp.ext_id] = corp
+        contacts = {}
+        for contact in CorpContact.objects.filter(corporation__in=corps.values()).order_by('pk'):
+            contacts.setdefault(
+                (contact.corporation_id, contact.first_name.lower(), contact.last_name.lower()), contact
+            )
+
+        students_modified = {}
+        new_instructors = {}
+        contacts_created = []
+        contacts_modified = {}
+        for idx, line in enumerate(lines, start=2):
             try:
-                student = Student.objects.get(ext_id=int(line['UID_ETU']))
-            except Student.DoesNotExist:
+                student = students[int(line['UID_ETU'])]
+            except KeyError:
                 errors.append(
                     "Impossible de trouver l’étudiant avec le numéro %s" % int(line['UID_ETU'])
                 )
@@ -437,8 +581,8 @@ class HPContactsImportView(ImportViewBase):
                 )
                 continue
             try:
-                corp = Corporation.objects.get(ext_id=int(line['NoSIRET']))
-            except Corporation.DoesNotExist:
+                corp = corps[int(line['NoSIRET'])]
+            except KeyError:
                 errors.append(
                     "Impossible de trouver l’institution avec le numéro %s" % int(line['NoSIRET'])
                 )
@@ -448,28 +592,49 @@ class HPContactsImportView(ImportViewBase):
             if student.corporation_id != corp.pk:
                 # This import has priority over the corporation set by StudentImportView
                 student.corporation = corp
-                student.save()
+                students_modified[student.pk] = student
 
-            contact = corp.corpcontact_set.filter(
-                first_name__iexact=line['PRENOMMDS'].strip(),
-                last_name__iexact=line['NOMMDS'].strip()
-            ).first()
+            first_name, last_name = line['PRENOMMDS'].strip(), line['NOMMDS'].strip()
+            contact_key = (corp.pk, first_name.lower(), last_name.lower())
+            contact = contacts.get(contact_key)
             if contact is None:
-                contact = CorpContact.objects.create(
-                    corporation=corp, first_name=line['PRENOMMDS'].strip(),
-                    last_name=line['NOMMDS'].strip(), civility=line['CIVMDS'], email=line['EMAILMDS']
+                contact = CorpContact(
+                    corporation=corp, first_name=first_name,
+                    last_name=last_name, civility=line['CIVMDS'], email=line['EMAILMDS']
                 )
+                contacts[contact_key] = contact
+                contacts_created.append(contact)
             else:
                 if line['CIVMDS'] and contact.civility != line['CIVMDS']:
                     contact.civility = line['CIVMDS']
-                    contact.save()
+                    if contact.pk:
+                        contacts_modified[contact.pk] = contact
                 if line['EMAILMDS'] and contact.email != line['EMAILMDS']:
                     contact.email = line['EMAILMDS']
-                    contact.save()
-            if student.instructor != contact:
+                    if contact.pk:
+                        contacts_modified[contact.pk] = contact
+            if contact.pk is None:
+                changed = new_instructors.get(student.pk) is not contact
+            else:
+                changed = student.instructor_id != contact.pk
+            if changed:
                 student.instructor = contact
-                student.save()
+                if contact.pk is None:
+                    new_instructors[student.pk] = contact
+                else:
+                    # A new contact from a previous line is replaced
+                    new_instructors.pop(student.pk, None)
+                students_modified[student.pk] = student
                 obj_modified += 1
+
+        CorpContact.objects.bulk_create(contacts_created, batch_size=500)
+        CorpContact.objects.bulk_update(contacts_modified.values(), ['civility', 'email'], batch_size=500)
+        # Set instructor_id from newly created contacts.
+        for student_pk, contact in new_instructors.items():
+            students_modified[student_pk].instructor_id = contact.pk
+        Student.objects.bulk_update(
+            students_modified.values(), ['corporation', 'instructor'], batch_size=500
+        )
         return {'modified': obj_modified, 'errors': errors}
 
 
@@ -521,44 +686,58 @@ class ImportReportsView(FormView):
 
     def import_reports(self, pdf_path, semester):
         path = os.path.abspath(pdf_path)
+        base_name = os.path.basename(path)[:-4]
         student_regex = r'[E|É]lève\s*:\s*([^\n]*)'
-        # Directory automatically deleted when the variable is deleted
-        _temp_dir = tempfile.TemporaryDirectory()
-        temp_dir = _temp_dir.name
-
-        os.system("pdfseparate %s %s/%s_%%d.pdf" % (path, temp_dir, os.path.basename(path)[:-4]))
-
-        # Look for student names in each separated PDF and rename PDF with student name
-        pdf_count = 0
         pdf_field = 'report_sem' + semester
-        for filename in os.listdir(temp_dir):
-            p = Popen(['pdftotext', os.path.join(temp_dir, filename), '-'],
-                      shell=False, stdout=PIPE, stderr=PIPE)
-            output, errs = p.communicate()
-            m = re.search(student_regex, output.decode('utf-8'))
-            if not m:
-                print("Unable to find student name in %s" % filename)
-                continue
-            student_name = m.groups()[0]
-            # Find a student with the found student_name
-            try:
-                student = self.klass.student_set.exclude(archived=True
-                    ).annotate(fullname=Concat('last_name', Value(' '), 'first_name')).get(fullname=student_name)
-            except Student.DoesNotExist:
-                messages.warning(
-                    self.request,
-                    "Impossible de trouver l'étudiant {} dans la classe {}".format(student_name, self.klass.name)
-                )
-                continue
-            with open(os.path.join(temp_dir, filename), 'rb') as pdf:
-                getattr(student, pdf_field).save(filename, File(pdf), save=True)
-            student.save()
-            pdf_count += 1
+
+        students = list(self.klass.student_set.exclude(archived=True))
+        # Index by 'last_name first_name', None for ambiguous names.
+        students_by_name = {}
+        for student in students:
+            full_name = '%s %s' % (student.last_name, student.first_name)
+            students_by_name[full_name] = None if full_name in students_by_name else student
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Split the file and extract the text of all pages in parallel,
+            # pdftotext separates pages by form feeds.
+            separate = Popen(
+                ['pdfseparate', path, os.path.join(temp_dir, '%s_%%d.pdf' % base_name)],
+                shell=False, stdout=PIPE, stderr=PIPE
+            )
+            to_text = Popen(['pdftotext', path, '-'], shell=False, stdout=PIPE, stderr=PIPE)
+            output, errs = to_text.communicate()
+            separate.communicate()
+
+            # Look for student names in each page and save the separated PDF,
+            # the last page of a student wins.
+            to_update = {}
+            for num, page_text in enumerate(output.decode('utf-8').split('\f'), start=1):
+                filename = '%s_%d.pdf' % (base_name, num)
+                if not os.path.exists(os.path.join(temp_dir, filename)):
+                    continue
+                m = re.search(student_regex, page_text)
+                if not m:
+                    messages.warning(
+                        self.request, "Impossible de trouver le nom de l'étudiant à la page {}".format(num)
+                    )
+                    continue
+                student_name = m.groups()[0]
+                student = students_by_name.get(student_name)
+                if student is None:
+                    if student_name in students_by_name:
+                        msg = "Plusieurs étudiants s'appellent {} dans la classe {}"
+                    else:
+                        msg = "Impossible de trouver l'étudiant {} dans la classe {}"
+                    messages.warning(self.request, msg.format(student_name, self.klass.name))
+                    continue
+                with open(os.path.join(temp_dir, filename), 'rb') as pdf:
+                    getattr(student, pdf_field).save(filename, File(pdf), save=False)
+                to_update[student.pk] = student
+            Student.objects.bulk_update(to_update.values(), [pdf_field])
 
         messages.success(
             self.request,
             '{0} bulletins PDF ont été importés pour la classe {1} (sur {2} élèves)'.format(
-                pdf_count, self.klass.name,
-                self.klass.student_set.exclude(archived=True).count()
+                len(to_update), self.klass.name, len(students)
             )
         )
@@ -0,0 +1,77 @@
+from functools import wraps
+
+from django.http import FileResponse, Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.generic import DetailView, ListView
+
+from ..jobs import enqueue
+from ..mail import warn_unsent_mails
+from ..models import Job
+
+
+def background_allowed(title):
+    """
+    Decorator allowing a GET view to be run as a background job when called
+    with the `background` parameter. The job result is the response content.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method == 'GET' and 'background' in request.GET:
+                query = request.GET.copy()
+                del query['background']
+                job = enqueue(
+                    'view', title, user=request.user, path=request.path_info, query=query.urlencode()
+                )
+                return HttpResponseRedirect(reverse('job', args=[job.pk]))
+            return view(request, *args, **kwargs)
+        wrapper.background_allowed = True
+        return wrapper
+    return decorator
+
+
+def user_jobs(user):
+    jobs = Job.objects.all()
+    return jobs if user.is_superuser else jobs.filter(user=user)
+
+
+class JobListView(ListView):
+    template_name = 'jobs.html'
+
+    def get_queryset(self):
+        return user_jobs(self.request.user).select_related('user')
+
+    def get_context_data(self, **kwargs):
+        warn_unsent_mails(self.request)
+        return super().get_context_data(**kwargs)
+
+
+class JobView(DetailView):
+    template_name = 'job.html'
+
+    def get_queryset(self):
+        return user_jobs(self.request.user)
+
+    def get_context_data(self, **kwargs):
+        warn_unsent_mails(self.request)
+        return super().get_context_data(**kwargs)
+
+
+def job_status(request, pk):
+    """Return job status as JSON, for polling by the job page."""
+    job = get_object_or_404(user_jobs(request.user), pk=pk)
+    return JsonResponse({
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'finished': job.is_finished,
+        'message': job.message,
+        'download_url': reverse('job-download', args=[job.pk]) if job.result else None,
+    })
+
+
+def job_download(request, pk):
+    job = get_object_or_404(user_jobs(request.user), pk=pk)
+    if not job.result:
+        raise Http404("Cette tâche n'a pas de résultat.")
+    return FileResponse(job.result.open('rb'), as_attachment=True, filename=job.result_filename)